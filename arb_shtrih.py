@@ -1,14 +1,49 @@
 import os
 import csv
+import time
+import json
 import shutil
+import filecmp
+import tempfile
 import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from argparse import ArgumentParser
+from typing import NamedTuple
 
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
-import oracledb
-from dbfpy3 import dbf as dbfpy
-import dbf
+
+import ora_session
+import instrument
+import rn7_codec
+from dbf_mmap import read_dbf_frame, read_dbf_chunks, dbf_fingerprint, patch_field, DbfPatcher
+from snapshot import cached, invalidate, evict
+from columnar import export_csv, SCHEMAS, DTYPE_IMP, DTYPE_UDO, DTYPE_SOOT
+from shared_arrays import SharedArrays, attach
+from code_alloc import CodeAllocator, code_values, CONFLICTS, DUPLICATE_ALLOCATE, DUPLICATE_KEEP
+from diagnostics import Diagnostics, LOG_PROC, VERBOSITY_SUMMARY, VERBOSITY_ERRORS, VERBOSITY_ALL
+
+
+# Only raw rn7 and rn8 are fetched, RN7 (4 chars) is converted to shtrih code (3 digits of ASCII code
+# for every char) on client side, see rn7_codec
+IMPORT7_SQL = 'select i.rn7, i.rn8 from import7 i where i.table7=\'INBASE\''
+UDO_IMPORT7_SQL = 'select ui.rn7, ui.rn8 from udo_import7 ui where trim(ui.table7)=\'INSOST\''
+
+# Same conversion on server side, used only to check rn7_codec (see verify_codec)
+IMPORT7_SHTRIH_SQL = ('select i.rn7, i.rn8, LPAD(ASCII(SUBSTR(I.RN7, 1, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(I.RN7, 2, 1)), 3, '
+               '\'0\') || LPAD(ASCII(SUBSTR(I.RN7, 3, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(I.RN7, 4, 1)), 3, \'0\') '
+               'from import7 i where i.table7=\'INBASE\'')
+UDO_IMPORT7_SHTRIH_SQL = ('select ui.rn7, LPAD(ASCII(SUBSTR(uI.RN7, 1, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 2, 1)), 3, '
+                   '\'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 3, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 4, 1)), 3, '
+                   '\'0\'), ui.rn8 from udo_import7 ui where trim(ui.table7)=\'INSOST\'')
+
+# Row count, max RN8 and sum of row hashes show, if table was changed since previous run
+# (the hash catches rows changed in place, e.g. fixed mapping of rn7)
+IMPORT7_FINGERPRINT_SQL = ('select count(*), max(i.rn8), sum(ORA_HASH(i.rn7 || \'@\' || i.rn8)) '
+                           'from import7 i where i.table7=\'INBASE\'')
+UDO_IMPORT7_FINGERPRINT_SQL = ('select count(*), max(ui.rn8), sum(ORA_HASH(ui.rn7 || \'@\' || ui.rn8)) '
+                               'from udo_import7 ui where trim(ui.table7)=\'INSOST\'')
 
 
 def log(ct: int, name: str) -> None:
@@ -61,6 +96,53 @@ def read_params(path: str) -> dict:
     return params
 
 
+class Site(NamedTuple):
+    """
+    One pair of dbf folders of batch run (see read_manifest)
+    output: path to result dbf file of site
+    """
+    name: str
+    dbf7: str
+    dbf8: str
+    output: str
+
+
+def read_manifest(path: str) -> list:
+    """
+    Service function, read manifest of batch run: csv file with header 'site,dbf7,dbf8[,output]',
+    one line per site. Default output is ..\\.result\\<site>\\NEW_InvSoot.dbf
+    :param path: path to manifest file
+    :return: list of Site
+    """
+    sites = []
+    with open(path, 'r', newline='', encoding='UTF-8') as f:
+        for line in csv.DictReader(f):
+            name = (line.get('site') or '').strip()
+            if not name:
+                continue
+            output = (line.get('output') or '').strip() or f'..\\.result\\{name}\\NEW_InvSoot.dbf'
+            sites.append(Site(name, line['dbf7'].strip(), line['dbf8'].strip(), output))
+
+    names = [i.name for i in sites]
+    duplicated = sorted({i for i in names if names.count(i) > 1})
+    if duplicated:
+        raise ValueError(f'sites {duplicated} are listed in {path} more than once')
+    return sites
+
+
+def session_params(params: dict, args) -> dict:
+    """
+    Service function, add database session options from command line to params
+    :param params: dict with params (see read_params)
+    :param args: command line arguments (sqlite, thin, workers)
+    :return: dict with params
+    """
+    params['sqlite'] = args.sqlite
+    params['thin'] = args.thin
+    params['pool_size'] = max(args.workers, 2)
+    return params
+
+
 def convert7(rn7: str) -> str:
     """
     DENIED
@@ -70,291 +152,1029 @@ def convert7(rn7: str) -> str:
     return ''.join(str(ord(i)).zfill(3) for i in list(rn7))
 
 
-def dataframe_from_csv(csv_name: str, tp: str = 'base', version: int = 7) -> pd.DataFrame:
+def dataframe_from_dbf(path: str, name: str) -> pd.DataFrame:
     """
-    Optional feature (doesn't do much)
-    Create pd.DataFrame object from passed filename parameter
-    :param csv_name: csv filename
-    :param tp: type of passing csv file (invsoot, sinbase, etc.)
-    :param version: db version
+    Create pd.DataFrame object straight from 'InvSoot.dbf' file (without csv file)
+    Only columns of DTYPE_SOOT are read
+    :param path: path to dbf's folder
+    :param name: name for log file
     :return: pd.DataFrame object
     """
-    dtype_imp = {'RN7': 'str', 'RN8': pd.Int64Dtype(), 'SRN7': pd.Int64Dtype()}
-    dtype_soot = {'IRN': pd.Int64Dtype(),
-                  'KRN': pd.Int64Dtype(),
-                  'SRN': pd.Int64Dtype(),
-                  'CODE': 'str'}
+    with instrument.stage(f'decode {name}') as record:
+        db = read_dbf_frame(path + '\\InvSoot.dbf', dtype=DTYPE_SOOT, columns=list(DTYPE_SOOT))
+        record.rows = len(db)
+    log(len(db), name)
+    return db
 
-    dtype_base7 = {'RN': pd.Int64Dtype(), 'NRN': pd.Int64Dtype(), 'ARN': pd.Int64Dtype(), 'MRN': pd.Int64Dtype(),
-                   'KRN': pd.Int64Dtype(), 'GRP': pd.Int64Dtype(),
-                   'NUM': 'str', 'KART': 'str', 'PASS': 'str', 'ZAV': 'str', 'TIP': 'float', 'SUM': 'float',
-                   'DAT': 'str', 'KOL': 'float', 'HND': 'bool', 'PR1': 'str', 'PRM': 'str', 'OKOF': 'str'}
 
-    if tp == 'base':
-        if version == 7:
-            db = pd.read_csv(csv_name, delimiter='@', dtype=dtype_base7)
-        else:
-            db = pd.read_csv(csv_name, delimiter='@')
-    elif tp == 'soot':
-        db = pd.read_csv(csv_name, delimiter='@', dtype=dtype_soot, encoding="ISO-8859-1")
-    else:
-        db = pd.read_csv(csv_name, delimiter='@', dtype=dtype_imp, encoding='ISO-8859-1')
+def fetch_import7(connection, arraysize: int = 50000) -> pd.DataFrame:
+    """
+    Collect table 'IMPORT7' (INBASE) to pd.DataFrame, RN7 is packed, SRN7 is shtrih value of RN7 without the first digit
+    :param connection: DB-API connection
+    :param arraysize: rows fetched in one round-trip
+    :return: pd.DataFrame with columns RN7, RN8, SRN7
+    """
+    with instrument.stage('query import7') as record:
+        db = ora_session.fetch_frame(connection, IMPORT7_SQL, ['RN7', 'RN8'], DTYPE_IMP, arraysize)
+        db['SRN7'] = rn7_codec.value(db['RN7'], drop_first=True)
+        record.rows = len(db)
     return db
 
 
-def oracle_conn(instant_cli: str, host: str, service: str, authid: str, password: str) -> None:
+def fetch_udo_import7(connection, arraysize: int = 50000) -> pd.DataFrame:
     """
-    Function that connect to oracle db, collect data from table 'IMPORT7', and write it to csv file
-    :param instant_cli: path to oracle_instantclient folder
-    :param host: oracle db host (IP)
-    :param service: oracle service name (oracle_sid)
-    :param authid: (username)
-    :param password: (user password)
-    :return: None
+    Collect table 'UDO_IMPORT7' (INSOST) to pd.DataFrame, SRN7 is packed RN7, RN7 is its shtrih value
+    :param connection: DB-API connection
+    :param arraysize: rows fetched in one round-trip
+    :return: pd.DataFrame with columns SRN7, RN7, RN8
     """
-    oracledb.init_oracle_client(lib_dir=instant_cli)
-    connection = oracledb.connect(user=authid, password=password, host=host, port=1521, service_name=service)
+    with instrument.stage('query udo_import7') as record:
+        db = ora_session.fetch_frame(connection, UDO_IMPORT7_SQL, ['SRN7', 'RN8'], DTYPE_UDO, arraysize)
+        db.insert(1, 'RN7', rn7_codec.value(db['SRN7']))
+        record.rows = len(db)
+    return db
 
-    with open('..\\.temp_files\\import7.csv', 'w', newline='', encoding='UTF-8') as txt:
-        cursor = connection.cursor()
-        writer = csv.writer(txt, delimiter='@',
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['RN7', 'RN8', 'SRN7'])
-        inventory = cursor.execute(
-            'select i.rn7, i.rn8, LPAD(ASCII(SUBSTR(I.RN7, 1, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(I.RN7, 2, 1)), 3, '
-            '\'0\') || LPAD(ASCII(SUBSTR(I.RN7, 3, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(I.RN7, 4, 1)), 3, \'0\') from '
-            'import7 i where i.table7=\'INBASE\'')
-        for row in tqdm(inventory):
-            rn7, rn8, rn_shtrih = row
-            # rn_shtrih = ''.join(str(ord(i)).zfill(3) for i in [s for s in rn7])
-            writer.writerow([rn7, rn8, rn_shtrih[1:]])
-            # print(rn8[0], rn7[0], rn_shtrih)
-        cursor.close()
 
-    with open('..\\.temp_files\\udo_import7.csv', 'w', newline='', encoding='UTF-8') as txt:
+def table_fingerprint(connection, sql: str) -> dict:
+    """
+    Short description of database table state (see IMPORT7_FINGERPRINT_SQL)
+    :param connection: DB-API connection
+    :param sql: query returning row count, max RN and sum of row hashes
+    :return: dict
+    """
+    cursor = connection.cursor()
+    count, max_rn, rows_hash = cursor.execute(sql).fetchone()
+    cursor.close()
+    return {'sql': sql, 'count': count, 'max_rn': max_rn, 'hash': rows_hash}
+
+
+def verify_codec(connection) -> int:
+    """
+    Check rn7_codec against shtrih codes computed by database (IMPORT7_SHTRIH_SQL and UDO_IMPORT7_SHTRIH_SQL),
+    and that codes are decoded back to the same RN7
+    :param connection: DB-API connection
+    :return: number of checked rows
+    """
+    checked = 0
+    for sql, position in ((IMPORT7_SHTRIH_SQL, 2), (UDO_IMPORT7_SHTRIH_SQL, 1)):
         cursor = connection.cursor()
-        writer = csv.writer(txt, delimiter='@',
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['SRN7', 'RN7', 'RN8'])
-        tmp = cursor.execute(
-            'select ui.rn7, LPAD(ASCII(SUBSTR(uI.RN7, 1, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 2, 1)), 3, '
-            '\'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 3, 1)), 3, \'0\') || LPAD(ASCII(SUBSTR(uI.RN7, 4, 1)), 3, \'0\'), '
-            'ui.rn8 from udo_import7 ui where trim(ui.table7)=\'INSOST\''
-        )
-        for row in tqdm(tmp):
-            writer.writerow(row)
+        rows = cursor.execute(sql).fetchall()
         cursor.close()
-    connection.close()
 
+        rn7 = np.array(['' if row[0] is None else row[0] for row in rows], dtype=str)
+        expected = np.array(['' if row[position] is None else row[position] for row in rows], dtype=str)
+        codes = rn7_codec.encode(rn7)
+        for actual, name in ((np.char.decode(codes, 'ascii'), 'shtrih code'), (rn7_codec.decode(codes), 'decoded RN7')):
+            wrong = np.flatnonzero(actual != (expected if name == 'shtrih code' else rn7))
+            if len(wrong):
+                raise ValueError(f'RN7 {rn7[wrong[0]]!r}: {name} {actual[wrong[0]]!r} by rn7_codec, '
+                                 f'shtrih code {expected[wrong[0]]!r} by database')
+        checked += len(rows)
+    return checked
+
+
+# Estimated working memory of one InvSoot8 record in streaming mode (decoded chunk, mapping arrays, codes),
+# --max-memory is converted to chunk size with it
+STREAM_ROW_BYTES = 2048
 
-def read_dbf(path7: str, path8: str) -> None:
+# repeated_keys spills key hashes of InvSoot8 to that many files, only one file is in memory at once
+SPILL_BUCKETS = 64
+SPILL_DIR = '..\\.temp_files'
+
+# Outcomes of mapping single InvSoot8 row (see resolve_codes)
+ST_OK = 0                   # code found in InvSoot7
+ST_DUPLICATE = 1            # code found, but it was already given to previous row
+ST_KRN_NAN_NO_IMPORT7 = 2   # KRN is NAN, IRN is not in import7
+ST_KRN_NAN_NO_SOOT7 = 3     # KRN is NAN, InvSoot7 doesn't contain rn7
+ST_KRN_NAN_KRN_SOOT7 = 4    # KRN is NAN, but InvSoot7 has rn7 only with not NAN KRN
+ST_NO_IMPORT7 = 5           # KRN is not NAN, IRN is not in import7
+ST_NO_SUBST = 6             # KRN is not NAN, KRN is not in udo_import7 (InvSUBST)
+ST_NO_CODE7 = 7             # KRN is not NAN, InvSoot7 doesn't contain (rn7, invs_rn7)
+ST_DUPLICATE_NEW = 8        # code found, but it was already given to previous row, free code is given instead
+
+# Outcomes, that get free code from CodeAllocator
+ST_FALLBACK = (ST_KRN_NAN_NO_SOOT7, ST_KRN_NAN_KRN_SOOT7, ST_NO_SUBST, ST_DUPLICATE_NEW)
+
+
+class KeyIndex(NamedTuple):
     """
-    Function read input dbf's files, version 7 and 8, and write it to csv files
-    :param path7: path to 7's dbf's folder
-    :param path8: path to 8's dbf's folder
-    :return: none
+    Sorted index over one or two integer key columns, keeps first row of every key
+    keys: sorted unique keys (pair of keys is packed through ranks in levels)
+    rows: position of the first row with that key
+    levels: sorted unique values of every key column (only for pair of keys)
     """
-    count = 0
-    path7_inv = path7 + '\\InvSoot.dbf'
-    path8_inv = path8 + '\\InvSoot.dbf'
-
-    db7 = dbfpy.Dbf(path7_inv)
-    db8 = dbfpy.Dbf(path8_inv)
-
-    with open('..\\.temp_files\\InvSoot7.csv', 'w', newline='', encoding='utf-8') as csv7:
-        spamwriter = csv.writer(csv7, delimiter='@',
-                                quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        spamwriter.writerow([i.decode('UTF-8') for i in db7.field_names])
-        for row in tqdm(db7, desc='Import from dbf to CSV file'):
-            spamwriter.writerow([str(i).strip() for i in row])
-            count += 1
-    db7.close()
-    log(count, 'InvSoot7.dbf')
-
-    count = 0
-    with open('..\\.temp_files\\InvSoot8.csv', 'w', newline='', encoding='utf-8') as csv8:
-        spamwriter = csv.writer(csv8, delimiter='@',
-                                quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        spamwriter.writerow([i.decode('UTF-8') for i in db8.field_names])
-        for row in tqdm(db8, desc='Import from dbf to CSV file'):
-            count += 1
-            spamwriter.writerow([str(i).strip() for i in row])
-    db8.close()
-    log(count, 'InvSoot8.dbf')
-
-    # Reading 'SINBASE.dbf'
-    # Rejected section (not used)
-    # path7_base = path7 + '\\SINBASE.dbf'
-    # path8_base = path8 + '\\SINBASE.dbf'
-
-    # db7_base = dbfpy.Dbf(path7_base)
-    # db8_base = dbfpy.Dbf(path8_base)
-
-    # count = 0
-    # with open('SINBASE7.csv', 'w', newline='', encoding='utf-8') as csv7_base:
-    #     writer = csv.writer(csv7_base, delimiter='@',
-    #                         quotechar='|', quoting=csv.QUOTE_MINIMAL)
-    #     writer.writerow([i.decode('UTF-8') for i in db7_base.field_names])
-    #     for row in tqdm(db7_base):
-    #         writer.writerow([str(i).strip() for i in row])
-    #         count += 1
-    #     db7_base.close()
-    #     log(count, 'SInBase7.dbf')
-    #
-    # count = 0
-    # with open('SINBASE8.csv', 'w', newline='', encoding='utf-8') as csv8_base:
-    #     writer = csv.writer(csv8_base, delimiter='@',
-    #                         quotechar='|', quoting=csv.QUOTE_MINIMAL)
-    #     writer.writerow([i.decode('UTF-8') for i in db8_base.field_names])
-    #     for row in tqdm(db8_base):
-    #         writer.writerow([str(i).strip() for i in row])
-    #         count += 1
-    #     db8_base.close()
-    #     log(count, 'SInBase8.dbf')
-
-
-def log_proc(args):
-    """
-    service function, logging something, write it to log_proc.txt
-    :param args: some arguments
-    """
-    with open('..\\.log_files\\log_proc.txt', 'a', encoding='utf-8') as f:
-        # f.write(f'{args[0]}, {args[1]}, {args[2]}\n')
-        f.write(' -| '.join([str(i) for i in args]))
-        f.write('\n')
-        f.write('_' * 40 + '\n')
+    keys: np.ndarray
+    rows: np.ndarray
+    levels: tuple
+
+
+def key_column(column) -> tuple:
+    """
+    Service function, split nullable integer column into int64 values and null mask
+    :param column: pd.Series (or array) with integer keys
+    :return: (values, mask)
+    """
+    column = pd.array(column, dtype=pd.Int64Dtype())
+    return column.to_numpy(dtype=np.int64, na_value=0), np.asarray(column.isna())
+
+
+def _search(sorted_keys: np.ndarray, keys: np.ndarray) -> tuple:
+    """
+    Service function, find keys in sorted array
+    :param sorted_keys: sorted unique keys
+    :param keys: keys to find
+    :return: (positions, found mask)
+    """
+    pos = np.searchsorted(sorted_keys, keys)
+    found = pos < len(sorted_keys)
+    found[found] = sorted_keys[pos[found]] == keys[found]
+    return pos, found
+
+
+def _pack_keys(levels: tuple, values: list) -> tuple:
+    """
+    Service function, pack several key columns into one int64 key by their ranks in levels
+    :param levels: sorted unique values of every key column
+    :param values: key columns
+    :return: (packed keys, found mask)
+    """
+    keys = np.zeros(len(values[0]), dtype=np.int64)
+    found = np.ones(len(values[0]), dtype=bool)
+    for level, value in zip(levels, values):
+        rank, level_found = _search(level, value)
+        found &= level_found
+        keys = keys * len(level) + np.where(level_found, rank, 0)
+    return keys, found
+
+
+def build_key_index(*columns) -> KeyIndex:
+    """
+    Build sorted index over key columns, rows with null in any key are skipped
+    :param columns: one or two integer key columns
+    :return: KeyIndex object
+    """
+    values, masks = zip(*[key_column(column) for column in columns])
+    valid = ~np.logical_or.reduce(masks)
+    rows = np.flatnonzero(valid)
+    values = [value[valid] for value in values]
+
+    if len(values) == 1:
+        levels = ()
+        keys = values[0]
+    else:
+        levels = tuple(np.unique(value) for value in values)
+        keys, _ = _pack_keys(levels, values)
+
+    order = np.argsort(keys, kind='stable')
+    keys, rows = keys[order], rows[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return KeyIndex(keys[first], rows[first], levels)
+
+
+def key_lookup(index: KeyIndex, *columns) -> np.ndarray:
+    """
+    Find first rows of index for every key, -1 if key is null or not found
+    :param index: KeyIndex object
+    :param columns: key columns, same count as index was built on
+    :return: array of row positions
+    """
+    values, masks = zip(*[key_column(column) for column in columns])
+    valid = ~np.logical_or.reduce(masks)
+
+    if index.levels:
+        keys, found = _pack_keys(index.levels, list(values))
+        valid &= found
+    else:
+        keys = values[0]
+
+    pos, found = _search(index.keys, keys)
+    valid &= found
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    rows[valid] = index.rows[pos[valid]]
+    return rows
+
+
+def build_import_indexes(db_imp: pd.DataFrame, invsubst: pd.DataFrame) -> dict:
+    """
+    Build lookup indexes for oracle tables: import7 (RN8 -> SRN7) and udo_import7 (RN8 -> RN7)
+    :param db_imp: import7 table
+    :param invsubst: udo_import7 table
+    :return: dict with indexes and looked up columns
+    """
+    return {'import7': build_key_index(db_imp['RN8']),
+            'srn7': pd.array(db_imp['SRN7'], dtype=pd.Int64Dtype()),
+            'subst': build_key_index(invsubst['RN8']),
+            'subst_rn7': pd.array(invsubst['RN7'], dtype=pd.Int64Dtype())}
+
+
+def build_soot7_indexes(db7: pd.DataFrame) -> dict:
+    """
+    Build lookup indexes for InvSoot7: (IRN, KRN) -> CODE, (IRN, NAN) -> CODE and IRN
+    Codes are taken from categorical CODE column: rows with equal codes share one str object and code group
+    (category number, null code is the last group), code_index gives group of code
+    :param db7: InvSoot7 table
+    :return: dict with indexes, codes and code groups
+    """
+    irn = pd.array(db7['IRN'], dtype=pd.Int64Dtype())
+    irn_krn_null = irn.copy()
+    irn_krn_null[np.asarray(db7['KRN'].notna())] = pd.NA
+
+    code7 = pd.Categorical(db7['CODE'])
+    categories = np.append(code7.categories.to_numpy(dtype=object), np.nan)
+    group = np.where(code7.codes < 0, len(categories) - 1, code7.codes)
+    return {'pair': build_key_index(irn, db7['KRN']),
+            'krn_null': build_key_index(irn_krn_null),
+            'irn': build_key_index(irn),
+            'code': categories[group],
+            'group': group,
+            'groups': len(categories),
+            'code_index': code7.categories}
+
+
+def resolve_codes(irn8, krn8, imp: dict, soot7: dict) -> dict:
+    """
+    Find InvSoot7 code row for every InvSoot8 row (without duplicate check)
+    InvSoot8 -> import7 on RN8, KRN -> udo_import7, then (SRN7, KRN7) -> InvSoot7
+    :param irn8: InvSoot8 IRN column
+    :param krn8: InvSoot8 KRN column
+    :param imp: indexes of oracle tables (see build_import_indexes)
+    :param soot7: indexes of InvSoot7 (see build_soot7_indexes)
+    :return: dict with status, row7 (InvSoot7 row with code, -1 if none), rn7 and invs_rn7 columns
+    """
+    _, krn_nan = key_column(krn8)
+
+    imp_pos = key_lookup(imp['import7'], irn8)
+    subst_pos = key_lookup(imp['subst'], krn8)
+    rn7 = imp['srn7'].take(imp_pos, allow_fill=True)
+    invs_rn7 = imp['subst_rn7'].take(subst_pos, allow_fill=True)
+
+    row7 = np.where(krn_nan, key_lookup(soot7['krn_null'], rn7), key_lookup(soot7['pair'], rn7, invs_rn7))
+    irn7_found = key_lookup(soot7['irn'], rn7) >= 0
+
+    # Every next assignment has higher priority, same as order of checks for single row
+    status = np.full(len(row7), ST_OK, dtype=np.int8)
+    status[krn_nan & (row7 < 0)] = np.where(irn7_found, ST_KRN_NAN_KRN_SOOT7, ST_KRN_NAN_NO_SOOT7)[krn_nan & (row7 < 0)]
+    status[krn_nan & (imp_pos < 0)] = ST_KRN_NAN_NO_IMPORT7
+    status[~krn_nan & (row7 < 0)] = ST_NO_CODE7
+    status[~krn_nan & (subst_pos < 0)] = ST_NO_SUBST
+    status[~krn_nan & (imp_pos < 0)] = ST_NO_IMPORT7
+
+    return {'status': status, 'row7': row7, 'rn7': rn7, 'invs_rn7': invs_rn7}
+
+
+# Shared lookup structures of worker process of resolve_codes_sharded
+_SHARD = {}
+
+
+def _share_index(shared: SharedArrays, index: KeyIndex) -> tuple:
+    """
+    Service function, copy KeyIndex arrays to shared memory
+    """
+    return shared.share(index.keys), shared.share(index.rows), tuple(shared.share(i) for i in index.levels)
+
+
+def _attach_index(descriptor: tuple, keep: list) -> KeyIndex:
+    """
+    Service function, KeyIndex over shared memory (see _share_index)
+    """
+    keys, rows, levels = descriptor
+    return KeyIndex(attach(keys, keep), attach(rows, keep), tuple(attach(i, keep) for i in levels))
+
+
+def _share_column(shared: SharedArrays, column) -> tuple:
+    """
+    Service function, copy nullable integer column to shared memory as values and mask
+    """
+    values, mask = key_column(column)
+    return shared.share(values), shared.share(mask)
+
+
+def _attach_column(descriptor: tuple, keep: list) -> pd.arrays.IntegerArray:
+    """
+    Service function, read-only Int64 column over shared memory (see _share_column)
+    """
+    values, mask = descriptor
+    return pd.arrays.IntegerArray(attach(values, keep), attach(mask, keep))
+
+
+def shard_of(irn: np.ndarray, shards: int) -> np.ndarray:
+    """
+    Shard number of every row by hash of IRN (Fibonacci hashing, so sequential IRN are spread evenly)
+    :param irn: int64 IRN values
+    :param shards: number of shards
+    :return: array of shard numbers
+    """
+    hashed = (irn.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    return (hashed % np.uint64(shards)).astype(np.int64)
+
+
+def _shard_init(descriptors: dict) -> None:
+    """
+    Service function, initializer of worker process: attach to shared lookup structures
+    """
+    keep = []
+    _SHARD['keep'] = keep
+    _SHARD['order'] = attach(descriptors['order'], keep)
+    _SHARD['irn8'] = _attach_column(descriptors['irn8'], keep)
+    _SHARD['krn8'] = _attach_column(descriptors['krn8'], keep)
+    _SHARD['imp'] = {'import7': _attach_index(descriptors['import7'], keep),
+                     'srn7': _attach_column(descriptors['srn7'], keep),
+                     'subst': _attach_index(descriptors['subst'], keep),
+                     'subst_rn7': _attach_column(descriptors['subst_rn7'], keep)}
+    _SHARD['soot7'] = {name: _attach_index(descriptors[name], keep) for name in ('pair', 'krn_null', 'irn')}
+    _SHARD['out'] = {name: attach(descriptors['out'][name], keep) for name in descriptors['out']}
+
+
+def _shard_resolve(start: int, end: int) -> int:
+    """
+    Service function, resolve_codes for rows of one shard in worker process, results are written
+    to shared output arrays at positions of rows (so merge doesn't depend on order of shards)
+    :param start: start of shard in shared row order (rows sorted by shard, see resolve_codes_sharded)
+    :param end: end of shard in shared row order
+    :return: number of rows in shard
+    """
+    irn8, out = _SHARD['irn8'], _SHARD['out']
+    rows = np.asarray(_SHARD['order'][start:end])
+    resolved = resolve_codes(irn8[rows], _SHARD['krn8'][rows], _SHARD['imp'], _SHARD['soot7'])
+
+    out['status'][rows] = resolved['status']
+    out['row7'][rows] = resolved['row7']
+    for name in ('rn7', 'invs_rn7'):
+        out[name][rows], out[name + '_mask'][rows] = key_column(resolved[name])
+    return len(rows)
+
+
+def resolve_codes_sharded(irn8, krn8, imp: dict, soot7: dict, workers: int) -> dict:
+    """
+    Same as resolve_codes, but rows are partitioned by IRN hash and resolved on process pool
+    Workers read indexes and InvSoot8 keys from shared memory (nothing is pickled but shard bounds),
+    every row result is written to its own position, so output is the same as of resolve_codes
+    :param irn8: InvSoot8 IRN column
+    :param krn8: InvSoot8 KRN column
+    :param imp: indexes of oracle tables (see build_import_indexes)
+    :param soot7: indexes of InvSoot7 (see build_soot7_indexes)
+    :param workers: number of worker processes
+    :return: dict with status, row7, rn7 and invs_rn7 columns
+    """
+    count = len(irn8)
+    # Several shards per worker, so one slow shard doesn't hold the whole pool
+    shards = workers * 4
+    # Rows are sorted by shard once, every worker takes only its range of that order
+    shard = shard_of(key_column(irn8)[0], shards)
+    order = np.argsort(shard, kind='stable')
+    bounds = np.searchsorted(shard[order], np.arange(shards + 1)).tolist()
+
+    shared = SharedArrays()
+    try:
+        descriptors = {'order': shared.share(order),
+                       'irn8': _share_column(shared, irn8),
+                       'krn8': _share_column(shared, krn8),
+                       'import7': _share_index(shared, imp['import7']),
+                       'srn7': _share_column(shared, imp['srn7']),
+                       'subst': _share_index(shared, imp['subst']),
+                       'subst_rn7': _share_column(shared, imp['subst_rn7']),
+                       'out': {'status': shared.empty(count, np.int8), 'row7': shared.empty(count, np.int64),
+                               'rn7': shared.empty(count, np.int64), 'rn7_mask': shared.empty(count, bool),
+                               'invs_rn7': shared.empty(count, np.int64),
+                               'invs_rn7_mask': shared.empty(count, bool)}}
+        for name in ('pair', 'krn_null', 'irn'):
+            descriptors[name] = _share_index(shared, soot7[name])
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_shard_init, initargs=(descriptors,)) as pool:
+            resolved_rows = sum(pool.map(_shard_resolve, bounds[:-1], bounds[1:]))
+        if resolved_rows != count:
+            raise RuntimeError(f'{resolved_rows} of {count} InvSoot8 rows were resolved by shards')
+
+        keep = []
+        out = {name: attach(descriptors['out'][name], keep).copy() for name in descriptors['out']}
+        del keep
+    finally:
+        shared.close()
+
+    return {'status': out['status'], 'row7': out['row7'],
+            'rn7': pd.arrays.IntegerArray(out['rn7'], out['rn7_mask']),
+            'invs_rn7': pd.arrays.IntegerArray(out['invs_rn7'], out['invs_rn7_mask'])}
+
+
+def assign_codes(status: np.ndarray, row7: np.ndarray, code: np.ndarray, soot7: dict, old_code,
+                 allocator: CodeAllocator, offset: int = 0) -> np.ndarray:
+    """
+    Choose new code for every InvSoot8 row: found InvSoot7 code, if it wasn't given to any previous row,
+    or free code from allocator (for rows without InvSoot7 code, see ST_FALLBACK)
+    Duplicates are found by code groups of InvSoot7 rows (see build_soot7_indexes): the first row keeps
+    the code, next rows get free codes or keep their old codes (by allocator.duplicates policy)
+    In streaming mode allocator keeps codes given to rows of previous chunks, offset is number of their rows
+    :param status: row statuses from resolve_codes, duplicates are marked in place
+    :param row7: InvSoot7 rows with codes (see resolve_codes)
+    :param code: found InvSoot7 codes
+    :param soot7: indexes of InvSoot7 (see build_soot7_indexes)
+    :param old_code: InvSoot8 CODE column
+    :param allocator: CodeAllocator object (conflicts are added to its report)
+    :param offset: number of InvSoot8 rows in previous chunks
+    :return: object array with new codes, None for rows that keep old code
+    """
+    new_code = np.full(len(status), None, dtype=object)
+
+    found = np.flatnonzero(status == ST_OK)
+    group = soot7['group'][row7[found]]
+    duplicated = allocator.give(group, offset + found)
+    status[found[duplicated]] = ST_DUPLICATE_NEW if allocator.duplicates == DUPLICATE_ALLOCATE else ST_DUPLICATE
+    new_code[found[~duplicated]] = code[found[~duplicated]]
+
+    generated = np.flatnonzero(np.isin(status, ST_FALLBACK))
+    new_code[generated] = allocator.take(len(generated))
+
+    rows = found[duplicated]
+    allocator.conflict('duplicate', offset + rows, code[rows], new_code[rows], allocator.first_row(group[duplicated]))
+
+    # Rows keeping old code, that is code of InvSoot7 (it may be given to other row)
+    kept = np.flatnonzero(~np.isin(status, (ST_OK,) + ST_FALLBACK))
+    kept_code = pd.Series(old_code).take(kept)
+    kept_group = soot7['code_index'].get_indexer(kept_code)
+    matched = kept_group >= 0
+    allocator.keep(offset + kept[matched], kept_group[matched], kept_code.to_numpy(dtype=object)[matched])
+    return new_code
+
+
+# Diagnostics category and message of every outcome
+ST_DIAGNOSTICS = {ST_OK: ('ok', 'ALL RIGHT'),
+                  ST_DUPLICATE: ('duplicate_code', 'code is already given to previous row'),
+                  ST_DUPLICATE_NEW: ('duplicate_code_new', 'code is already given to previous row, free code is given'),
+                  ST_KRN_NAN_NO_IMPORT7: ('krn_nan_no_import7', '(KRN is NAN) and (import7 not contains rn7)'),
+                  ST_KRN_NAN_NO_SOOT7: ('krn_nan_no_soot7',
+                                        '(MAX ERROR) :(KRN is NAN) and (invsoot7 not contains rn7)'),
+                  ST_KRN_NAN_KRN_SOOT7: ('krn_nan_krn_in_soot7', '(KRN is NAN) and (KRN is not NAN in invsoot7)'),
+                  ST_NO_IMPORT7: ('no_import7', '(KRN is not NAN) and (import7 not contains rn7)'),
+                  ST_NO_SUBST: ('subst_nomen_undefined', 'InvSUBST nomen is undefined'),
+                  ST_NO_CODE7: ('no_code7', '(KRN is not NAN) and (invsoot7 not contains rn7 with KRN)')}
+
+
+def report_outcomes(diagnostics: Diagnostics, db8: pd.DataFrame, resolved: dict,
+                    code: np.ndarray, new_code: np.ndarray) -> None:
+    """
+    Pass outcome of every InvSoot8 row to diagnostics sink, one batch per outcome category
+    :param diagnostics: Diagnostics object
+    :param db8: InvSoot8 table
+    :param resolved: output of resolve_codes (with duplicates marked by assign_codes)
+    :param code: found InvSoot7 codes
+    :param new_code: new codes (see assign_codes)
+    """
+    status = resolved['status']
+    for st, (category, message) in ST_DIAGNOSTICS.items():
+        rows = np.flatnonzero(status == st)
+        diagnostics.add_many(category, message, len(rows), error=st != ST_OK,
+                             IRN=db8['IRN'].array[rows], KRN=db8['KRN'].array[rows],
+                             RN7=resolved['rn7'][rows], INVS_RN7=resolved['invs_rn7'][rows],
+                             CODE7=code[rows], CODE=new_code[rows])
 
 
 def process(db7: pd.DataFrame,
             db8: pd.DataFrame,
             db_imp: pd.DataFrame,
-            invsubst: pd.DataFrame) -> pd.DataFrame:
+            invsubst: pd.DataFrame,
+            diagnostics: Diagnostics = None,
+            workers: int = 1,
+            imp: dict = None,
+            allocator: CodeAllocator = None) -> pd.DataFrame:
+    """
+    Replace codes of InvSoot8 with codes from InvSoot7
+    All rows are mapped at once through prebuilt indexes, see resolve_codes
+    :param db7: InvSoot7 table
+    :param db8: InvSoot8 table, column 'CODE' is changed in place
+    :param db_imp: import7 table
+    :param invsubst: udo_import7 table
+    :param diagnostics: Diagnostics sink for outcomes of rows (default: errors to log_proc.txt)
+    :param workers: resolve rows on N processes (see resolve_codes_sharded),
+                    duplicate check and generated codes are the same as of serial run
+    :param imp: indexes of oracle tables, if they are already built (see build_import_indexes)
+    :param allocator: CodeAllocator for generated codes and duplicates
+                      (default: codes of InvSoot7 and InvSoot8 are used, base 14641, free codes for duplicates)
+    :return: db8 with new codes
+    """
+    if allocator is None:
+        allocator = CodeAllocator(np.concatenate([code_values(db7['CODE']), code_values(db8['CODE'])]))
+    soot7 = build_soot7_indexes(db7)
+    if imp is None:
+        imp = build_import_indexes(db_imp, invsubst)
+    if workers > 1:
+        resolved = resolve_codes_sharded(db8['IRN'], db8['KRN'], imp, soot7, workers)
+    else:
+        resolved = resolve_codes(db8['IRN'], db8['KRN'], imp, soot7)
+
+    code = np.full(len(db8), None, dtype=object)
+    found = resolved['row7'] >= 0
+    code[found] = soot7['code'][resolved['row7'][found]]
+
+    new_code = assign_codes(resolved['status'], resolved['row7'], code, soot7, db8['CODE'], allocator)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+        report_outcomes(diagnostics, db8, resolved, code, new_code)
+        diagnostics.close()
+    else:
+        report_outcomes(diagnostics, db8, resolved, code, new_code)
+
+    changed = np.flatnonzero(np.isin(resolved['status'], (ST_OK,) + ST_FALLBACK))
+    codes = db8['CODE'].to_numpy(dtype=object, copy=True)
+    codes[changed] = new_code[changed]
+    db8['CODE'] = codes
+
+    return db8
+
+
+def key_hash(irn, krn) -> np.ndarray:
+    """
+    63-bit hash of (IRN, KRN) keys of InvSoot8 rows, null KRN differs from any KRN value
+    (the highest bit is free, repeated_keys marks deleted records with it)
+    :param irn: IRN column
+    :param krn: KRN column
+    :return: uint64 array
     """
+    irn_values, _ = key_column(irn)
+    krn_values, krn_null = key_column(krn)
+    hashed = irn_values.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    hashed ^= (krn_values.astype(np.uint64) + np.uint64(1)) * np.uint64(0xC2B2AE3D27D4EB4F)
+    hashed[krn_null] ^= np.uint64(0x165667B19E3779F9)
+    return hashed >> np.uint64(1)
 
-    :param invsubst:
-    :param db7:
-    :param db8:
-    :param db_imp:
+
+def dbf_code_values(path: str, chunk_size: int) -> np.ndarray:
+    """
+    Numeric values of codes of not deleted records of InvSoot.dbf (see code_alloc.code_values), read by chunks
+    :param path: path to InvSoot.dbf file
+    :param chunk_size: records in chunk
+    :return: sorted unique int64 array
     """
+    values = [code_values(chunk['CODE'][~mask])
+              for _, mask, chunk in read_dbf_chunks(path, chunk_size, DTYPE_SOOT, ['CODE'])]
+    return np.unique(np.concatenate(values or [np.array([], dtype=np.int64)]))
 
-    codes = set()
-    codes_list = dict()
 
-    max_code = 14641
-    i = 0
-    for rn8 in tqdm(db8.iterrows(), desc='Process database'):
-        i += 1
-        idx = list(rn8)[0]
+def repeated_keys(path: str, chunk_size: int, spill_dir: str = SPILL_DIR) -> np.ndarray:
+    """
+    Hashes of (IRN, KRN) keys, that are used by several records of InvSoot.dbf (deleted records included,
+    if key is used by not deleted record), see key_hash. Only keys are read, by chunks
+    Hashes are spilled to SPILL_BUCKETS temporary files by hash value, repeats are found file by file,
+    so memory is one chunk plus 8 / SPILL_BUCKETS bytes per record (and repeated keys found)
+    :param path: path to InvSoot.dbf file
+    :param chunk_size: records in chunk
+    :param spill_dir: folder for temporary files
+    :return: sorted uint64 array (may contain some unique keys with colliding hashes)
+    """
+    deleted_bit = np.uint64(1 << 63)
+    os.makedirs(spill_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        files = [open(os.path.join(tmp, f'{i}.bin'), 'wb') for i in range(SPILL_BUCKETS)]
+        try:
+            for _, mask, chunk in read_dbf_chunks(path, chunk_size, DTYPE_SOOT, ['IRN', 'KRN']):
+                present = np.asarray(chunk['IRN'].notna())
+                hashed = key_hash(chunk['IRN'], chunk['KRN'])[present]
+                bucket = hashed % np.uint64(SPILL_BUCKETS)
+                order = np.argsort(bucket, kind='stable')
+                bounds = np.searchsorted(bucket[order], np.arange(SPILL_BUCKETS + 1))
+                hashed = (hashed | np.where(mask[present], deleted_bit, np.uint64(0)))[order]
+                for i, f in enumerate(files):
+                    f.write(hashed[bounds[i]:bounds[i + 1]].tobytes())
+        finally:
+            for f in files:
+                f.close()
 
-        if pd.isna(rn8[1].KRN):
-            rn7 = list(db_imp.loc[db_imp['RN8'] == rn8[1].IRN]['SRN7'])
-            if len(rn7) == 0:
-                log_proc(['(KRN is NAN) and (import7 not contains rn7)', 'error', rn8[1].IRN, '\n'])
+        repeated = []
+        for i in range(SPILL_BUCKETS):
+            hashed = np.fromfile(os.path.join(tmp, f'{i}.bin'), dtype=np.uint64)
+            deleted = (hashed & deleted_bit) != 0
+            hashed &= ~deleted_bit
+            hashes, counts = np.unique(hashed[~deleted], return_counts=True)
+            repeated.append(np.union1d(hashes[counts > 1], np.intersect1d(hashes, hashed[deleted])))
+    return np.sort(np.concatenate(repeated))
 
-            else:
-                rn7 = rn7[0]
-                code = list(db7.loc[(db7['IRN'] == rn7) & (db7['KRN'].isnull())]['CODE'])
-                if len(code) == 0:
-                    tmp = db7.loc[(db7['IRN'] == rn7)]
-                    if len(list(tmp['CODE'])) == 0:
-                        codes_list[idx] = '000' + str(max_code + i)
-                        log_proc(['(MAX ERROR) :(KRN is NAN) and (invsoot7 not contains rn7)', rn8[1].IRN, '\n'])
-                    else:
-                        codes_list[idx] = '000' + str(max_code + i)
-                        log_proc(
-                            ['(KRN is NAN) and (KRN is not NAN in invsoot7)', 'error', rn8[1].IRN, '\n', tmp, '\n'])
+
+def stream_codes(source: str, target: str, db7: pd.DataFrame, db_imp: pd.DataFrame, invsubst: pd.DataFrame,
+                 chunk_size: int, diagnostics: Diagnostics, allocator: CodeAllocator = None, imp: dict = None) -> int:
+    """
+    Streaming version of process() and patch_codes(): InvSoot8 is read by chunks of records, every chunk is
+    mapped and its codes are written to copy of dbf file. Memory is one chunk, lookup indexes of InvSoot7 and
+    oracle tables, and state, that grows with InvSoot8: index of used codes (8 bytes per numeric code, see
+    dbf_code_values), key hashes of one spill file (see repeated_keys) and codes of repeated keys
+    (conflicts and rows keeping code of InvSoot7 are spilled by CodeAllocator)
+    Result is the same as of process() and patch_codes(): duplicate codes are tracked by InvSoot7 code groups,
+    generated codes are numbered through all chunks, and every record gets code of the first record
+    with its (IRN, KRN) key (such keys are found before, see repeated_keys)
+    :param source: path to InvSoot8 'InvSoot.dbf' file
+    :param target: path to result dbf file, written through temporary file and atomic rename
+    :param db7: InvSoot7 table
+    :param db_imp: import7 table
+    :param invsubst: udo_import7 table
+    :param chunk_size: InvSoot8 records in chunk
+    :param diagnostics: Diagnostics sink for outcomes of rows
+    :param allocator: CodeAllocator for generated codes and duplicates
+                      (default: codes of InvSoot7 and InvSoot8 are used, see process)
+    :param imp: indexes of oracle tables, if they are already built (see build_import_indexes)
+    :return: number of records without new code
+    """
+    if allocator is None:
+        allocator = CodeAllocator(np.concatenate([code_values(db7['CODE']), dbf_code_values(source, chunk_size)]),
+                                  spill_dir=SPILL_DIR)
+    soot7 = build_soot7_indexes(db7)
+    if imp is None:
+        imp = build_import_indexes(db_imp, invsubst)
+
+    repeated = repeated_keys(source, chunk_size)
+    first = {}      # (IRN, KRN) -> code of the first not deleted record, only for repeated keys
+    deferred = []   # deleted records before the first not deleted record with their key
+    offset = 0
+    written = 0
+    total = 0
+
+    with DbfPatcher(source, target) as patcher:
+        for start, deleted, chunk in tqdm(read_dbf_chunks(source, chunk_size, DTYPE_SOOT, ['IRN', 'KRN', 'CODE']),
+                                          desc='Streaming InvSoot8', unit=' chunks'):
+            live = np.flatnonzero(~deleted)
+            db8 = chunk.iloc[live].reset_index(drop=True)
+            resolved = resolve_codes(db8['IRN'], db8['KRN'], imp, soot7)
+
+            code = np.full(len(db8), None, dtype=object)
+            found = resolved['row7'] >= 0
+            code[found] = soot7['code'][resolved['row7'][found]]
+            new_code = assign_codes(resolved['status'], resolved['row7'], code, soot7, db8['CODE'], allocator, offset)
+            report_outcomes(diagnostics, db8, resolved, code, new_code)
+
+            changed = np.flatnonzero(np.isin(resolved['status'], (ST_OK,) + ST_FALLBACK))
+            result = db8['CODE'].to_numpy(dtype=object, copy=True)
+            result[changed] = new_code[changed]
+
+            # Record code, same as patch_codes: records with repeated key get code of the first one
+            codes = np.full(len(chunk), None, dtype=object)
+            codes[live] = result
+            matched = np.zeros(len(chunk), dtype=bool)
+            matched[live] = np.asarray(db8['IRN'].notna())
+            check = np.flatnonzero(np.isin(key_hash(chunk['IRN'], chunk['KRN']), repeated)
+                                   & np.asarray(chunk['IRN'].notna()))
+            for i, irn, krn in zip(check.tolist(), chunk['IRN'].take(check).tolist(),
+                                   chunk['KRN'].take(check).tolist()):
+                key = (irn, None if pd.isna(krn) else krn)
+                if key in first:
+                    codes[i] = first[key]
+                    matched[i] = True
+                elif not deleted[i]:
+                    first[key] = codes[i]
                 else:
-                    if code[0] in codes:
-                        log_proc(['err'])
-                    else:
-                        codes.add(code[0])
-                        codes_list[idx] = code[0]
-                        log_proc(['ALL RIGHT', rn8[1].IRN, ' --> ', rn7, ': ', code[0], '\n'])
-            pass
+                    deferred.append((start + i, key))
 
-        else:
-            rn7 = list(db_imp.loc[db_imp['RN8'] == rn8[1].IRN]['SRN7'])
-            if len(rn7) == 0:
-                log_proc(['(KRN is not NAN) and (import7 not contains rn7)', 'error', rn8[1].IRN, '\n'])
-                continue
-            else:
-                rn7 = rn7[0]
+            rows = np.flatnonzero(matched)
+            patcher.patch('CODE', start + rows, codes[rows])
+            written += len(rows)
+            total += len(chunk)
+            offset += len(live)
 
-            invs_rn7 = list(invsubst.loc[invsubst['RN8'] == rn8[1].KRN]['RN7'])
-            if len(invs_rn7) == 0:
-                codes_list[idx] = '000' + str(max_code + i)
-                log_proc(['InvSUBST nomen is undefined', 'error', rn8[1].IRN, rn8[1].KRN, 'Неизвестно', '\n'])
-                continue
+        deferred = [(record, first[key]) for record, key in deferred if key in first]
+        if deferred:
+            records, values = zip(*deferred)
+            patcher.patch('CODE', np.array(records), list(values))
+            written += len(deferred)
+
+    log(written, os.path.basename(target))
+    if total - written:
+        print(f'{total - written} records of {source} have no new code (left unchanged)')
+    return total - written
+
+
+def build_code_index(result_db: pd.DataFrame) -> dict:
+    """
+    Build (IRN, KRN) -> CODE index from process() output, KRN is None for NAN
+    If there are several rows with the same key, the first one is used
+    :param result_db: InvSoot8 table with new codes
+    :return: dict with codes
+    """
+    krn = [None if pd.isna(i) else i for i in result_db['KRN'].tolist()]
+    index = {}
+    for key, code in zip(zip(result_db['IRN'].tolist(), krn), result_db['CODE'].tolist()):
+        index.setdefault(key, code)
+    return index
+
+
+def write_codes(path: str, code_index: dict) -> int:
+    """
+    Write new codes to dbf file, record is found in code_index by its IRN and KRN
+    :param path: path to dbf file (changed in place)
+    :param code_index: (IRN, KRN) -> CODE index, see build_code_index
+    :return: number of records without new code
+    """
+    import dbf      # legacy writer, imported only when used
+
+    written = 0
+    missed = 0
+
+    db8 = dbf.Table(path)
+    db8.open(mode=dbf.READ_WRITE)
+    for row in tqdm(db8, desc='Writing to dbf'):
+        irn = int(row.IRN)
+        krn = None if row.KRN is None or str(row.KRN).strip() == '' else int(row.KRN)
+        key = (irn, krn)
+        if key not in code_index:
+            missed += 1
+            continue
+        new_code = code_index[key]
+        with row:
+            row.CODE = ('' if pd.isna(new_code) else new_code) + ' ' * 12
+        written += 1
+    db8.close()
+
+    log(written, os.path.basename(path))
+    if missed:
+        print(f'{missed} records of {path} have no new code (left unchanged)')
+    return missed
+
+
+def patch_codes(source: str, target: str, result_db: pd.DataFrame) -> int:
+    """
+    Write new codes to copy of dbf file, only CODE bytes of records are changed (see dbf_mmap.patch_field)
+    Record is found in result_db by its IRN and KRN, same as in write_codes (first row with key is used)
+    :param source: path to InvSoot.dbf file
+    :param target: path to result dbf file, written through temporary file and atomic rename
+    :param result_db: InvSoot8 table with new codes
+    :return: number of records without new code
+    """
+    keys = read_dbf_frame(source, dtype=DTYPE_SOOT, columns=['IRN', 'KRN'], deleted=True)
+
+    irn = pd.array(result_db['IRN'], dtype=pd.Int64Dtype())
+    irn_krn_null = irn.copy()
+    irn_krn_null[np.asarray(result_db['KRN'].notna())] = pd.NA
+    krn_nan = np.asarray(keys['KRN'].isna())
+    row = np.where(krn_nan,
+                   key_lookup(build_key_index(irn_krn_null), keys['IRN']),
+                   key_lookup(build_key_index(irn, result_db['KRN']), keys['IRN'], keys['KRN']))
+
+    patched = np.flatnonzero(row >= 0)
+    patch_field(source, target, 'CODE', patched, result_db['CODE'].to_numpy(dtype=object)[row[patched]])
+
+    missed = len(row) - len(patched)
+    log(len(patched), os.path.basename(target))
+    if missed:
+        print(f'{missed} records of {source} have no new code (left unchanged)')
+    return missed
+
+
+def extract(params: dict, args, names: tuple = ('InvSoot7', 'InvSoot8', 'import7', 'udo_import7'),
+            site: str = None) -> tuple:
+    """
+    Run extract stages: 'InvSoot.dbf' files 7 and 8, tables import7 and udo_import7
+    Stages don't depend on each other, with args.workers > 1 they run concurrently on thread pool
+    (every database stage takes its own connection from pool)
+    Unchanged sources are loaded from snapshots of previous run (if args.cache is set), see snapshot.cached
+    :param params: dict with params (see session_params)
+    :param args: command line arguments (arraysize, workers, cache, cache_size, csv)
+    :param names: sources to extract
+    :param site: site name of batch run: snapshots, stages and csv files of dbf sources are named
+                 '<source>.<site>', snapshot folder isn't trimmed (see run_batch)
+    :return: tables in order of names, by default (db_invsoot7, db_invsoot8, db_import7, db_invsubst)
+    """
+    def from_dbf(name, path):
+        if site is not None:
+            name = f'{name}.{site}'
+        with instrument.stage(f'extract {name}') as record:
+            if not args.cache:
+                db = dataframe_from_dbf(path, name + '.dbf')
             else:
-                invs_rn7 = invs_rn7[0]
+                db = cached(name, dbf_fingerprint(path + '\\InvSoot.dbf'),
+                            lambda: dataframe_from_dbf(path, name + '.dbf'))
+            record.rows = len(db)
+        return db
 
-            code7 = list(db7.loc[(db7['IRN'] == rn7) & (db7['KRN'] == invs_rn7)]['CODE'])[0]
-            if code7 in codes:
-                log_proc(['error'])
+    def from_database(name, fetch, fingerprint_sql):
+        with instrument.stage(f'extract {name}') as record, ora_session.connection(params) as connection:
+            if not args.cache:
+                db = fetch(connection, args.arraysize)
             else:
-                codes.add(code7)
-                codes_list[idx] = code7
-                log_proc(['ALL RIGHT', rn8[1].IRN, rn8[1].KRN, ' --> ', rn7, invs_rn7, ' --> ', code7, '\n'])
+                db = cached(name, table_fingerprint(connection, fingerprint_sql),
+                            lambda: fetch(connection, args.arraysize))
+            record.rows = len(db)
+        return db
 
-        pass
+    stages = {'InvSoot7': lambda: from_dbf('InvSoot7', params['dbf7']),
+              'InvSoot8': lambda: from_dbf('InvSoot8', params['dbf8']),
+              'import7': lambda: from_database('import7', fetch_import7, IMPORT7_FINGERPRINT_SQL),
+              'udo_import7': lambda: from_database('udo_import7', fetch_udo_import7, UDO_IMPORT7_FINGERPRINT_SQL)}
+    stages = {name: stages[name] for name in names}
 
-    for key, value in tqdm(codes_list.items(), desc='Changing codes'):
-        db8.loc[key, 'CODE'] = value
+    if args.workers <= 1:
+        result = tuple(stage() for stage in stages.values())
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(stage): name for name, stage in stages.items()}
+            with tqdm(total=len(futures), desc='Extract stages') as bar:
+                for future in as_completed(futures):
+                    future.result()
+                    bar.set_postfix_str(f'{futures[future]} done')
+                    bar.update()
+            result = tuple(future.result() for future in futures)
+
+    if args.cache and site is None:
+        evict(args.cache_size * 1024 ** 2)
+    if args.csv:
+        for name, db in zip(names, result):
+            export_csv(db, '..\\.temp_files\\' + (name if site is None else f'{name}.{site}'), SCHEMAS[name])
+    return result
+
+
+def site_log(path: str, site: str) -> str:
+    """
+    Service function, per-site name of log file: log_proc.txt -> log_proc_<site>.txt
+    :param path: log file path (None - no file)
+    :param site: site name
+    :return: path
+    """
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path)
+    return f'{root}_{site}{ext}'
 
-    return db8
+
+def run_site(site: Site, params: dict, args, db_import7: pd.DataFrame, db_invsubst: pd.DataFrame,
+             imp: dict) -> dict:
+    """
+    Map codes of one site of batch run: extract its dbf files, map InvSoot8 with shared oracle tables
+    and their indexes, write result to site.output. Outcomes of rows go to log_proc_<site>.txt,
+    code conflicts to code_conflicts_<site>.csv
+    :param site: Site object
+    :param params: dict with params (see session_params)
+    :param args: command line arguments
+    :param db_import7: import7 table
+    :param db_invsubst: udo_import7 table
+    :param imp: indexes of oracle tables (see build_import_indexes)
+    :return: status of site (see run_batch)
+    """
+    started = time.perf_counter()
+    status = {'site': site.name, 'status': 'failed', 'output': site.output, 'rows': None, 'missed': None,
+              'outcomes': {}, 'conflicts': None, 'wall': None, 'error': None}
+    site_params = dict(params, dbf7=site.dbf7, dbf8=site.dbf8)
+    diagnostics = Diagnostics(path=site_log(LOG_PROC, site.name), jsonl=site_log(args.log_jsonl, site.name),
+                              verbosity=args.verbosity)
+    try:
+        os.makedirs(os.path.dirname(site.output) or '.', exist_ok=True)
+        source = site.dbf8 + '\\InvSoot.dbf'
+        if args.stream:
+            db_invsoot7, = extract(site_params, args, ('InvSoot7',), site.name)
+            with instrument.stage(f'stream {site.name}') as record:
+                allocator = code_allocator(args, db_invsoot7, source=source)
+                status['missed'] = stream_codes(source, site.output, db_invsoot7, db_import7, db_invsubst,
+                                                stream_chunk_size(args), diagnostics, allocator, imp)
+                status['rows'] = sum(diagnostics.counters.values())
+                record.rows = status['rows']
+        else:
+            db_invsoot7, db_invsoot8 = extract(site_params, args, ('InvSoot7', 'InvSoot8'), site.name)
+            with instrument.stage(f'process {site.name}', len(db_invsoot8)):
+                allocator = code_allocator(args, db_invsoot7, db_invsoot8)
+                result_db = process(db_invsoot7, db_invsoot8, db_import7, db_invsubst, diagnostics,
+                                    args.map_workers, imp, allocator)
+            with instrument.stage(f'write_back {site.name}', len(result_db)):
+                status['missed'] = patch_codes(source, site.output, result_db)
+            status['rows'] = len(result_db)
+        diagnostics.close()
+        status['conflicts'] = allocator.write_report(site_log(args.conflicts, site.name))
+        allocator.close()
+        status['status'] = 'ok'
+    except Exception as e:
+        diagnostics.close()
+        status['error'] = f'{type(e).__name__}: {e}'
+    status['outcomes'] = dict(diagnostics.counters)
+    status['wall'] = round(time.perf_counter() - started, 4)
+    return status
+
+
+def run_batch(params: dict, args) -> list:
+    """
+    Batch run for many sites of manifest (see read_manifest): oracle tables are extracted and indexed once,
+    sites are mapped concurrently on args.site_workers threads (see run_site). Failed site doesn't stop
+    the others, statuses of all sites are written to args.summary
+    :param params: dict with params (see session_params)
+    :param args: command line arguments
+    :return: list of site statuses
+    """
+    sites = read_manifest(args.manifest)
+    db_import7, db_invsubst = extract(params, args, ('import7', 'udo_import7'))
+    with instrument.stage('import indexes', len(db_import7) + len(db_invsubst)):
+        imp = build_import_indexes(db_import7, db_invsubst)
+
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=max(args.site_workers, 1)) as pool:
+        futures = {pool.submit(run_site, site, params, args, db_import7, db_invsubst, imp): site.name
+                   for site in sites}
+        with tqdm(total=len(futures), desc='Sites') as bar:
+            for future in as_completed(futures):
+                statuses[futures[future]] = future.result()
+                bar.set_postfix_str(f'{futures[future]} {statuses[futures[future]]["status"]}')
+                bar.update()
+    statuses = [statuses[site.name] for site in sites]
+
+    if args.cache:
+        evict(args.cache_size * 1024 ** 2)
+    with open(args.summary, 'w', encoding='UTF-8') as f:
+        json.dump(statuses, f, indent=1)
+    for status in statuses:
+        outcomes = ', '.join(f'{key}: {value}' for key, value in sorted(status['outcomes'].items()))
+        print(f'{status["site"]}: {status["status"]}, {status["rows"]} rows, {status["missed"]} records '
+              f'without new code, {outcomes or status["error"]}')
+    return statuses
+
+
+def code_allocator(args, db7: pd.DataFrame, db8: pd.DataFrame = None, source: str = None) -> CodeAllocator:
+    """
+    Service function, CodeAllocator with options from command line (max_code, duplicates) over codes of InvSoot7
+    and InvSoot8 (from table db8 or read from dbf file source by chunks)
+    """
+    used8 = code_values(db8['CODE']) if db8 is not None else dbf_code_values(source, stream_chunk_size(args))
+    return CodeAllocator(np.concatenate([code_values(db7['CODE']), used8]), args.max_code, args.duplicates,
+                         SPILL_DIR)
+
+
+def stream_chunk_size(args) -> int:
+    """
+    Service function, InvSoot8 records in chunk of streaming mode (from --max-memory, if it's set)
+    """
+    if args.max_memory:
+        return max(args.max_memory * 1024 ** 2 // STREAM_ROW_BYTES, 1000)
+    return args.chunk_size
 
 
 def main(args) -> int:
     """
     Main function, call everything else
     :param args: input path to pars.txt
-    :return: none
+    :return: exit status (1 if any site of batch run failed)
     """
     # Reading input parameters
     PARAMS_PATH = args.path
-    params = read_params(PARAMS_PATH)
+    params = session_params(read_params(PARAMS_PATH), args)
+    instrument.configure(profile=args.profile, trace_malloc=args.trace_malloc)
+
+    if args.invalidate_cache:
+        invalidate()
+
+    if args.verify_codec:
+        with ora_session.connection(params) as connection:
+            print(f'rn7_codec is the same as database conversion on {verify_codec(connection)} rows')
+
+    if args.manifest:
+        # Many pairs of dbf folders with the same oracle tables
+        statuses = run_batch(params, args)
+        ora_session.close_pool()
+        instrument.write_report(args.report, 'arb_shtrih')
+        # Statuses of sites are in summary file, exit status is only 0 or 1
+        return 1 if any(i['status'] != 'ok' for i in statuses) else 0
 
-    # Reading data from dbf files
-    # More specific: files 'InvSoot.dbf' and 'SinBase.dbf'
-    read_dbf(params['dbf7'], params['dbf8'])
+    if args.stream:
+        # Only lookup tables are extracted, InvSoot8 is mapped and written by chunks
+        db_invsoot7, db_import7, db_invsubst = extract(params, args, ('InvSoot7', 'import7', 'udo_import7'))
+        chunk_size = stream_chunk_size(args)
 
-    # Create pd.DataFrame objects from read dbf's
-    db_invsoot7 = dataframe_from_csv('..\\.temp_files\\InvSoot7.csv', tp='soot')
-    db_invsoot8 = dataframe_from_csv('..\\.temp_files\\InvSoot8.csv', tp='soot')
+        diagnostics = Diagnostics(jsonl=args.log_jsonl, verbosity=args.verbosity, background=True)
+        with instrument.stage('stream'):
+            allocator = code_allocator(args, db_invsoot7, source=params['dbf8'] + '\\InvSoot.dbf')
+            stream_codes(params['dbf8'] + '\\InvSoot.dbf', '..\\.result\\NEW_InvSoot.dbf',
+                         db_invsoot7, db_import7, db_invsubst, chunk_size, diagnostics, allocator)
+            diagnostics.close()
+        allocator.write_report(args.conflicts)
+        print(f'Outcomes: {diagnostics.summary()}')
+        print(f'Codes: {allocator.summary()}')
+        allocator.close()
 
-    # Reading table import7 and udo_import7 (contains table7 'INSOST') from oracle database
-    oracle_conn(params['cli'], params['host'], params['service'], params['authid'], params['password'])
+        ora_session.close_pool()
+        instrument.write_report(args.report, 'arb_shtrih')
+        return 0
 
-    # Convert those tables to pd.DataFrame objects
-    db_import7 = dataframe_from_csv('..\\.temp_files\\import7.csv', tp='imp')
-    db_invsubst = pd.read_csv('..\\.temp_files\\udo_import7.csv', delimiter='@',
-                              dtype={'RN7': pd.Int64Dtype(), 'RN8': pd.Int64Dtype()})
+    # Create pd.DataFrame objects straight from 'InvSoot.dbf' files and
+    # tables import7 and udo_import7 (contains table7 'INSOST') from oracle database
+    # (or from local sqlite db with the same tables)
+    db_invsoot7, db_invsoot8, db_import7, db_invsubst = extract(params, args)
 
     # Main process function
     # Replace codes from main 'InvSoot.dbf' file with codes from 'InvSoot.dbf' by Parus-7
-    result_db = process(db_invsoot7, db_invsoot8, db_import7, db_invsubst)
+    diagnostics = Diagnostics(jsonl=args.log_jsonl, verbosity=args.verbosity, background=True)
+    with instrument.stage('process', len(db_invsoot8)):
+        allocator = code_allocator(args, db_invsoot7, db_invsoot8)
+        result_db = process(db_invsoot7, db_invsoot8, db_import7, db_invsubst, diagnostics, args.map_workers,
+                            allocator=allocator)
+        diagnostics.close()
+    allocator.write_report(args.conflicts)
+    print(f'Outcomes: {diagnostics.summary()}')
+    print(f'Codes: {allocator.summary()}')
+    allocator.close()
 
-    shutil.copyfile(params['dbf8'] + '\\InvSoot.dbf', '..\\.temp_files\\result.dbf')
-
-    # Write data to existing 'InvSoot.dbf' file new codes
-    db8 = dbf.Table('..\\.temp_files\\result.dbf')
-    print(db8.field_names)
-    db8.open(mode=dbf.READ_WRITE)
-    for row in tqdm(db8, desc='Writing to dbf'):
-        irn = int(row.IRN)
-        krn = None if str(row.KRN).strip() == '' else int(row.KRN)
-        if pd.isna(krn):
-            new_code = list(result_db.loc[(result_db['IRN'] == irn) & result_db['KRN'].isnull()]['CODE'])
-        else:
-            new_code = list(
-                result_db.loc[(result_db['IRN'] == irn) & (result_db['KRN'] == krn)][
-                    'CODE'])
-        with row:
-            row.CODE = new_code[0] + ' ' * 12
-    db8.close()
+    # Write new codes to copy of 'InvSoot.dbf' file
+    with instrument.stage('write_back', len(result_db)):
+        patch_codes(params['dbf8'] + '\\InvSoot.dbf', '..\\.result\\NEW_InvSoot.dbf', result_db)
 
-    shutil.copyfile('..\\.temp_files\\result.dbf', '..\\.result\\NEW_InvSoot.dbf')
+    if args.verify_writer:
+        # Same file written by dbf library, record by record
+        shutil.copyfile(params['dbf8'] + '\\InvSoot.dbf', '..\\.temp_files\\result.dbf')
+        write_codes('..\\.temp_files\\result.dbf', build_code_index(result_db))
+        if not filecmp.cmp('..\\.temp_files\\result.dbf', '..\\.result\\NEW_InvSoot.dbf', shallow=False):
+            raise RuntimeError('NEW_InvSoot.dbf differs from file written by dbf library')
+        print('NEW_InvSoot.dbf is the same as file written by dbf library')
 
+    ora_session.close_pool()
+    instrument.write_report(args.report, 'arb_shtrih')
     return 0
 
 
@@ -366,5 +1186,63 @@ if __name__ == '__main__':
                                    'DBF\'s files')
     parser.add_argument('--path', type=dir_path, default='./pars.txt', required=False,
                         help='Path to *.txt file with all neaded parameters\n (See example.txt)')
+    parser.add_argument('--sqlite', type=dir_path, default=None, required=False,
+                        help='Path to sqlite db with tables import7 and udo_import7, used instead of oracle db')
+    parser.add_argument('--arraysize', type=int, default=50000, required=False,
+                        help='Rows fetched from database in one round-trip')
+    parser.add_argument('--workers', type=int, default=1, required=False,
+                        help='Run extract stages (dbf files and database tables) concurrently on N threads')
+    parser.add_argument('--map-workers', type=int, default=1, required=False,
+                        help='Map InvSoot8 rows on N processes (rows are partitioned by IRN hash)')
+    parser.add_argument('--manifest', type=dir_path, default=None, required=False,
+                        help='Batch run: csv file with columns site,dbf7,dbf8[,output], one line per pair of dbf '
+                             'folders (dbf folders of pars.txt are not used)')
+    parser.add_argument('--site-workers', type=int, default=2, required=False,
+                        help='Batch run: map N sites concurrently')
+    parser.add_argument('--summary', type=str, default='..\\.log_files\\batch_summary.json', required=False,
+                        help='Batch run: JSON file with status, rows and outcomes of every site')
+    parser.add_argument('--stream', action='store_true',
+                        help='Map InvSoot8 by chunks of records straight to NEW_InvSoot.dbf (bounded memory)')
+    parser.add_argument('--chunk-size', type=int, default=200000, required=False,
+                        help='InvSoot8 records in one chunk of streaming mode')
+    parser.add_argument('--max-memory', type=int, default=None, required=False,
+                        help='Working memory of one chunk of streaming mode, MB (sets chunk size). '
+                             'Besides chunk, lookup indexes and the index of used codes (8 bytes per code '
+                             'of InvSoot8) are kept, repeated keys of InvSoot8 are found through temporary files')
+    parser.add_argument('--max-code', type=int, default=14641, required=False,
+                        help='Generated codes are \'000\' + number, numbers start after max code '
+                             '(codes used in InvSoot7 and InvSoot8 are skipped)')
+    parser.add_argument('--duplicates', choices=[DUPLICATE_ALLOCATE, DUPLICATE_KEEP], default=DUPLICATE_ALLOCATE,
+                        required=False,
+                        help='InvSoot7 code found for several rows: the first row gets it, next rows get free codes '
+                             '(allocate) or keep old codes (keep)')
+    parser.add_argument('--conflicts', type=str, default=CONFLICTS, required=False,
+                        help='Csv report of code conflicts (duplicates and kept codes given to other rows)')
+    parser.add_argument('--csv', action='store_true',
+                        help='Also write extracted tables to csv files in ..\\.temp_files (for debugging)')
+    parser.add_argument('--thin', action='store_true',
+                        help='Connect to oracle db in thin mode (without Oracle_instantClient)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Always extract dbf files and database tables, don\'t use snapshots of previous runs')
+    parser.add_argument('--invalidate-cache', action='store_true',
+                        help='Remove all snapshots before run')
+    parser.add_argument('--cache-size', type=int, default=2048, required=False,
+                        help='Max size of snapshot folder, MB (the least recently used snapshots are removed)')
+    parser.add_argument('--verify-writer', action='store_true',
+                        help='Also write result with dbf library and check that files are byte-for-byte equal')
+    parser.add_argument('--verify-codec', action='store_true',
+                        help='Check client-side RN7 -> shtrih code conversion against the same conversion in database')
+    parser.add_argument('--verbosity', type=int, choices=[VERBOSITY_SUMMARY, VERBOSITY_ERRORS, VERBOSITY_ALL],
+                        default=VERBOSITY_ERRORS, required=False,
+                        help='log_proc.txt details: 0 - only counters, 1 - errors, 2 - errors and successful matches')
+    parser.add_argument('--log-jsonl', type=str, default=None, required=False,
+                        help='Also write outcomes of rows to JSON Lines file')
+    parser.add_argument('--report', type=str, default='..\\.log_files\\report_arb_shtrih.json', required=False,
+                        help='JSON report of run: wall and CPU time, rows, rows/sec and peak memory of every stage')
+    parser.add_argument('--profile', type=str, default=None, required=False,
+                        help='Run one stage under cProfile (stage name from report, e.g. process), '
+                             'dump is written to ..\\.log_files\\<stage>.prof')
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help='Record python memory high-water mark of stages (tracemalloc, slows down run)')
     args = parser.parse_args()
-    main(args)
+    raise SystemExit(main(args))
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import struct
+import sqlite3
+import datetime
+import subprocess
+from argparse import ArgumentParser
+
+import numpy as np
+
+import arb_shtrih
+import invs_test
+from diagnostics import Diagnostics
+
+
+# Synthetic data: RN7 is 4 chars from '0' to 'z', as in Parus-7
+RN7_FIRST = 48
+RN7_CHARS = 75
+RN8_BASE = 10 ** 9
+NOMEN_COUNT = 500
+
+SOOT_FIELDS = [('IRN', 'C', 17), ('KRN', 'C', 17), ('SRN', 'N', 10), ('CODE', 'C', 13), ('NAME', 'C', 20)]
+
+RESULTS_PATH = 'bench_results.json'
+
+
+def rn7_strings(numbers: np.ndarray) -> np.ndarray:
+    """
+    Service function, make RN7 (4 chars) from numbers 0 .. RN7_CHARS ** 4 - 1
+    :param numbers: int array
+    :return: array of dtype 'S4'
+    """
+    chars = np.stack([RN7_FIRST + numbers // RN7_CHARS ** (3 - i) % RN7_CHARS for i in range(4)], axis=1)
+    return chars.astype(np.uint8).view('S4').ravel()
+
+
+def rn7_shtrih(numbers: np.ndarray) -> np.ndarray:
+    """
+    Service function, shtrih value of RN7 (3 digits of ASCII code for every char, see convert7)
+    :param numbers: int array
+    :return: int64 array
+    """
+    value = np.zeros(len(numbers), dtype=np.int64)
+    for i in range(4):
+        value = value * 1000 + RN7_FIRST + numbers // RN7_CHARS ** (3 - i) % RN7_CHARS
+    return value
+
+
+def write_dbf(path: str, fields: list, columns: list, encoding_id: int = 101, chunk: int = 1000000) -> None:
+    """
+    Write dbf file (dBase III) from fixed-width columns, by chunks of records
+    :param path: path to dbf file
+    :param fields: list of (name, type, length), C fields are left-justified, N fields right-justified
+    :param columns: list of bytes arrays, one for every field
+    :param encoding_id: code page byte of header (101 - cp866)
+    :param chunk: records written at once
+    """
+    count = len(columns[0])
+    record_length = 1 + sum(length for _, _, length in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    today = datetime.date.today()
+
+    header = bytearray(struct.pack('<4BIHH', 3, today.year - 1900, today.month, today.day,
+                                   count, header_length, record_length))
+    header += bytes(17) + bytes([encoding_id]) + bytes(2)
+    offset = 1     # the first byte of record is deletion flag
+    for name, kind, length in fields:
+        header += name.encode('ascii').ljust(11, b'\x00') + kind.encode('ascii') + struct.pack('<I', offset)
+        header += bytes([length, 0]) + bytes(14)
+        offset += length
+    header += b'\x0D'
+
+    with open(path, 'wb') as f:
+        f.write(header)
+        for start in range(0, count, chunk):
+            block = []
+            for (name, kind, length), column in zip(fields, columns):
+                values = column[start:start + chunk]
+                values = np.char.rjust(values, length) if kind == 'N' else np.char.ljust(values, length)
+                block.append(values.astype(f'S{length}').view(np.uint8).reshape(-1, length))
+            records = np.hstack([np.full((len(block[0]), 1), ord(' '), dtype=np.uint8)] + block)
+            f.write(records.tobytes())
+        f.write(b'\x1A')
+
+
+def generate(folder: str, rows: int, seed: int = 0, null_krn: float = 0.5, missing_import7: float = 0.03,
+             missing_subst: float = 0.05, duplicate_codes: float = 0.01) -> dict:
+    """
+    Generate synthetic InvSoot.dbf files 7 and 8 and sqlite db with tables
+    import7, udo_import7, INVSUBST, P7_INSOST and UDO_T_IMPORT7
+    :param folder: output folder
+    :param rows: records in every InvSoot.dbf
+    :param seed: random seed
+    :param null_krn: fraction of records with null KRN
+    :param missing_import7: fraction of inventory without import7 link
+    :param missing_subst: fraction of substitutes without udo_import7 link
+    :param duplicate_codes: fraction of InvSoot7 records with code of another record
+    :return: dict with paths (dbf7, dbf8, sqlite, pars)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(folder, 'D7'), exist_ok=True)
+    os.makedirs(os.path.join(folder, 'D8'), exist_ok=True)
+
+    # Inventory (INBASE), substitutes (INSOST) and nomenclature (NOBASE) of Parus-7 with unique RN7
+    subst_count = max(rows // 4, 100)
+    numbers = rng.choice(RN7_CHARS ** 4, rows + subst_count + NOMEN_COUNT, replace=False)
+    inbase, insost, nobase = np.split(numbers, [rows, rows + subst_count])
+    rn8 = RN8_BASE + np.arange(rows)
+    krn8 = 2 * RN8_BASE + np.arange(subst_count)
+    nomen8 = 3 * RN8_BASE + np.arange(NOMEN_COUNT)
+
+    # Every record is inventory itself (null KRN) or one of its substitutes
+    has_krn = rng.random(rows) >= null_krn
+    subst = rng.integers(0, subst_count, rows)
+    codes = rng.choice(10 ** 12, rows, replace=False)
+    duplicated = np.flatnonzero(rng.random(rows) < duplicate_codes)
+    codes[duplicated] = codes[rng.integers(0, rows, len(duplicated))]
+
+    empty = np.full(rows, b'', dtype='S1')
+    name = np.where(has_krn, b'sost', b'inv')
+    irn7 = (rn7_shtrih(inbase) % 10 ** 11).astype('S17')
+    krn7 = np.where(has_krn, rn7_shtrih(insost)[subst].astype('S17'), empty)
+    write_dbf(os.path.join(folder, 'D7') + '\\InvSoot.dbf', SOOT_FIELDS,
+              [irn7, krn7, np.arange(rows).astype('S10'), np.char.zfill(codes.astype('S13'), 13), name])
+    write_dbf(os.path.join(folder, 'D8') + '\\InvSoot.dbf', SOOT_FIELDS,
+              [rn8.astype('S17'), np.where(has_krn, krn8[subst].astype('S17'), empty),
+               np.arange(rows).astype('S10'), empty, name])
+
+    path = os.path.join(folder, 'bench.db')
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        'create table import7 (table7 text, rn7 text, rn8 integer);'
+        'create table udo_import7 (table7 text, rn7 text, rn8 integer);'
+        'create table INVSUBST (RN integer, PRN integer, NOMENCLATURE integer);'
+        'create table P7_INSOST (RN text, MASTER_RN text, RN_PRNOM text);'
+        'create table UDO_T_IMPORT7 (table7 text, rn7 text, rn8 integer);'
+    )
+
+    linked = rng.random(rows) >= missing_import7
+    connection.executemany('insert into import7 values (\'INBASE\', ?, ?)',
+                           zip(np.char.decode(rn7_strings(inbase[linked]), 'ascii').tolist(), rn8[linked].tolist()))
+    connection.executemany('insert into import7 values (\'NOBASE\', ?, ?)',
+                           zip(np.char.decode(rn7_strings(nobase), 'ascii').tolist(), nomen8.tolist()))
+    linked = rng.random(subst_count) >= missing_subst
+    connection.executemany('insert into udo_import7 values (\' INSOST \', ?, ?)',
+                           zip(np.char.decode(rn7_strings(insost[linked]), 'ascii').tolist(), krn8[linked].tolist()))
+
+    # Substitutes belong to some inventory and have some nomenclature
+    owner = rng.integers(0, rows, subst_count)
+    nomen = rng.integers(0, NOMEN_COUNT, subst_count)
+    connection.executemany('insert into INVSUBST values (?, ?, ?)',
+                           zip(krn8.tolist(), rn8[owner].tolist(), nomen8[nomen].tolist()))
+    connection.executemany('insert into P7_INSOST values (?, ?, ?)',
+                           zip(np.char.decode(rn7_strings(insost), 'ascii').tolist(),
+                               np.char.decode(rn7_strings(inbase[owner]), 'ascii').tolist(),
+                               np.char.decode(rn7_strings(nobase[nomen]), 'ascii').tolist()))
+    connection.commit()
+    connection.close()
+
+    pars = os.path.join(folder, 'pars.txt')
+    with open(pars, 'w', encoding='UTF-8') as f:
+        f.write('ORACLE_CONNECTION***\n- cli\n- host\n- service\nmain - user\n- password\n***\n'
+                f'DDBF_files\n{os.path.join(folder, "D7")} - p7\n{os.path.join(folder, "D8")} - p8\n')
+
+    return {'dbf7': os.path.join(folder, 'D7'), 'dbf8': os.path.join(folder, 'D8'), 'sqlite': path, 'pars': pars}
+
+
+def timed(stages: dict, name: str, function, *args, **kwargs):
+    """
+    Service function, call function and store its wall time in stages
+    :param stages: stage name -> seconds
+    :param name: stage name
+    :param function: stage function
+    :return: result of function
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def run_stages(paths: dict, arraysize: int = 50000, batch_size: int = 10000) -> dict:
+    """
+    Run stages of arb_shtrih.main() and invs_test.main() one by one on generated data
+    Must be called from work folder: scripts write to '..\\.temp_files', '..\\.log_files' and '..\\.result'
+    :param paths: output of generate
+    :param arraysize: rows fetched from database in one round-trip
+    :param batch_size: rows inserted to UDO_T_IMPORT7 by one statement
+    :return: stage name -> seconds
+    """
+    params = arb_shtrih.read_params(paths['pars'])
+    params['sqlite'] = paths['sqlite']
+    stages = {}
+
+    def dataframe_from_dbf():
+        return (arb_shtrih.dataframe_from_dbf(params['dbf7'], 'InvSoot7.dbf'),
+                arb_shtrih.dataframe_from_dbf(params['dbf8'], 'InvSoot8.dbf'))
+
+    def oracle_conn():
+        with arb_shtrih.ora_session.connection(params) as connection:
+            return (arb_shtrih.fetch_import7(connection, arraysize),
+                    arb_shtrih.fetch_udo_import7(connection, arraysize))
+
+    def process():
+        diagnostics = Diagnostics()
+        result = arb_shtrih.process(db7, db8, db_imp, invsubst, diagnostics)
+        diagnostics.close()
+        return result
+
+    db7, db8 = timed(stages, 'dataframe_from_dbf', dataframe_from_dbf)
+    db_imp, invsubst = timed(stages, 'oracle_conn', oracle_conn)
+    result_db = timed(stages, 'process', process)
+    timed(stages, 'write_back', arb_shtrih.patch_codes,
+          params['dbf8'] + '\\InvSoot.dbf', '..\\.result\\NEW_InvSoot.dbf', result_db)
+
+    timed(stages, 'oracle_imp', invs_test.oracle_imp, params)
+    timed(stages, 'oracle_insert', invs_test.oracle_insert, params, batch_size=batch_size)
+    timed(stages, 'oracle_pushdown', invs_test.oracle_pushdown, params)
+    return stages
+
+
+def version() -> str:
+    """
+    Service function, current git commit (to compare results of different versions)
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def compare(previous: dict, current: dict) -> None:
+    """
+    Print stage times of current run against previous run with the same rows
+    :param previous: stored result
+    :param current: new result
+    """
+    print(f'{current["rows"]} rows: {previous["version"]} -> {current["version"]}')
+    for name, seconds in current['stages'].items():
+        before = previous['stages'].get(name)
+        ratio = f'{seconds / before:6.2f}x' if before else '     -'
+        print(f'  {name:<15}{before if before is not None else "-":>10} {seconds:>10} {ratio}')
+
+
+def main(args) -> None:
+    results = []
+    if os.path.isfile(args.results):
+        with open(args.results, 'r', encoding='UTF-8') as f:
+            results = json.load(f)
+
+    for rows in args.rows:
+        folder = os.path.abspath(os.path.join(args.data, f'rows{rows}_seed{args.seed}'))
+        if not os.path.isfile(os.path.join(folder, 'pars.txt')) or args.regenerate:
+            print(f'Generating {rows} rows to {folder}')
+            generate(folder, rows, args.seed)
+        paths = {'dbf7': os.path.join(folder, 'D7'), 'dbf8': os.path.join(folder, 'D8'),
+                 'sqlite': os.path.join(folder, 'bench.db'), 'pars': os.path.join(folder, 'pars.txt')}
+
+        # Work folder, with '..\.temp_files', '..\.log_files' and '..\.result' next to it
+        work = os.path.join(folder, 'work')
+        for name in ('work', '.temp_files', '.log_files', '.result'):
+            os.makedirs(os.path.join(folder, name), exist_ok=True)
+
+        cwd = os.getcwd()
+        os.chdir(work)
+        try:
+            runs = [run_stages(paths, args.arraysize, args.batch_size) for _ in range(args.repeat)]
+        finally:
+            os.chdir(cwd)
+
+        # The best time of every stage
+        current = {'version': version(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'rows': rows, 'seed': args.seed, 'repeat': args.repeat,
+                   'stages': {name: min(run[name] for run in runs) for name in runs[0]}}
+        previous = [i for i in results if i['rows'] == rows and i['seed'] == args.seed]
+        if previous:
+            compare(previous[-1], current)
+        else:
+            print(f'{rows} rows: {current["stages"]}')
+        results.append(current)
+
+    with open(args.results, 'w', encoding='UTF-8') as f:
+        json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='Shtrih benchmark',
+                            description='Generate synthetic InvSoot.dbf files and sqlite db, time every stage of '
+                                        'arb_shtrih and invs_test and compare with previous results')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='Records in generated InvSoot.dbf files (10000 .. 10000000), several scales allowed')
+    parser.add_argument('--seed', type=int, default=0, required=False,
+                        help='Random seed of generated data')
+    parser.add_argument('--data', type=str, default='..\\.bench', required=False,
+                        help='Folder for generated data')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='Generate data even if it already exists')
+    parser.add_argument('--repeat', type=int, default=1, required=False,
+                        help='Run every stage N times, the best time is stored')
+    parser.add_argument('--results', type=str, default=RESULTS_PATH, required=False,
+                        help='JSON file with results of previous runs (new results are appended)')
+    parser.add_argument('--arraysize', type=int, default=50000, required=False,
+                        help='Rows fetched from database in one round-trip')
+    parser.add_argument('--batch-size', type=int, default=10000, required=False,
+                        help='Rows inserted to UDO_T_IMPORT7 by one statement')
+    args = parser.parse_args()
+    main(args)
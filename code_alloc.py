@@ -0,0 +1,258 @@
+import os
+import tempfile
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+
+# Policy for InvSoot8 rows, whose InvSoot7 code was already given to previous row
+# (the first row by InvSoot8 row order always keeps the code)
+DUPLICATE_ALLOCATE = 'allocate'     # duplicate row gets new free code
+DUPLICATE_KEEP = 'keep'             # duplicate row keeps its old code (only logged)
+
+CONFLICTS = '..\\.log_files\\code_conflicts.csv'
+MAX_DIGITS = 18     # longer digit codes don't fit int64 and can't be equal to generated codes
+REPORT_COLUMNS = ['kind', 'row', 'code', 'new_code', 'first_row']
+SPILL_CHUNK = 100000     # records of spill file read at once
+
+
+def code_values(column) -> np.ndarray:
+    """
+    Numeric values of codes made of digits only ('0000000014642' -> 14642), other codes are skipped
+    Only unique codes are parsed (categories of categorical column)
+    :param column: codes (str, categorical or object with NaN)
+    :return: sorted unique int64 array
+    """
+    codes = pd.Series(pd.Categorical(column).categories, dtype=object).astype(str).str.strip()
+    codes = codes[codes.str.fullmatch(f'[0-9]{{1,{MAX_DIGITS}}}')]
+    return np.unique(codes.astype(np.int64).to_numpy())
+
+
+def generated_code(values) -> np.ndarray:
+    """
+    Generated code of number: '000' + str(number), the same format as codes of previous versions
+    :param values: int64 array
+    :return: object array of str
+    """
+    return np.array(['000' + str(i) for i in np.asarray(values).tolist()], dtype=object)
+
+
+class CodeAllocator:
+    """
+    Sorted index of codes used in InvSoot7 and InvSoot8, that hands out free codes in bulk
+    Free numbers after base are numbered in increasing order: k-th free number is found by binary search
+    over counts of free numbers before every used number, so allocation is O(log n) per code and
+    codes are handed out in InvSoot8 row order (the same result in batch and streaming modes).
+    Also keeps the first InvSoot8 row given every InvSoot7 code (by code group, see build_soot7_indexes)
+    and collects conflict report. Conflicts and rows keeping old codes are spilled to temporary files
+    (appended in InvSoot8 row order), so memory doesn't grow with them
+    """
+
+    def __init__(self, used: np.ndarray, base: int = 14641, duplicates: str = DUPLICATE_ALLOCATE,
+                 spill_dir: str = None):
+        """
+        :param used: numeric values of used codes (see code_values), any order, may repeat
+        :param base: generated codes start from base + 1
+        :param duplicates: DUPLICATE_ALLOCATE or DUPLICATE_KEEP
+        :param spill_dir: folder for temporary files (None - default temporary folder)
+        """
+        if duplicates not in (DUPLICATE_ALLOCATE, DUPLICATE_KEEP):
+            raise ValueError(f'unknown duplicate policy {duplicates!r}')
+        self.base = base
+        self.duplicates = duplicates
+        self.allocated = 0
+
+        used = np.unique(np.asarray(used, dtype=np.int64))
+        self._used = used[used > base]
+        # free numbers between base and every used number
+        self._free_before = self._used - base - 1 - np.arange(len(self._used))
+
+        self._first_row = np.full(0, -1, dtype=np.int64)
+        self._spill_dir = spill_dir
+        self._tmp = None
+        self._counts = Counter()    # records of conflict report added by conflict(), by kind
+        self._kept_codes = None     # kept codes given to other rows (see keep), counted by write_report
+
+    def close(self) -> None:
+        """
+        Remove temporary files (report can't be written after it)
+        """
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def _spill(self, name: str, frame: pd.DataFrame) -> None:
+        """
+        Service function, append records to temporary '@'-delimited file
+        """
+        if self._tmp is None:
+            if self._spill_dir is not None:
+                os.makedirs(self._spill_dir, exist_ok=True)
+            self._tmp = tempfile.TemporaryDirectory(dir=self._spill_dir)
+        frame.to_csv(os.path.join(self._tmp.name, name), sep='@', quotechar='|', index=False, header=False,
+                     mode='a')
+
+    def _spilled(self, name: str, columns: list):
+        """
+        Service function, read temporary file by chunks of SPILL_CHUNK records (all values as str)
+        """
+        path = os.path.join(self._tmp.name, name) if self._tmp is not None else None
+        if path is None or not os.path.exists(path):
+            return
+        yield from pd.read_csv(path, sep='@', quotechar='|', names=columns, dtype=str, keep_default_na=False,
+                               chunksize=SPILL_CHUNK)
+
+    def take(self, count: int) -> np.ndarray:
+        """
+        Next count free codes (never used in dbf files and never given before)
+        :param count: number of codes
+        :return: object array of generated codes (see generated_code)
+        """
+        rank = self.allocated + np.arange(count, dtype=np.int64)
+        values = self.base + 1 + rank + np.searchsorted(self._free_before, rank, side='right')
+        self.allocated += count
+        return generated_code(values)
+
+    def skipped(self) -> int:
+        """
+        Number of used codes skipped by allocated codes so far
+        """
+        if not self.allocated:
+            return 0
+        return int(np.searchsorted(self._free_before, self.allocated - 1, side='right'))
+
+    def give(self, group: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """
+        Give InvSoot7 codes to InvSoot8 rows, the first row of every code group keeps the code
+        :param group: code groups of found InvSoot7 rows
+        :param rows: InvSoot8 row numbers (increasing, through all chunks)
+        :return: bool mask of duplicates (code was given to previous row)
+        """
+        if len(group) and group.max() >= len(self._first_row):
+            extended = np.full(group.max() + 1, -1, dtype=np.int64)
+            extended[:len(self._first_row)] = self._first_row
+            self._first_row = extended
+
+        duplicated = np.ones(len(group), dtype=bool)
+        duplicated[np.unique(group, return_index=True)[1]] = False
+        duplicated |= self._first_row[group] >= 0
+        first = ~duplicated
+        self._first_row[group[first]] = rows[first]
+        return duplicated
+
+    def first_row(self, group: np.ndarray) -> np.ndarray:
+        """
+        First InvSoot8 row given code of group, -1 if code wasn't given
+        """
+        group = np.asarray(group, dtype=np.int64)
+        first = np.full(len(group), -1, dtype=np.int64)
+        known = group < len(self._first_row)
+        first[known] = self._first_row[group[known]]
+        return first
+
+    def conflict(self, kind: str, rows, code, new_code=None, first_row=None) -> None:
+        """
+        Add records to conflict report
+        :param kind: 'duplicate' (InvSoot7 code was given to previous row), 'kept_code' (row keeps old code,
+                     that is given to other row)
+        :param rows: InvSoot8 row numbers
+        :param code: conflicting codes
+        :param new_code: codes given to rows (None - row keeps old code)
+        :param first_row: rows, that got code before
+        """
+        if not len(rows):
+            return
+        self._spill('conflicts.csv', pd.DataFrame({'kind': kind,
+                                                   'row': np.asarray(rows, dtype=np.int64),
+                                                   'code': np.asarray(code, dtype=object),
+                                                   'new_code': np.asarray(new_code, dtype=object)
+                                                   if new_code is not None else None,
+                                                   'first_row': first_row if first_row is not None else -1}))
+        self._counts[kind] += len(rows)
+
+    def keep(self, rows, group, code) -> None:
+        """
+        Remember rows, that keep their old code equal to InvSoot7 code: if this code is given to other row
+        (now or in later chunk), it's a conflict (see conflicts)
+        :param rows: InvSoot8 row numbers
+        :param group: code groups of old codes
+        :param code: old codes
+        """
+        if len(rows):
+            self._spill('kept.csv', pd.DataFrame({'row': np.asarray(rows, dtype=np.int64),
+                                                  'group': np.asarray(group, dtype=np.int64),
+                                                  'code': np.asarray(code, dtype=object)}))
+
+    def _kept_conflicts(self):
+        """
+        Service function, 'kept_code' records of conflict report by chunks: kept rows, whose code was given
+        to other row
+        """
+        for chunk in self._spilled('kept.csv', ['row', 'group', 'code']):
+            rows = chunk['row'].astype(np.int64).to_numpy()
+            first = self.first_row(chunk['group'].astype(np.int64).to_numpy())
+            clash = (first >= 0) & (first != rows)
+            if clash.any():
+                yield pd.DataFrame({'kind': 'kept_code', 'row': rows[clash],
+                                    'code': chunk['code'].to_numpy(dtype=object)[clash], 'new_code': '',
+                                    'first_row': first[clash]})
+
+    def _report_chunks(self):
+        """
+        Service function, conflict report by chunks, ordered by InvSoot8 row: spilled duplicates and
+        'kept_code' records (both are in row order) are merged up to the last row read from both of them
+        """
+        sources = [self._spilled('conflicts.csv', REPORT_COLUMNS), self._kept_conflicts()]
+        buffers = [pd.DataFrame(columns=REPORT_COLUMNS)] * 2
+        done = [False, False]
+        while True:
+            for i, source in enumerate(sources):
+                while not done[i] and not len(buffers[i]):
+                    chunk = next(source, None)
+                    if chunk is None:
+                        done[i] = True
+                    else:
+                        buffers[i] = chunk.assign(row=chunk['row'].astype(np.int64))
+            if all(done) and not any(len(i) for i in buffers):
+                return
+            limit = min(np.inf if done[i] else buffers[i]['row'].iloc[-1] for i in range(2))
+            parts = [i[i['row'] <= limit] for i in buffers]
+            buffers = [i[i['row'] > limit] for i in buffers]
+            yield pd.concat(parts, ignore_index=True).sort_values(['row', 'kind'], kind='stable')
+
+    def conflicts(self) -> pd.DataFrame:
+        """
+        Conflict report, ordered by InvSoot8 row (whole report in memory, see write_report)
+        :return: pd.DataFrame with columns kind, row, code, new_code, first_row
+        """
+        frames = list(self._report_chunks())
+        if not frames:
+            return pd.DataFrame({i: [] for i in REPORT_COLUMNS})
+        return pd.concat(frames, ignore_index=True)
+
+    def write_report(self, path: str = CONFLICTS) -> int:
+        """
+        Write conflict report to csv file ('@'-delimited as other intermediate files) by chunks
+        :param path: path to csv file
+        :return: number of records in report
+        """
+        count = kept = 0
+        with open(path, 'w', newline='', encoding='UTF-8') as f:
+            f.write('@'.join(REPORT_COLUMNS) + '\n')
+            for chunk in self._report_chunks():
+                chunk.to_csv(f, sep='@', quotechar='|', index=False, header=False)
+                count += len(chunk)
+                kept += int((chunk['kind'] == 'kept_code').sum())
+        self._kept_codes = kept - self._counts['kept_code']
+        return count
+
+    def summary(self) -> str:
+        """
+        Service function, allocation counters as one line
+        """
+        if self._kept_codes is None:
+            self._kept_codes = sum(len(i) for i in self._kept_conflicts())
+        return (f'allocated: {self.allocated}, used codes skipped: {self.skipped()}, '
+                f'duplicates: {self._counts["duplicate"]}, kept codes given to other rows: '
+                f'{self._counts["kept_code"] + self._kept_codes}')
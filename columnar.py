@@ -0,0 +1,229 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import rn7_codec
+
+
+# Raw RN7 of parus-7 is kept packed to int64 (see rn7_codec.pack), keys are Int64 (int64 values + null mask),
+# codes are categorical: no str object per row in tables
+RN7 = 'rn7'
+
+# Types of columns of all intermediate tables
+DTYPE_IMP = {'RN7': RN7, 'RN8': pd.Int64Dtype(), 'SRN7': pd.Int64Dtype()}
+DTYPE_UDO = {'SRN7': RN7, 'RN7': pd.Int64Dtype(), 'RN8': pd.Int64Dtype()}
+DTYPE_SOOT = {'IRN': pd.Int64Dtype(),
+              'KRN': pd.Int64Dtype(),
+              'SRN': pd.Int64Dtype(),
+              'CODE': 'category'}
+
+DTYPE_BASE7 = {'RN': pd.Int64Dtype(), 'NRN': pd.Int64Dtype(), 'ARN': pd.Int64Dtype(), 'MRN': pd.Int64Dtype(),
+               'KRN': pd.Int64Dtype(), 'GRP': pd.Int64Dtype(),
+               'NUM': 'str', 'KART': 'str', 'PASS': 'str', 'ZAV': 'str', 'TIP': 'float', 'SUM': 'float',
+               'DAT': 'str', 'KOL': 'float', 'HND': 'bool', 'PR1': 'str', 'PRM': 'str', 'OKOF': 'str'}
+
+DTYPE_INV_SUBST = {'RN': pd.Int64Dtype(), 'PRN': pd.Int64Dtype(), 'NOMEN': pd.Int64Dtype()}
+DTYPE_INSOST = {'RN7': RN7, 'PRN': pd.Int64Dtype(), 'NOMEN': pd.Int64Dtype()}
+DTYPE_INVPACK = {'PRN': pd.Int64Dtype(), 'RN': pd.Int64Dtype()}
+DTYPE_PAIRS = {'PRN': pd.Int64Dtype(), 'NOMEN': pd.Int64Dtype(), 'RN7': RN7, 'RN8': pd.Int64Dtype()}
+
+SCHEMAS = {'InvSoot7': DTYPE_SOOT, 'InvSoot8': DTYPE_SOOT,
+           'import7': DTYPE_IMP, 'udo_import7': DTYPE_UDO,
+           'SinBase7': DTYPE_BASE7,
+           'inv_subst': DTYPE_INV_SUBST, 'insost': DTYPE_INSOST, 'invpack': DTYPE_INVPACK,
+           'udo_pairs': DTYPE_PAIRS}
+
+
+def to_array(values, dtype):
+    """
+    Convert sequence of values (batch of query rows, etc.) to column of schema type
+    :param values: sequence of values (None for null)
+    :param dtype: type from schema
+    :return: pandas or numpy array
+    """
+    if dtype == RN7:
+        return rn7_codec.pack(values)
+    if dtype in ('str', str):
+        return pd.array(list(values), dtype=object)
+    return pd.array(list(values), dtype=dtype)
+
+
+def concat_arrays(arrays: list, dtype):
+    """
+    Concatenate columns of schema type (see to_array)
+    :param arrays: list of arrays
+    :param dtype: type from schema
+    :return: pandas or numpy array
+    """
+    if not arrays:
+        return to_array([], dtype)
+    if len(arrays) == 1:
+        return arrays[0]
+    if dtype == RN7:
+        return np.concatenate(arrays)
+    return pd.concat([pd.Series(i, copy=False) for i in arrays], ignore_index=True).array
+
+
+def csv_dtype(schema: dict) -> dict:
+    """
+    Types for pd.read_csv: packed RN7 is read as str (see apply_schema)
+    :param schema: column -> type
+    :return: column -> dtype
+    """
+    return {key: 'str' if value == RN7 else value for key, value in schema.items()}
+
+
+def apply_schema(db: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """
+    Convert columns of pd.DataFrame to schema types in place (packed RN7, categorical codes, etc.)
+    :param db: pd.DataFrame object
+    :param schema: column -> type
+    :return: db
+    """
+    for name, dtype in schema.items():
+        if name not in db.columns:
+            continue
+        if dtype == RN7:
+            if not pd.api.types.is_integer_dtype(db[name].dtype):
+                db[name] = rn7_codec.pack(db[name])
+        elif dtype not in ('str', str):
+            db[name] = db[name].astype(dtype)
+    return db
+
+
+def _kind(column: pd.Series) -> str:
+    """
+    Service function, storage kind of column: int (nullable), bool (nullable), float, category or str
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return 'category'
+    if pd.api.types.is_bool_dtype(column.dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(column.dtype):
+        return 'int'
+    if pd.api.types.is_float_dtype(column.dtype):
+        return 'float'
+    return 'str'
+
+
+def write_table(db: pd.DataFrame, path: str, csv: bool = False, dtype: dict = None) -> None:
+    """
+    Write pd.DataFrame to columnar folder '<path>.cols': one .npy file per column (+ null mask)
+    and schema.json with column kinds; strings are stored as fixed-width utf-8 bytes,
+    categorical columns as int32 codes and categories
+    :param db: pd.DataFrame object
+    :param path: path without extension
+    :param csv: also write '<path>.csv' ('@'-delimited, for debugging)
+    :param dtype: column types, for csv file (see export_csv)
+    """
+    folder = path + '.cols'
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    schema = {'rows': len(db), 'columns': []}
+    for i, name in enumerate(db.columns):
+        column = db[name]
+        kind = _kind(column)
+        mask = np.asarray(column.isna())
+        extra = {}
+
+        if kind == 'category':
+            values = column.cat.codes.to_numpy(dtype=np.int32)
+            categories = np.array([str(v) for v in column.cat.categories.tolist()], dtype=str)
+            categories = np.char.encode(categories, 'utf-8') if len(categories) else np.array([], dtype='S1')
+            np.save(os.path.join(tmp, f'{i}.categories.npy'), categories)
+            mask = np.zeros(len(column), dtype=bool)
+        elif kind == 'int':
+            extra['nullable'] = isinstance(column.dtype, pd.api.extensions.ExtensionDtype)
+            values = column.to_numpy(dtype=np.int64, na_value=0)
+        elif kind == 'bool':
+            values = column.to_numpy(dtype=bool, na_value=False)
+        elif kind == 'float':
+            values = column.to_numpy(dtype=np.float64)
+        else:
+            strings = np.array(['' if m else str(v) for v, m in zip(column.tolist(), mask)], dtype=str)
+            values = np.char.encode(strings, 'utf-8') if len(strings) else np.array([], dtype='S1')
+
+        np.save(os.path.join(tmp, f'{i}.npy'), values)
+        if mask.any():
+            np.save(os.path.join(tmp, f'{i}.mask.npy'), mask)
+        schema['columns'].append({'name': str(name), 'kind': kind, 'nulls': bool(mask.any()), **extra})
+
+    with open(os.path.join(tmp, 'schema.json'), 'w', encoding='UTF-8') as f:
+        json.dump(schema, f)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp, folder)
+
+    if csv:
+        export_csv(db, path, dtype)
+
+
+def export_csv(db: pd.DataFrame, path: str, schema: dict = None) -> None:
+    """
+    Write pd.DataFrame to '<path>.csv', '@'-delimited and '|'-quoted as old intermediate files (for debugging)
+    Packed RN7 columns of schema are written as str (read back with csv_dtype and apply_schema)
+    :param db: pd.DataFrame object
+    :param path: path without extension
+    :param schema: column types (None - columns are written as they are)
+    """
+    packed = [name for name, dtype in (schema or {}).items() if dtype == RN7 and name in db.columns]
+    if packed:
+        db = db.assign(**{name: rn7_codec.unpack(db[name]) for name in packed})
+    db.to_csv(path + '.csv', sep='@', quotechar='|', index=False)
+
+
+def read_table(path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Read columnar folder '<path>.cols' to pd.DataFrame
+    Numeric columns and category codes are memory-mapped copy-on-write (not read to memory), strings are decoded
+    :param path: path without extension
+    :param columns: columns to read (default: all)
+    :return: pd.DataFrame object
+    """
+    folder = path + '.cols'
+    with open(os.path.join(folder, 'schema.json'), 'r', encoding='UTF-8') as f:
+        schema = json.load(f)
+
+    data = {}
+    for i, column in enumerate(schema['columns']):
+        if columns is not None and column['name'] not in columns:
+            continue
+        values = np.load(os.path.join(folder, f'{i}.npy'), mmap_mode='c' if schema['rows'] else None)
+        if column['nulls']:
+            mask = np.load(os.path.join(folder, f'{i}.mask.npy'))
+        else:
+            mask = np.zeros(schema['rows'], dtype=bool)
+
+        if column['kind'] == 'category':
+            categories = np.load(os.path.join(folder, f'{i}.categories.npy'))
+            categories = np.char.decode(categories, 'utf-8').astype(object) if len(categories) else []
+            data[column['name']] = pd.Categorical.from_codes(values, pd.Index(categories, dtype=object))
+        elif column['kind'] == 'int' and not column.get('nullable', True):
+            data[column['name']] = values
+        elif column['kind'] == 'int':
+            data[column['name']] = pd.arrays.IntegerArray(values, mask)
+        elif column['kind'] == 'bool':
+            data[column['name']] = pd.arrays.BooleanArray(values, mask)
+        elif column['kind'] == 'float':
+            data[column['name']] = values
+        else:
+            strings = np.char.decode(values, 'utf-8').astype(object)
+            strings[mask] = np.nan
+            data[column['name']] = strings
+
+    return pd.DataFrame(data, index=pd.RangeIndex(schema['rows']))
+
+
+def table_size(path: str) -> int:
+    """
+    Service function, size of columnar folder on disk
+    :param path: path without extension
+    :return: size in bytes
+    """
+    folder = path + '.cols'
+    return sum(os.path.getsize(os.path.join(folder, i)) for i in os.listdir(folder))
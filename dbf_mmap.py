@@ -0,0 +1,359 @@
+import os
+import mmap
+import shutil
+import struct
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+class DbfField(NamedTuple):
+    """
+    Field descriptor of dbf file
+    offset: position of field in record (record starts with deletion flag)
+    """
+    name: str
+    type: str
+    offset: int
+    length: int
+    decimals: int
+
+
+class DbfHeader(NamedTuple):
+    """
+    Header of dbf file
+    updated: date of last update (year, month, day)
+    """
+    version: int
+    updated: tuple
+    record_count: int
+    header_length: int
+    record_length: int
+    encoding: str
+    fields: list
+
+
+def read_header(buffer) -> DbfHeader:
+    """
+    Parse dbf header from the beginning of buffer
+    :param buffer: bytes-like object (bytes, mmap)
+    :return: DbfHeader object
+    """
+    from dbfpy3.code_page import code_pages     # only code page table of dbfpy3 is used, imported when needed
+
+    version, year, month, day, record_count, header_length, record_length = struct.unpack_from('<4BIHH', buffer, 0)
+    encoding = code_pages.get(buffer[29], ['cp866'])[0]
+
+    fields = []
+    pos = 32
+    offset = 1
+    end = min(header_length, len(buffer))
+    while pos < end and buffer[pos] != 0x0D:
+        name = bytes(buffer[pos:pos + 11]).split(b'\x00')[0].decode('ascii').strip()
+        length, decimals = buffer[pos + 16], buffer[pos + 17]
+        fields.append(DbfField(name, chr(buffer[pos + 11]), offset, length, decimals))
+        offset += length
+        pos += 32
+
+    return DbfHeader(version, (1900 + year, month, day), record_count, header_length, record_length,
+                     encoding, fields)
+
+
+def record_block(buffer, header: DbfHeader) -> np.ndarray:
+    """
+    View of all records of dbf file as 2d array of bytes, without copying
+    :param buffer: bytes-like object with whole dbf file
+    :param header: DbfHeader object
+    :return: np.ndarray (records x record_length) of uint8
+    """
+    count = min(header.record_count, (len(buffer) - header.header_length) // header.record_length)
+    return np.frombuffer(buffer, dtype=np.uint8, count=count * header.record_length,
+                         offset=header.header_length).reshape(count, header.record_length)
+
+
+def field_bytes(records: np.ndarray, field: DbfField, rows: np.ndarray = None) -> np.ndarray:
+    """
+    Raw values of one field as fixed-width bytes array (copy)
+    :param records: records block (see record_block)
+    :param field: DbfField object
+    :param rows: bool mask of records to take (default: all)
+    :return: np.ndarray of dtype 'S<length>'
+    """
+    if rows is None:
+        raw = np.ascontiguousarray(records[:, field.offset:field.offset + field.length])
+    else:
+        raw = np.ascontiguousarray(records[rows, field.offset:field.offset + field.length])
+    return raw.view(f'S{field.length}').ravel()
+
+
+def charmap(encoding: str):
+    """
+    Service function, table byte -> unicode code point for single-byte encoding
+    :param encoding: dbf code page
+    :return: np.ndarray of 256 uint32 values, None for multi-byte encoding
+    """
+    chars = bytes(range(256)).decode(encoding, errors='replace')
+    if len(chars) != 256:
+        return None
+    return np.array([ord(i) for i in chars], dtype=np.uint32)
+
+
+def decode_text(raw: np.ndarray, encoding: str) -> np.ndarray:
+    """
+    Service function, decode fixed-width bytes array to stripped fixed-width str array
+    :param raw: fixed-width bytes array
+    :param encoding: dbf code page
+    :return: np.ndarray of dtype 'U<length>'
+    """
+    table = charmap(encoding)
+    if table is None:
+        values = np.char.decode(raw, encoding)
+    else:
+        values = table[raw.view(np.uint8).reshape(len(raw), -1)].view(f'U{raw.itemsize}').ravel()
+    return np.char.strip(values)
+
+
+def decode_field(raw: np.ndarray, field: DbfField, encoding: str, dtype=None):
+    """
+    Decode raw field values to column by dbf field type
+    N, F -> Int64 or float; L -> boolean; C, D and others -> str (stripped, NaN if empty)
+    C fields with dtype Int64 or 'category' are decoded straight from bytes, without str objects per row
+    :param raw: fixed-width bytes array (see field_bytes)
+    :param field: DbfField object
+    :param encoding: dbf code page
+    :param dtype: target dtype of column (see columnar.SCHEMAS), None - by field type
+    :return: pandas or numpy array
+    """
+    if field.type not in 'NFL' and isinstance(dtype, pd.Int64Dtype):
+        raw = np.char.strip(raw)
+        empty = raw == b''
+        try:
+            values = np.where(empty, b'0', raw).astype(np.int64)
+        except ValueError:
+            raise ValueError(f'field {field.name} has not numeric values') from None
+        return pd.arrays.IntegerArray(values, empty)
+
+    if field.type not in 'NFL' and dtype == 'category':
+        categories, codes = np.unique(np.char.strip(raw), return_inverse=True)
+        codes = codes.ravel().astype(np.int32)
+        if len(categories) and categories[0] == b'':
+            categories, codes = categories[1:], codes - 1
+        categories = decode_text(categories, encoding) if len(categories) else np.array([], dtype=str)
+        return pd.Categorical.from_codes(codes, categories.astype(object))
+
+    if field.type not in 'NFL':
+        values = decode_text(raw, encoding)
+        empty = values == ''
+        values = values.astype(object)
+        values[empty] = np.nan
+        return values
+
+    raw = np.char.strip(raw)
+    empty = raw == b''
+
+    if field.type == 'L':
+        values = np.isin(raw, [b'T', b't', b'Y', b'y'])
+        empty |= ~(values | np.isin(raw, [b'F', b'f', b'N', b'n']))
+        return pd.arrays.BooleanArray(values, empty)
+
+    if field.type == 'N' and field.decimals == 0:
+        values = np.where(empty, b'0', raw).astype(np.int64)
+        return pd.arrays.IntegerArray(values, empty)
+    return np.where(empty, b'nan', raw).astype(np.float64)
+
+
+def read_dbf_frame(path: str, dtype: dict = None, columns: list = None, deleted: bool = False) -> pd.DataFrame:
+    """
+    Read dbf file to pd.DataFrame through memory-mapped buffer, deleted records are skipped
+    :param path: path to dbf file
+    :param dtype: column -> dtype, for columns which type differs from dbf field type
+    :param columns: columns to read (default: all)
+    :param deleted: keep deleted records (row number is physical record number)
+    :return: pd.DataFrame object
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        header = read_header(buffer)
+        records = record_block(buffer, header)
+        keep = np.ones(len(records), dtype=bool) if deleted else records[:, 0] != ord('*')
+        db = _decode_records(records, header, dtype, columns, keep)
+        del records
+
+    return db
+
+
+def read_dbf_chunks(path: str, chunk_size: int, dtype: dict = None, columns: list = None):
+    """
+    Read dbf file by chunks of records through memory-mapped buffer, only one chunk is decoded at once
+    Deleted records are included (row number is physical record number) and marked in deleted mask
+    :param path: path to dbf file
+    :param chunk_size: records in chunk
+    :param dtype: column -> dtype, for columns which type differs from dbf field type
+    :param columns: columns to read (default: all)
+    :return: generator of (number of first record, deleted mask, pd.DataFrame)
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        header = read_header(buffer)
+        records = record_block(buffer, header)
+        try:
+            for start in range(0, len(records), chunk_size):
+                deleted = records[start:start + chunk_size, 0] == ord('*')
+                db = _decode_records(records[start:start + chunk_size], header, dtype, columns)
+                yield start, deleted, db
+        finally:
+            del records
+
+
+def _decode_records(records: np.ndarray, header: DbfHeader, dtype: dict = None, columns: list = None,
+                    rows: np.ndarray = None) -> pd.DataFrame:
+    """
+    Service function, decode block of records to pd.DataFrame
+    :param records: records block (see record_block)
+    :param header: DbfHeader object
+    :param dtype: column -> dtype, for columns which type differs from dbf field type
+    :param columns: columns to read (default: all)
+    :param rows: bool mask of records to decode (default: all), only needed fields of them are copied
+    :return: pd.DataFrame object
+    """
+    dtype = dtype or {}
+    data = {}
+    for field in header.fields:
+        if columns is not None and field.name not in columns:
+            continue
+        column = decode_field(field_bytes(records, field, rows), field, header.encoding, dtype.get(field.name))
+        if field.name in dtype:
+            column = _cast(column, dtype[field.name])
+        data[field.name] = column
+    return pd.DataFrame(data)
+
+
+def _cast(column, dtype):
+    """
+    Service function, cast decoded column to dtype (numbers stored in character fields, etc.)
+    :param column: pandas array
+    :param dtype: target dtype
+    :return: pandas array
+    """
+    if dtype in ('str', str, 'object', object):
+        if column.dtype == object:
+            return column
+        return pd.array([np.nan if pd.isna(i) else str(i) for i in column], dtype=object)
+    if isinstance(dtype, pd.Int64Dtype) and column.dtype == object:
+        return pd.array(pd.to_numeric(column), dtype=dtype)
+    return column.astype(dtype)
+
+
+def encode_field(values, field: DbfField, encoding: str) -> np.ndarray:
+    """
+    Encode str values to raw values of character field: left-justified and padded with spaces,
+    NaN is written as empty value (surrounding spaces are stripped, same as dbf library does)
+    :param values: sequence of str
+    :param field: DbfField object
+    :param encoding: dbf code page
+    :return: np.ndarray of dtype 'S<length>'
+    """
+    strings = np.char.strip(np.asarray(pd.Series(values, dtype=object).fillna(''), dtype=str))
+    table = charmap(encoding)
+    if table is None or not len(strings):
+        raw = np.char.encode(strings, encoding) if len(strings) else np.array([], dtype='S1')
+    else:
+        # Single-byte code page: code points are replaced with bytes through sorted charmap
+        points = strings.view(np.uint32).reshape(len(strings), -1)
+        defined = np.flatnonzero(table != 0xFFFD)
+        order = defined[np.argsort(table[defined], kind='stable')]
+        pos = np.minimum(np.searchsorted(table[order], points), len(order) - 1)
+        found = table[order][pos] == points
+        if not found.all():
+            bad = strings[~found.all(axis=1)][0]
+            raise ValueError(f'field {field.name}: {str(bad)!r} can\'t be encoded to {encoding}')
+        raw = order[pos].astype(np.uint8).view(f'S{points.shape[1]}').ravel()
+
+    too_long = np.char.str_len(raw) > field.length
+    if too_long.any():
+        raise ValueError(f'field {field.name}: {str(strings[too_long][0])!r} is longer than {field.length} bytes')
+    return np.char.ljust(raw, field.length, b' ').astype(f'S{field.length}')
+
+
+class DbfPatcher:
+    """
+    Copy of dbf file, which character fields are overwritten in place through memory-mapped buffer
+    (other bytes are not changed). Copy is written to temporary file near target and renamed to target
+    on successful exit of with block, or removed on error
+    """
+
+    def __init__(self, source: str, target: str):
+        """
+        :param source: path to dbf file
+        :param target: path to result dbf file (may be the same as source)
+        """
+        self.source = source
+        self.target = target
+        self.tmp = target + '.tmp'
+        self._file = None
+        self._buffer = None
+        self._records = None
+        self.header = None
+
+    def __enter__(self):
+        shutil.copyfile(self.source, self.tmp)
+        self._file = open(self.tmp, 'r+b')
+        self._buffer = mmap.mmap(self._file.fileno(), 0)
+        self.header = read_header(self._buffer)
+        self._records = record_block(self._buffer, self.header)
+        return self
+
+    def patch(self, name: str, rows: np.ndarray, values) -> None:
+        """
+        Overwrite field in given records
+        :param name: field name
+        :param rows: physical record numbers (deleted records are counted), see read_dbf_frame(deleted=True)
+        :param values: new values of field, one for every row
+        """
+        field = next((i for i in self.header.fields if i.name == name), None)
+        if field is None:
+            raise ValueError(f'{self.source} has no field {name}')
+        raw = encode_field(values, field, self.header.encoding)
+        self._records[rows, field.offset:field.offset + field.length] = raw.view(np.uint8).reshape(len(raw),
+                                                                                                   field.length)
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._records = None
+        if exc_type is None:
+            self._buffer.flush()
+        self._buffer.close()
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp, self.target)
+        elif os.path.exists(self.tmp):
+            os.remove(self.tmp)
+        return False
+
+
+def patch_field(source: str, target: str, name: str, rows: np.ndarray, values) -> None:
+    """
+    Copy dbf file and overwrite one character field in given records, other bytes are not changed
+    (see DbfPatcher)
+    :param source: path to dbf file
+    :param target: path to result dbf file (may be the same as source)
+    :param name: field name
+    :param rows: physical record numbers (deleted records are counted), see read_dbf_frame(deleted=True)
+    :param values: new values of field, one for every row
+    """
+    with DbfPatcher(source, target) as patcher:
+        patcher.patch(name, rows, values)
+
+
+def dbf_fingerprint(path: str) -> dict:
+    """
+    Short description of dbf file state: record count and last update date from header, size and mtime
+    :param path: path to dbf file
+    :return: dict
+    """
+    with open(path, 'rb') as f:
+        header = read_header(f.read(32))
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path),
+            'record_count': header.record_count,
+            'updated': header.updated,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns}
@@ -0,0 +1,149 @@
+import json
+import queue
+import threading
+from collections import Counter
+
+import pandas as pd
+
+
+LOG_PROC = '..\\.log_files\\log_proc.txt'
+
+VERBOSITY_SUMMARY = 0   # only counters
+VERBOSITY_ERRORS = 1    # errors are written, successful matches are only counted
+VERBOSITY_ALL = 2       # everything is written
+
+
+class Diagnostics:
+    """
+    Buffered sink for process() diagnostics
+    Records are collected by outcome category, counted, and written to log_proc.txt
+    (and optionally to JSON Lines file) by batches, in caller thread or in background writer thread
+    """
+
+    def __init__(self, path: str = LOG_PROC, jsonl: str = None, verbosity: int = VERBOSITY_ERRORS,
+                 batch_size: int = 50000, background: bool = False):
+        """
+        :param path: text log file
+        :param jsonl: JSON Lines log file (None - don't write)
+        :param verbosity: VERBOSITY_SUMMARY, VERBOSITY_ERRORS or VERBOSITY_ALL
+        :param batch_size: records collected before writing
+        :param background: write batches in background thread
+        """
+        self.path = path
+        self.jsonl = jsonl
+        self.verbosity = verbosity
+        self.batch_size = batch_size
+        self.counters = Counter()
+
+        self._buffer = []
+        self._buffered = 0
+        self._queue = None
+        self._writer = None
+        self._error = None      # exception of background writer, raised by flush() and close()
+        if background:
+            self._queue = queue.Queue(maxsize=4)
+            self._writer = threading.Thread(target=self._background, daemon=True)
+            self._writer.start()
+
+    def add(self, category: str, message: str, error: bool = True, **fields) -> None:
+        """
+        Add one record
+        :param category: outcome category (ok, duplicate_code, ...)
+        :param message: human-readable description
+        :param error: False for successful outcome (not written with VERBOSITY_ERRORS)
+        :param fields: record fields (IRN, KRN, ...)
+        """
+        self.add_many(category, message, 1, error, **{key: [value] for key, value in fields.items()})
+
+    def add_many(self, category: str, message: str, count: int, error: bool = True, **columns) -> None:
+        """
+        Add count records of the same category at once
+        :param category: outcome category (ok, duplicate_code, ...)
+        :param message: human-readable description
+        :param count: number of records
+        :param error: False for successful outcome (not written with VERBOSITY_ERRORS)
+        :param columns: record fields, sequences of count values
+        """
+        if not count:
+            return
+        self.counters[category] += count
+        if self.verbosity == VERBOSITY_SUMMARY or (not error and self.verbosity < VERBOSITY_ALL):
+            return
+
+        columns = {key: [None if pd.isna(i) else i for i in (value.tolist() if hasattr(value, 'tolist') else value)]
+                   for key, value in columns.items()}
+        self._buffer.append((category, message, count, columns))
+        self._buffered += count
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write collected records (or pass them to background writer)
+        Error of background writer is raised here, records are not queued after it
+        """
+        self._check_writer()
+        if not self._buffer:
+            return
+        batch, self._buffer, self._buffered = self._buffer, [], 0
+        if self._queue is not None:
+            self._queue.put(batch)
+        else:
+            self._write(batch)
+
+    def close(self) -> Counter:
+        """
+        Write the rest of records, stop background writer
+        :return: counters by category
+        """
+        try:
+            self.flush()
+        finally:
+            if self._writer is not None:
+                self._queue.put(None)
+                self._writer.join()
+                self._writer = None
+        self._check_writer()
+        return self.counters
+
+    def summary(self) -> str:
+        """
+        Service function, counters as one line
+        """
+        return ', '.join(f'{key}: {value}' for key, value in sorted(self.counters.items()))
+
+    def _check_writer(self) -> None:
+        """
+        Service function, raise exception of background writer
+        """
+        if self._error is not None:
+            raise self._error
+
+    def _background(self) -> None:
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._error is not None:
+                continue    # writer failed: batches are dropped, so put() of caller never blocks
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, batch: list) -> None:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for category, message, count, columns in batch:
+                values = list(zip(*columns.values())) if columns else [()] * count
+                for row in values:
+                    f.write(' -| '.join([message] + [str(i) for i in row]))
+                    f.write('\n')
+                    f.write('_' * 40 + '\n')
+
+        if self.jsonl:
+            with open(self.jsonl, 'a', encoding='utf-8') as f:
+                for category, message, count, columns in batch:
+                    values = list(zip(*columns.values())) if columns else [()] * count
+                    for row in values:
+                        f.write(json.dumps({'category': category, **dict(zip(columns, row))}, default=str))
+                        f.write('\n')
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import datetime
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Stages of run are recorded once per process, report is written at the end of run (see write_report)
+_LOCK = threading.Lock()
+_STAGES = []
+# Stages in progress (all threads): python memory high-water mark is folded into each of them before reset
+_ACTIVE = []
+_PROFILE = None
+_PROFILE_DIR = '..\\.log_files'
+_STARTED = time.perf_counter()
+
+
+class StageRecord:
+    """
+    Measurements of one stage, rows may be set inside of stage block
+    rss_rise, python_rise: rise of memory during stage above its level at stage entry
+    """
+
+    def __init__(self, name: str, rows: int = None):
+        self.name = name
+        self.rows = rows
+        self.wall = None
+        self.cpu = None
+        self.rss_rise = None
+        self.python_rise = None
+        self._python_start = None
+        self._python_max = 0
+
+    def as_dict(self) -> dict:
+        return {'name': self.name,
+                'wall': round(self.wall, 4),
+                'cpu': round(self.cpu, 4),
+                'rows': self.rows,
+                'rows_per_sec': round(self.rows / self.wall, 1) if self.rows is not None and self.wall else None,
+                'rss_rise': self.rss_rise,
+                'python_rise': self.python_rise}
+
+
+def configure(profile: str = None, profile_dir: str = _PROFILE_DIR, trace_malloc: bool = False) -> None:
+    """
+    Set up instrumentation for the run
+    :param profile: name of stage to run under cProfile (dump is written to profile_dir)
+    :param profile_dir: folder for cProfile dumps
+    :param trace_malloc: record python memory high-water mark of stages (tracemalloc, slows down run)
+    """
+    global _PROFILE, _PROFILE_DIR, _STARTED
+    _PROFILE, _PROFILE_DIR = profile, profile_dir
+    _STARTED = time.perf_counter()
+    if trace_malloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss() -> int:
+    """
+    Service function, peak resident memory of process in bytes (None if it can't be measured)
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    return None
+
+
+def current_rss() -> int:
+    """
+    Service function, current resident memory of process in bytes (None if it can't be measured)
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def rss_rise(rss_start: int, peak_start: int) -> int:
+    """
+    Service function, rise of resident memory since stage entry
+    If peak RSS of process grew during stage, the new peak was reached inside of stage and the rise is counted
+    from it, otherwise only current RSS is known (lower bound of the rise)
+    :param rss_start: current RSS at stage entry
+    :param peak_start: peak RSS of process at stage entry
+    :return: bytes (None if RSS can't be measured)
+    """
+    rss, peak = current_rss(), peak_rss()
+    if rss_start is None or rss is None:
+        return None
+    if peak is not None and peak_start is not None and peak > peak_start:
+        rss = max(rss, peak)
+    return max(rss - rss_start, 0)
+
+
+def _fold_python_peak() -> None:
+    """
+    Service function, fold python memory high-water mark since previous reset into all stages in progress and
+    reset it (called under _LOCK). Nested and concurrent stages keep their own maximum this way
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for i in _ACTIVE:
+        i._python_max = max(i._python_max, peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name: str, rows: int = None):
+    """
+    Measure wall time, CPU time, rise of RSS and of python memory (high-water mark) during block
+    CPU time and memory are per process: for stages running concurrently they include each other,
+    nested stages are included in outer ones
+    :param name: stage name
+    :param rows: rows processed (may be set later as record.rows)
+    :return: StageRecord object
+    """
+    record = StageRecord(name, rows)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        with _LOCK:
+            _fold_python_peak()
+            record._python_start = record._python_max = tracemalloc.get_traced_memory()[0]
+            _ACTIVE.append(record)
+    rss_start, peak_start = current_rss(), peak_rss()
+    profiler = cProfile.Profile() if name == _PROFILE else None
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record.wall = time.perf_counter() - wall
+        record.cpu = time.process_time() - cpu
+        record.rss_rise = rss_rise(rss_start, peak_start)
+        if tracing:
+            with _LOCK:
+                _fold_python_peak()
+                _ACTIVE.remove(record)
+            record.python_rise = record._python_max - record._python_start
+        if profiler is not None:
+            os.makedirs(_PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(_PROFILE_DIR, f'{name.replace(" ", "_")}.prof'))
+        with _LOCK:
+            _STAGES.append(record)
+
+
+def stages() -> list:
+    """
+    Records of finished stages
+    """
+    with _LOCK:
+        return [i.as_dict() for i in _STAGES]
+
+
+def write_report(path: str, script: str) -> dict:
+    """
+    Write JSON report of run: stages in order of finish, total time and peak memory
+    :param path: path to report file
+    :param script: script name
+    :return: report
+    """
+    report = {'script': script,
+              'argv': sys.argv[1:],
+              'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+              'wall': round(time.perf_counter() - _STARTED, 4),
+              'cpu': round(time.process_time(), 4),
+              'peak_rss': peak_rss(),
+              'stages': stages()}
+    with open(path, 'w', encoding='UTF-8') as f:
+        json.dump(report, f, indent=1)
+    return report
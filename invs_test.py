@@ -1,12 +1,56 @@
 import os
-import csv
 from argparse import ArgumentParser
 
-import oracledb
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+import ora_session
+import instrument
+import rn7_codec
+from columnar import (write_table, read_table,
+                      DTYPE_INV_SUBST, DTYPE_INSOST, DTYPE_INVPACK, DTYPE_PAIRS)
+
+
+# Rows are paired by position inside (PRN, NOMEN) groups, positions follow RN order
+# (the same order as ROW_NUMBER() of PAIRS_SQL, so client and server pairing give the same pairs)
+INVSUBST_SQL = ('SELECT INVS.RN, INVS.PRN, INVS.NOMENCLATURE '
+                'FROM INVSUBST INVS '
+                'WHERE INVS.NOMENCLATURE != 17354601 '
+                'ORDER BY INVS.RN')
+INSOST_SQL = ('select pi2.rn, i1.rn8, i2.rn8 from P7_INSOST pi2 '
+              'JOIN IMPORT7 i1 ON pi2.MASTER_RN = i1.RN7 '
+              'JOIN IMPORT7 i2 ON pi2.RN_PRNOM = i2.RN7 '
+              'WHERE i1.table7=\'INBASE\' AND i2.table7=\'NOBASE\' AND i2.rn8 != 17354601 '
+              'order by pi2.rn')
+INVPACK_SQL = 'SELECT ip.rn, inv.rn FROM invpack ip JOIN INVENTORY inv ON ip.prn=inv.rn '
+
+# Row count and max RN of source tables, to find out if they were changed since the last run
+INVSUBST_FINGERPRINT_SQL = ('SELECT count(*), max(INVS.RN), '
+                            'sum(ORA_HASH(INVS.RN || \'@\' || INVS.PRN || \'@\' || INVS.NOMENCLATURE)) '
+                            'FROM INVSUBST INVS')
+INSOST_FINGERPRINT_SQL = ('select count(*), max(pi2.rn), '
+                          'sum(ORA_HASH(pi2.rn || \'@\' || pi2.MASTER_RN || \'@\' || pi2.RN_PRNOM)) '
+                          'from P7_INSOST pi2')
+
+# Pairing of insost_pairs() inside database: k-th insost row of (PRN, NOMEN) group goes with k-th invsubst row,
+# rows with null PRN or NOMEN are not joined (window functions are required, sqlite 3.25+ for stand-in)
+PAIRS_SQL = ('SELECT s7.prn, s7.nomen, s7.rn7, s8.rn8 FROM '
+             '(select pi2.rn rn7, i1.rn8 prn, i2.rn8 nomen, '
+             'ROW_NUMBER() OVER (PARTITION BY i1.rn8, i2.rn8 ORDER BY pi2.rn) k '
+             'from P7_INSOST pi2 '
+             'JOIN IMPORT7 i1 ON pi2.MASTER_RN = i1.RN7 '
+             'JOIN IMPORT7 i2 ON pi2.RN_PRNOM = i2.RN7 '
+             'WHERE i1.table7=\'INBASE\' AND i2.table7=\'NOBASE\' AND i2.rn8 != 17354601) s7 '
+             'JOIN '
+             '(SELECT INVS.RN rn8, INVS.PRN prn, INVS.NOMENCLATURE nomen, '
+             'ROW_NUMBER() OVER (PARTITION BY INVS.PRN, INVS.NOMENCLATURE ORDER BY INVS.RN) k '
+             'FROM INVSUBST INVS '
+             'WHERE INVS.NOMENCLATURE != 17354601) s8 '
+             'ON s7.prn = s8.prn AND s7.nomen = s8.nomen AND s7.k = s8.k')
+PAIRS_INSERT_SQL = ('insert into UDO_T_IMPORT7 '
+                    '(table7, rn7, rn8) '
+                    f'select \' INSOST \', p.rn7, p.rn8 from ({PAIRS_SQL}) p')
+
 
 def dir_path(string: str) -> str:
     """
@@ -47,74 +91,127 @@ def read_params(path: str) -> dict:
     return params
 
 
-def oracle_imp(instant_cli: str, host: str, service: str, authid: str, password: str) -> None:
-    oracledb.init_oracle_client(lib_dir=instant_cli)
-    connection = oracledb.connect(user=authid, password=password, host=host, port=1521, service_name=service)
+def oracle_imp(params: dict, csv: bool = False) -> None:
+    """
+    Collect tables INVSUBST and P7_INSOST (joined with IMPORT7) to columnar tables inv_subst and insost
+    :param params: dict with params (see read_params)
+    :param csv: also write csv files (for debugging)
+    """
+    with ora_session.connection(params) as connection:
+        with instrument.stage('query inv_subst') as record:
+            invsubst = ora_session.fetch_frame(connection, INVSUBST_SQL, ['RN', 'PRN', 'NOMEN'], DTYPE_INV_SUBST)
+            write_table(invsubst, '..\\.temp_files\\inv_subst', csv, DTYPE_INV_SUBST)
+            record.rows = len(invsubst)
 
-    with open('..\\.temp_files\\inv_subst.csv', 'w', newline='', encoding='UTF-8') as txt:
-        cursor = connection.cursor()
-        writer = csv.writer(txt, delimiter='@',
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['RN', 'PRN', 'NOMEN'])
-        invsubst = cursor.execute(
-            'SELECT INVS.RN, INVS.PRN, INVS.NOMENCLATURE '
-            'FROM INVSUBST INVS '
-            'WHERE INVS.NOMENCLATURE != 17354601'
-        )
-        for row in tqdm(invsubst):
-            writer.writerow(row)
-
-    with open('..\\.temp_files\\insost.csv', 'w', newline='', encoding='UTF-8') as txt:
-        cursor = connection.cursor()
-        writer = csv.writer(txt, delimiter='@',
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['RN7', 'PRN', 'NOMEN'])
-        insost = cursor.execute(
-            'select pi2.rn, i1.rn8, i2.rn8 from P7_INSOST pi2 '
-            'JOIN IMPORT7 i1 ON pi2.MASTER_RN = i1.RN7 '
-            'JOIN IMPORT7 i2 ON pi2.RN_PRNOM = i2.RN7 '
-            'WHERE i1.table7=\'INBASE\' AND i2.table7=\'NOBASE\' AND i2.rn8 != 17354601'
-        )
-        for row in tqdm(insost):
-            writer.writerow(row)
+        with instrument.stage('query insost') as record:
+            insost = ora_session.fetch_frame(connection, INSOST_SQL, ['RN7', 'PRN', 'NOMEN'], DTYPE_INSOST)
+            write_table(insost, '..\\.temp_files\\insost', csv, DTYPE_INSOST)
+            record.rows = len(insost)
 
     return None
 
 
-def oracle123(instant_cli: str, host: str, service: str, authid: str, password: str) -> None:
-    oracledb.init_oracle_client(lib_dir=instant_cli)
-    connection = oracledb.connect(user=authid, password=password, host=host, port=1521, service_name=service)
+def oracle123(params: dict, csv: bool = False) -> None:
+    """
+    Collect table INVPACK (joined with INVENTORY) to columnar table invpack
+    :param params: dict with params (see read_params)
+    :param csv: also write csv file (for debugging)
+    """
+    with ora_session.connection(params) as connection:
+        with instrument.stage('query invpack') as record:
+            invpack = ora_session.fetch_frame(connection, INVPACK_SQL, ['PRN', 'RN'], DTYPE_INVPACK)
+            write_table(invpack, '..\\.temp_files\\invpack', csv, DTYPE_INVPACK)
+            record.rows = len(invpack)
+    return None
 
-    with open('..\\.temp_files\\invpack.csv', 'w', newline='', encoding='UTF-8') as txt:
-        cursor = connection.cursor()
-        writer = csv.writer(txt, delimiter='@',
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['PRN', 'RN'])
-        invpack = cursor.execute(
-            'SELECT ip.rn, inv.rn FROM invpack ip JOIN INVENTORY inv ON ip.prn=inv.rn '
+
+def insost_pairs(invsubst: pd.DataFrame, insost: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pair RN7 of P7_INSOST with RN of INVSUBST by position inside every (PRN, NOMEN) group:
+    k-th insost row goes with k-th invsubst row, extra rows of the bigger group are dropped (as zip() does)
+    :param invsubst: inv_subst table (RN, PRN, NOMEN)
+    :param insost: insost table (RN7, PRN, NOMEN)
+    :return: pd.DataFrame with columns PRN, NOMEN, RN7, RN8, ordered by PRN, NOMEN and position
+    """
+    keys = ['PRN', 'NOMEN']
+    rn8 = invsubst.dropna(subset=keys)[keys + ['RN']]
+    rn8 = rn8.assign(K=rn8.groupby(keys, sort=False).cumcount())
+    rn7 = insost.dropna(subset=keys)[keys + ['RN7']]
+    rn7 = rn7.assign(K=rn7.groupby(keys, sort=False).cumcount())
+
+    pairs = rn7.merge(rn8, on=keys + ['K'], how='inner')
+    pairs = pairs.sort_values(keys + ['K'], kind='stable').rename(columns={'RN': 'RN8'})
+    return pairs[keys + ['RN7', 'RN8']].reset_index(drop=True)
+
+
+def insert_pairs(connection, pairs: pd.DataFrame, batch_size: int = 10000, commit: str = 'batch') -> int:
+    """
+    Insert pairs to UDO_T_IMPORT7 with bind variables, batch_size rows by one executemany
+    :param connection: DB-API connection
+    :param pairs: pd.DataFrame with columns RN7 (packed, see rn7_codec.pack), RN8 (see insost_pairs)
+    :param batch_size: rows in one executemany
+    :param commit: 'batch' - commit after every batch, 'run' - commit once after all batches
+    :return: number of inserted rows
+    """
+    cursor = connection.cursor()
+    rows = [{'table7': ' INSOST ', 'rn7': rn7, 'rn8': rn8}
+            for rn7, rn8 in zip(rn7_codec.unpack(pairs['RN7']).tolist(), pairs['RN8'].tolist())]
+
+    for start in tqdm(range(0, len(rows), batch_size), desc='Insert to UDO_T_IMPORT7'):
+        cursor.executemany(
+            'insert into UDO_T_IMPORT7 '
+            '(table7, rn7, rn8) '
+            'values '
+            '(:table7, :rn7, :rn8)',
+            rows[start:start + batch_size]
         )
-        for row in tqdm(invpack):
-            writer.writerow(row)
-        cursor.close()
-    connection.close()
-    return None
+        if commit == 'batch':
+            connection.commit()
+    if commit == 'run':
+        connection.commit()
+
+    cursor.close()
+    return len(rows)
 
 
-def dataframe_from_csv(csv_name: str) -> pd.DataFrame:
-    db = pd.read_csv(csv_name, delimiter='@', encoding='UTF-8')
-    return db
+def oracle_insert(params: dict, batch_size: int = 10000, commit: str = 'batch',
+                  dry_run: bool = False) -> pd.DataFrame:
+    """
+    Function that fills table UDO_T_IMPORT7 (table7 'INSOST') with pairs of RN7 and RN8
+    :param params: dict with params (see read_params)
+    :param batch_size: rows in one insert
+    :param commit: 'batch' - commit after every batch, 'run' - commit once
+    :param dry_run: don't touch database, only write pairs to udo_pairs.csv
+    :return: pd.DataFrame with pairs
+    """
+    with instrument.stage('insost_pairs') as record:
+        invsubst = read_table('..\\.temp_files\\inv_subst')
+        insost = read_table('..\\.temp_files\\insost')
+        pairs = insost_pairs(invsubst, insost)
+        record.rows = len(pairs)
+
+    if dry_run:
+        pairs.assign(RN7=rn7_codec.unpack(pairs['RN7'])).to_csv('..\\.temp_files\\udo_pairs.csv',
+                                                               sep='@', quotechar='|', index=False)
+        return pairs
 
+    with ora_session.connection(params) as connection:
+        create_udo(connection, params)
+        with instrument.stage('insert UDO_T_IMPORT7', len(pairs)):
+            insert_pairs(connection, pairs, batch_size, commit)
+    return pairs
 
-def oracle_insert(instant_cli: str, host: str, service: str, authid: str, password: str) -> None:
-    invsubst = dataframe_from_csv('..\\.temp_files\\inv_subst.csv')
-    insost = dataframe_from_csv('..\\.temp_files\\insost.csv')
 
-    oracledb.init_oracle_client(lib_dir=instant_cli)
-    connection = oracledb.connect(user=authid, password=password, host=host, port=1521, service_name=service)
+def create_udo(connection, params: dict) -> None:
+    """
+    Drop and create empty table UDO_T_IMPORT7
+    :param connection: DB-API connection
+    :param params: dict with params (see read_params)
+    """
     cursor = connection.cursor()
 
     cursor.execute(
-        f'drop table {authid}.UDO_T_IMPORT7'
+        f'drop table {params["authid"]}.UDO_T_IMPORT7'
     )
 
     cursor.execute(
@@ -123,35 +220,129 @@ def oracle_insert(instant_cli: str, host: str, service: str, authid: str, passwo
         ' RN7       varchar2(10),'
         ' RN8       NUMBER(17))'
     )
+    cursor.close()
 
-    for prn in tqdm(np.unique(invsubst.PRN, axis=0)):
-        prn_nom = np.unique(invsubst.loc[invsubst['PRN'] == prn, 'NOMEN'])
 
-        for nom in prn_nom:
-            rn7_s = list(insost.loc[(insost['PRN'] == prn) & (insost['NOMEN'] == nom), 'RN7'])
-            rn8_s = list(invsubst.loc[(invsubst['PRN'] == prn) & (invsubst['NOMEN'] == nom), 'RN'])
+def server_pairs(connection) -> pd.DataFrame:
+    """
+    Pairs of RN7 and RN8 made inside database (see PAIRS_SQL), for dry run and parity check
+    :param connection: DB-API connection
+    :return: pd.DataFrame with columns PRN, NOMEN, RN7, RN8, ordered as insost_pairs() result
+    """
+    return ora_session.fetch_frame(connection, f'{PAIRS_SQL} ORDER BY s7.prn, s7.nomen, s7.k',
+                                   ['PRN', 'NOMEN', 'RN7', 'RN8'], DTYPE_PAIRS)
 
-            # print(rn7_s, len(rn7_s))
-            # print(rn8_s, len(rn8_s), '\n')
-            for rn7, rn8 in zip(rn7_s, rn8_s):
-                cursor.execute(
-                    'insert into UDO_T_IMPORT7 '
-                    '(table7, rn7, rn8) '
-                    'values '
-                    '( \' INSOST \' ,' + '\'' + rn7 + '\'' + ',' + str(rn8) + ')'
-                )
-                connection.commit()
 
-    cursor.close()
-    connection.close()
+def oracle_pushdown(params: dict, dry_run: bool = False) -> int:
+    """
+    Fill table UDO_T_IMPORT7 (table7 'INSOST') with pairs of RN7 and RN8 by one INSERT ... SELECT:
+    pairs are made inside database (see PAIRS_SQL), no rows are sent to or from client
+    :param params: dict with params (see read_params)
+    :param dry_run: don't touch UDO_T_IMPORT7, only write pairs to udo_pairs.csv
+    :return: number of pairs
+    """
+    with ora_session.connection(params) as connection:
+        if dry_run:
+            pairs = server_pairs(connection)
+            pairs.assign(RN7=rn7_codec.unpack(pairs['RN7'])).to_csv('..\\.temp_files\\udo_pairs.csv',
+                                                                   sep='@', quotechar='|', index=False)
+            return len(pairs)
+
+        create_udo(connection, params)
+        with instrument.stage('insert UDO_T_IMPORT7 (pushdown)') as record:
+            cursor = connection.cursor()
+            cursor.execute(PAIRS_INSERT_SQL)
+            record.rows = cursor.rowcount
+            cursor.close()
+            connection.commit()
+    return record.rows
+
+
+def fill_udo(params: dict, batch_size: int = 10000, commit: str = 'batch', dry_run: bool = False,
+             csv: bool = False, pushdown: bool = False) -> int:
+    """
+    Fill table UDO_T_IMPORT7: by one INSERT ... SELECT inside database (pushdown), or with pairs made on client
+    (oracle_imp and oracle_insert). Client pairing is also the fallback, if pushdown statement fails
+    :param params: dict with params (see read_params)
+    :param batch_size: rows in one insert (client pairing)
+    :param commit: 'batch' - commit after every batch, 'run' - commit once (client pairing)
+    :param dry_run: don't touch UDO_T_IMPORT7, only write pairs to udo_pairs.csv
+    :param csv: also write extracted tables to csv files (client pairing)
+    :param pushdown: make pairs inside database
+    :return: number of pairs
+    """
+    if pushdown:
+        try:
+            return oracle_pushdown(params, dry_run)
+        except Exception as e:
+            print(f'Pushdown failed ({type(e).__name__}: {e}), pairs are made on client')
+
+    oracle_imp(params, csv=csv)
+    return len(oracle_insert(params, batch_size=batch_size, commit=commit, dry_run=dry_run))
+
+
+def pair_diff(client: pd.DataFrame, server: pd.DataFrame) -> pd.DataFrame:
+    """
+    Difference of two pairings (repeated pairs are compared by count)
+    :param client: pairs of insost_pairs()
+    :param server: pairs of server_pairs()
+    :return: pd.DataFrame with columns PRN, NOMEN, RN7, RN8, SIDE ('client' or 'server' - side, that has pair)
+             empty if pairings are the same
+    """
+    keys = ['PRN', 'NOMEN', 'RN7', 'RN8']
+    client = client[keys].assign(RN7=rn7_codec.unpack(client['RN7']))
+    server = server[keys].assign(RN7=rn7_codec.unpack(server['RN7']))
+    client = client.assign(N=client.groupby(keys, sort=False).cumcount())
+    server = server.assign(N=server.groupby(keys, sort=False).cumcount())
+
+    diff = client.merge(server, on=keys + ['N'], how='outer', indicator=True)
+    diff = diff[diff['_merge'] != 'both']
+    diff = diff.assign(SIDE=diff['_merge'].map({'left_only': 'client', 'right_only': 'server'}).astype(str))
+    return diff[keys + ['SIDE']].sort_values(keys, kind='stable').reset_index(drop=True)
+
+
+def pairing_parity(params: dict) -> pd.DataFrame:
+    """
+    Compare pairs made on client (insost_pairs over INVSUBST_SQL and INSOST_SQL) with pairs made inside
+    database (PAIRS_SQL). Nothing is written to database, difference goes to udo_parity.csv
+    Works with sqlite stand-in (params['sqlite']) as well as with oracle db
+    :param params: dict with params (see read_params)
+    :return: difference of pairings (see pair_diff), empty if they are the same
+    """
+    with ora_session.connection(params) as connection:
+        with instrument.stage('parity client') as record:
+            invsubst = ora_session.fetch_frame(connection, INVSUBST_SQL, ['RN', 'PRN', 'NOMEN'], DTYPE_INV_SUBST)
+            insost = ora_session.fetch_frame(connection, INSOST_SQL, ['RN7', 'PRN', 'NOMEN'], DTYPE_INSOST)
+            client = insost_pairs(invsubst, insost)
+            record.rows = len(client)
+        with instrument.stage('parity server') as record:
+            server = server_pairs(connection)
+            record.rows = len(server)
+
+    diff = pair_diff(client, server)
+    diff.to_csv('..\\.temp_files\\udo_parity.csv', sep='@', quotechar='|', index=False)
+    print(f'Client pairs: {len(client)}, server pairs: {len(server)}, '
+          f'only on client: {(diff["SIDE"] == "client").sum()}, only on server: {(diff["SIDE"] == "server").sum()}')
+    return diff
 
 
 def main(args):
     PARAMS_PATH = args.path
     params = read_params(PARAMS_PATH)
-
-    oracle_imp(params['cli'], params['host'],  params['service'], params['authid'], params['password'])
-    oracle_insert(params['cli'], params['host'],  params['service'], params['authid'], params['password'])
+    params['sqlite'] = args.sqlite
+    params['thin'] = args.thin
+    instrument.configure(profile=args.profile, trace_malloc=args.trace_malloc)
+
+    failed = 0
+    if args.parity:
+        # Count of different pairs is printed by pairing_parity, exit status is only 0 or 1
+        failed = 0 if pairing_parity(params).empty else 1
+    else:
+        fill_udo(params, batch_size=args.batch_size, commit=args.commit, dry_run=args.dry_run, csv=args.csv,
+                 pushdown=args.pushdown)
+    ora_session.close_pool()
+    instrument.write_report(args.report, 'invs_test')
+    return failed
 
 
 if __name__ == '__main__':
@@ -162,5 +353,30 @@ if __name__ == '__main__':
                                    'DBF\'s files')
     parser.add_argument('--path', type=dir_path, default='./pars.txt', required=False,
                         help='Path to *.txt file with all neaded parameters\n (See example.txt)')
+    parser.add_argument('--batch-size', type=int, default=10000, required=False,
+                        help='Rows inserted to UDO_T_IMPORT7 by one statement')
+    parser.add_argument('--commit', choices=['batch', 'run'], default='batch', required=False,
+                        help='Commit after every batch or once after all rows')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Don\'t insert anything, write pairs to udo_pairs.csv')
+    parser.add_argument('--pushdown', action='store_true',
+                        help='Pair RN7 and RN8 inside database by one INSERT ... SELECT '
+                             '(pairing on client is used, if it fails)')
+    parser.add_argument('--parity', action='store_true',
+                        help='Don\'t insert anything, compare pairing on client with pairing inside database, '
+                             'difference is written to udo_parity.csv')
+    parser.add_argument('--csv', action='store_true',
+                        help='Also write extracted tables to csv files (for debugging)')
+    parser.add_argument('--thin', action='store_true',
+                        help='Connect to oracle db in thin mode (without Oracle_instantClient)')
+    parser.add_argument('--sqlite', type=dir_path, default=None, required=False,
+                        help='Path to sqlite db with the same tables, used instead of oracle db')
+    parser.add_argument('--report', type=str, default='..\\.log_files\\report_invs_test.json', required=False,
+                        help='JSON report of run: wall and CPU time, rows, rows/sec and peak memory of every stage')
+    parser.add_argument('--profile', type=str, default=None, required=False,
+                        help='Run one stage under cProfile (stage name from report, e.g. insost_pairs), '
+                             'dump is written to ..\\.log_files\\<stage>.prof')
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help='Record python memory high-water mark of stages (tracemalloc, slows down run)')
     args = parser.parse_args()
-    main(args)
+    raise SystemExit(main(args))
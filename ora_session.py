@@ -0,0 +1,158 @@
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+import pandas as pd
+from tqdm import tqdm
+
+from columnar import to_array, concat_arrays
+from rn7_codec import CHARSET
+
+
+# Oracle client is initialized and connection pool is created once per process,
+# all query and insert functions take connections from that pool
+_LOCK = threading.Lock()
+_CLIENT_READY = False
+_POOL = None
+
+
+def init_client(instant_cli: str, thin: bool = False) -> None:
+    """
+    Initialize oracle instant client (thick mode) once, nothing to do in thin mode
+    :param instant_cli: path to oracle_instantclient folder
+    :param thin: use python-oracledb thin mode (no instant client)
+    """
+    global _CLIENT_READY
+    import oracledb     # imported by oracle stages only (sqlite stand-in and light stages don't need it)
+
+    with _LOCK:
+        if not thin and not _CLIENT_READY:
+            oracledb.init_oracle_client(lib_dir=instant_cli)
+            _CLIENT_READY = True
+
+
+def get_pool(params: dict, stmtcachesize: int = 40) -> 'oracledb.ConnectionPool':
+    """
+    Return shared connection pool, create it on the first call
+    :param params: dict with params (see read_params),
+                   optional 'thin' - use thin mode, 'pool_size' - max connections in pool (default 4)
+    :param stmtcachesize: statements cached by every pooled connection
+    :return: oracledb.ConnectionPool object
+    """
+    global _POOL
+    import oracledb
+
+    init_client(params['cli'], params.get('thin', False))
+    with _LOCK:
+        if _POOL is None:
+            _POOL = oracledb.create_pool(user=params['authid'], password=params['password'], host=params['host'],
+                                         port=1521, service_name=params['service'],
+                                         min=1, max=params.get('pool_size', 4), increment=1,
+                                         stmtcachesize=stmtcachesize)
+        return _POOL
+
+
+def close_pool() -> None:
+    """
+    Close shared connection pool (at the end of run)
+    """
+    global _POOL
+    with _LOCK:
+        if _POOL is not None:
+            _POOL.close(force=True)
+            _POOL = None
+
+
+def sqlite_connect(path: str) -> sqlite3.Connection:
+    """
+    Connect to local sqlite db with the same tables as oracle db (stand-in for tests)
+    Oracle functions LPAD, ASCII and ORA_HASH, used by queries, are registered in connection
+    :param path: path to sqlite db file
+    :return: sqlite3.Connection object
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.create_function('ASCII', 1, _ascii, deterministic=True)
+    connection.create_function('LPAD', 3, _lpad, deterministic=True)
+    connection.create_function('ORA_HASH', 1, _ora_hash, deterministic=True)
+    return connection
+
+
+def _ascii(value):
+    """
+    Service function, oracle ASCII() for sqlite: code of the first char in database charset
+    """
+    return value[0].encode(CHARSET)[0] if value else None
+
+
+def _lpad(value, length: int, pad: str):
+    """
+    Service function, oracle LPAD() for sqlite
+    """
+    if value is None:
+        return None
+    value = str(value)
+    return value[:length] if len(value) >= length else value.rjust(length, pad)
+
+
+def _ora_hash(value):
+    """
+    Service function, oracle ORA_HASH() for sqlite (other hash function with the same range 0 .. 2^32 - 1)
+    """
+    if value is None:
+        return None
+    return zlib.crc32(str(value).encode('utf-8'))
+
+
+@contextmanager
+def connection(params: dict):
+    """
+    Connection to database: from shared oracle pool or to sqlite stand-in (if params['sqlite'] is set)
+    Connection is returned to pool (sqlite connection is closed) on exit
+    :param params: dict with params (see read_params)
+    """
+    if params.get('sqlite'):
+        conn = sqlite_connect(params['sqlite'])
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    pool = get_pool(params)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def fetch_frame(connection, sql: str, columns: list, dtype: dict, arraysize: int = 50000) -> pd.DataFrame:
+    """
+    Execute query and fetch result to pd.DataFrame in batches of arraysize rows
+    :param connection: DB-API connection (oracledb, sqlite3)
+    :param sql: query
+    :param columns: names of query columns
+    :param dtype: column -> dtype
+    :param arraysize: rows fetched in one round-trip
+    :return: pd.DataFrame object
+    """
+    cursor = connection.cursor()
+    cursor.arraysize = arraysize
+    if hasattr(cursor, 'prefetchrows'):
+        cursor.prefetchrows = arraysize + 1
+    cursor.execute(sql)
+
+    # Every batch is converted to typed arrays at once, so only one batch of rows is kept as python objects
+    data = [[] for _ in columns]
+    with tqdm(desc=f'Fetch {columns}', unit=' rows') as bar:
+        while True:
+            rows = cursor.fetchmany(arraysize)
+            if not rows:
+                break
+            for arrays, name, column in zip(data, columns, zip(*rows)):
+                arrays.append(to_array(column, dtype[name]))
+            bar.update(len(rows))
+    cursor.close()
+
+    return pd.DataFrame({name: concat_arrays(arrays, dtype[name]) for name, arrays in zip(columns, data)})
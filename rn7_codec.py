@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+
+
+# Shtrih code of RN7: 3 digits of character code for every char of RN7 (same as
+# LPAD(ASCII(SUBSTR(RN7, n, 1)), 3, '0') || ... in oracle), e.g. '0A' -> '048065'
+# ASCII() returns code of char in database charset, so RN7 is encoded to it first (convert7 used ord(),
+# that is the same only for ASCII chars)
+CHARSET = 'cp1251'      # database charset of parus-7 (CL8MSWIN1251)
+DIGITS = 3
+MAX_VALUE_CHARS = 6     # code of longer RN7 doesn't fit int64
+
+# Packed RN7: up to 7 chars (bytes in CHARSET) in one int64, the first char in the highest byte, 0 for null
+PACKED_CHARS = 7
+
+
+def _charset_tables() -> tuple:
+    """
+    Service function, lookup tables of CHARSET: char code (< 65536) -> byte (-1 if char is not in CHARSET)
+    and byte -> char code (-1 if byte is undefined)
+    """
+    to_byte = np.full(0x10000, -1, dtype=np.int16)
+    to_char = np.full(256, -1, dtype=np.int64)
+    to_byte[0], to_char[0] = 0, 0
+    for byte in range(1, 256):
+        try:
+            char = ord(bytes([byte]).decode(CHARSET))
+        except UnicodeDecodeError:
+            continue
+        to_byte[char], to_char[byte] = byte, char
+    return to_byte, to_char
+
+
+_TO_BYTE, _TO_CHAR = _charset_tables()
+
+
+def pack(column) -> np.ndarray:
+    """
+    Pack RN7 column to int64 values (compact representation of RN7 in tables, see columnar.py)
+    :param column: sequence of str (None / NaN for null)
+    :return: int64 array, 0 for null
+    """
+    raw, mask = rn7_array(column)
+    codes = char_codes(raw)
+    if codes.shape[1] > PACKED_CHARS and codes[:, PACKED_CHARS:].any():
+        raise ValueError(f'RN7 longer than {PACKED_CHARS} chars can\'t be packed')
+
+    packed = np.zeros(len(raw), dtype=np.int64)
+    for i in range(min(codes.shape[1], PACKED_CHARS)):
+        packed |= codes[:, i].astype(np.int64) << (8 * (PACKED_CHARS - 1 - i))
+    packed[mask] = 0
+    return packed
+
+
+def unpack(packed) -> np.ndarray:
+    """
+    Unpack int64 values back to RN7
+    :param packed: int64 array (see pack)
+    :return: np.ndarray of dtype 'U<width>', empty for null
+    """
+    raw, mask = rn7_array(np.asarray(packed, dtype=np.int64))
+    return text(raw)
+
+
+def text(raw: np.ndarray) -> np.ndarray:
+    """
+    Service function, decode fixed-width bytes array from CHARSET
+    :param raw: np.ndarray of dtype 'S<width>'
+    :return: np.ndarray of dtype 'U<width>'
+    """
+    if raw.dtype.itemsize == 0 or not len(raw):
+        raw = raw.astype('S1')
+    chars = _TO_CHAR[char_codes(raw)]
+    if (chars < 0).any():
+        raise ValueError(f'RN7 has byte, that is undefined in {CHARSET}')
+    return np.ascontiguousarray(chars.astype(np.uint32)).view(f'U{raw.dtype.itemsize}').ravel()
+
+
+def _packed_codes(packed: np.ndarray) -> np.ndarray:
+    """
+    Service function, character codes of packed RN7 (0 for padding)
+    :param packed: int64 array
+    :return: np.ndarray (rows x 7) of uint8
+    """
+    shifts = 8 * (PACKED_CHARS - 1 - np.arange(PACKED_CHARS))
+    return np.ascontiguousarray((packed[:, None] >> shifts) & 0xFF).astype(np.uint8)
+
+
+def rn7_array(column) -> tuple:
+    """
+    Service function, RN7 column as fixed-width bytes array in CHARSET and null mask
+    :param column: sequence of str (None / NaN for null) or packed int64 values (see pack)
+    :return: (np.ndarray of dtype 'S<width>', mask)
+    """
+    if isinstance(column, (np.ndarray, pd.Series, pd.api.extensions.ExtensionArray)) \
+            and pd.api.types.is_integer_dtype(column.dtype):
+        packed = pd.array(column, dtype=pd.Int64Dtype())
+        packed, mask = packed.to_numpy(dtype=np.int64, na_value=0), np.asarray(packed.isna())
+        raw = _packed_codes(packed).view(f'S{PACKED_CHARS}').ravel()
+        return raw, mask | (packed == 0)
+
+    values = pd.Series(column, dtype=object)
+    mask = np.asarray(values.isna())
+    strings = np.asarray(values.fillna(''), dtype=str)
+    if strings.dtype.itemsize == 0 or not len(strings):
+        strings = strings.astype('U1')
+    chars = strings.view(np.uint32).reshape(len(strings), strings.dtype.itemsize // 4)
+    codes = _TO_BYTE[np.minimum(chars, 0xFFFF)]
+    bad = (codes < 0) | (chars > 0xFFFF)
+    if bad.any():
+        raise ValueError(f'RN7 {str(strings[bad.any(axis=1)][0])!r} has char, that is not in {CHARSET}')
+    return np.ascontiguousarray(codes.astype(np.uint8)).view(f'S{codes.shape[1]}').ravel(), mask
+
+
+def char_codes(raw: np.ndarray) -> np.ndarray:
+    """
+    Service function, character codes of fixed-width bytes array (0 for padding)
+    :param raw: np.ndarray of dtype 'S<width>'
+    :return: np.ndarray (rows x width) of uint8
+    """
+    return raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize)
+
+
+def encode(column) -> np.ndarray:
+    """
+    Encode RN7 column to shtrih codes (3 digits for every char)
+    :param column: sequence of str (None / NaN for null) or packed int64 values
+    :return: np.ndarray of dtype 'S<3 * width>', empty for null
+    """
+    raw, mask = rn7_array(column)
+    codes = char_codes(raw)
+    digits = np.stack([codes // 100, codes // 10 % 10, codes % 10], axis=2) + ord('0')
+    digits[codes == 0] = 0
+    digits[mask] = 0
+    width = codes.shape[1] * DIGITS
+    return digits.astype(np.uint8).reshape(len(raw), width).view(f'S{width}').ravel()
+
+
+def decode(codes) -> np.ndarray:
+    """
+    Decode shtrih codes back to RN7
+    :param codes: sequence of digit strings (bytes or str), length divisible by 3
+    :return: np.ndarray of dtype 'U<width>', empty for empty code
+    """
+    raw = np.asarray(codes, dtype=bytes)
+    width = max(raw.dtype.itemsize // DIGITS, 1)
+    raw = raw.astype(f'S{width * DIGITS}')
+    lengths = np.char.str_len(raw)
+    if (lengths % DIGITS).any():
+        raise ValueError(f'shtrih code {raw[(lengths % DIGITS) != 0][0]!r} has length not divisible by {DIGITS}')
+
+    digits = raw.view(np.uint8).reshape(len(raw), width, DIGITS).astype(np.uint32)
+    padding = digits[:, :, 0] == 0
+    digits -= ord('0')
+    if ((digits > 9) & ~padding[:, :, None]).any():
+        raise ValueError('shtrih code has not digit characters')
+    chars = digits[:, :, 0] * 100 + digits[:, :, 1] * 10 + digits[:, :, 2]
+    chars[padding] = 0
+    if (chars > 255).any():
+        raise ValueError('shtrih code has char code bigger than 255')
+    return text(np.ascontiguousarray(chars.astype(np.uint8)).view(f'S{width}').ravel())
+
+
+def value(column, drop_first: bool = False) -> pd.arrays.IntegerArray:
+    """
+    Shtrih code of RN7 as number, without building digit strings
+    :param column: sequence of str (None / NaN for null) or packed int64 values
+    :param drop_first: drop the first digit of code (same as code[1:], for import7 SRN7)
+    :return: Int64 array, null for null RN7
+    """
+    raw, mask = rn7_array(column)
+    codes = char_codes(raw).astype(np.int64)
+    if codes.shape[1] > MAX_VALUE_CHARS:
+        if codes[:, MAX_VALUE_CHARS:].any():
+            raise ValueError(f'shtrih code of RN7 longer than {MAX_VALUE_CHARS} chars doesn\'t fit int64')
+        codes = codes[:, :MAX_VALUE_CHARS]
+
+    result = np.zeros(len(raw), dtype=np.int64)
+    length = np.zeros(len(raw), dtype=np.int64)
+    for i in range(codes.shape[1]):
+        present = codes[:, i] > 0
+        result = np.where(present, result * 10 ** DIGITS + codes[:, i], result)
+        length += present
+    if drop_first:
+        result %= 10 ** np.maximum(length * DIGITS - 1, 0)
+    return pd.arrays.IntegerArray(result, mask | (length == 0))
@@ -0,0 +1,56 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    """
+    Numpy arrays copied to shared memory blocks, to be attached by worker processes without pickling
+    Blocks live until close() (call it when workers are finished)
+    """
+
+    def __init__(self):
+        self._blocks = []
+
+    def share(self, array: np.ndarray) -> tuple:
+        """
+        Copy array to new shared memory block
+        :param array: np.ndarray (numeric or bool)
+        :return: descriptor (block name, shape, dtype), see attach
+        """
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return block.name, array.shape, array.dtype.str
+
+    def empty(self, shape, dtype) -> tuple:
+        """
+        Create zero-filled array in new shared memory block (for results written by workers)
+        :param shape: array shape
+        :param dtype: array dtype
+        :return: descriptor (block name, shape, dtype), see attach
+        """
+        return self.share(np.zeros(shape, dtype=dtype))
+
+    def close(self) -> None:
+        """
+        Release and remove all blocks
+        """
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+def attach(descriptor: tuple, keep: list) -> np.ndarray:
+    """
+    Attach to array in shared memory block
+    :param descriptor: (block name, shape, dtype), see SharedArrays.share
+    :param keep: list, where block object is stored (array is valid while block is referenced)
+    :return: np.ndarray over shared memory
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    keep.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import datetime
+from argparse import ArgumentParser
+
+# Only standard library is imported here: pandas, numpy, oracledb, etc. are imported by stages that need them
+# (through arb_shtrih and invs_test), so --help and status start at once
+
+
+# Stage tables and checkpoints of subcommand runs
+STAGE_DIR = '..\\.temp_files\\stages'
+RESULT = '..\\.result\\NEW_InvSoot.dbf'
+
+STAGES = ('extract-dbf', 'extract-oracle', 'map', 'writeback')
+
+
+def dir_path(string: str) -> str:
+    """
+    Service function, that checking if passed argument is correct
+    :param string: input path parameter
+    :return: input string, if it's correct
+    """
+    if os.path.isfile(string):
+        return string
+    raise NotADirectoryError(string)
+
+
+def stage_table(name: str) -> str:
+    """
+    Service function, path to stage table (columnar table, see columnar.py)
+    :param name: table name (InvSoot7, import7, mapped, ...)
+    :return: path without extension
+    """
+    return os.path.join(STAGE_DIR, name)
+
+
+def file_fingerprint(path: str) -> dict:
+    """
+    Short description of file or folder state: size and mtime (the latest of folder files)
+    :param path: path to file or folder
+    :return: dict, None if path doesn't exist
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, i) for i in sorted(os.listdir(path))]
+        stats = [os.stat(i) for i in files if os.path.isfile(i)]
+        return {'path': os.path.abspath(path), 'size': sum(i.st_size for i in stats),
+                'mtime': max((i.st_mtime_ns for i in stats), default=0), 'files': len(stats)}
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    return None
+
+
+def table_fingerprint(name: str) -> dict:
+    """
+    Service function, fingerprint of stage table (see file_fingerprint)
+    :param name: table name
+    :return: dict, None if table doesn't exist
+    """
+    return file_fingerprint(stage_table(name) + '.cols')
+
+
+def checkpoint_path(stage: str) -> str:
+    """
+    Service function, path to checkpoint manifest of stage
+    """
+    return os.path.join(STAGE_DIR, f'{stage}.json')
+
+
+def read_checkpoint(stage: str) -> dict:
+    """
+    Checkpoint manifest of the last successful run of stage
+    :param stage: stage name
+    :return: dict with stage, inputs, outputs, finished and wall, None if stage wasn't finished
+    """
+    try:
+        with open(checkpoint_path(stage), 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(stage: str, inputs: dict, outputs: dict, wall: float) -> dict:
+    """
+    Write checkpoint manifest of finished stage (through temporary file and atomic rename)
+    :param stage: stage name
+    :param inputs: fingerprints of stage inputs
+    :param outputs: fingerprints of stage outputs
+    :param wall: stage time, seconds
+    :return: checkpoint
+    """
+    checkpoint = {'stage': stage,
+                  'inputs': inputs,
+                  'outputs': outputs,
+                  'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'wall': round(wall, 4)}
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    with open(checkpoint_path(stage) + '.tmp', 'w', encoding='UTF-8') as f:
+        json.dump(checkpoint, f, indent=1, default=str)
+    os.replace(checkpoint_path(stage) + '.tmp', checkpoint_path(stage))
+    return checkpoint
+
+
+def is_done(stage: str, inputs: dict) -> bool:
+    """
+    Service function, stage is finished with the same inputs and its outputs weren't changed since
+    :param stage: stage name
+    :param inputs: current fingerprints of stage inputs
+    :return: bool
+    """
+    checkpoint = read_checkpoint(stage)
+    if checkpoint is None or checkpoint['inputs'] != json.loads(json.dumps(inputs, default=str)):
+        return False
+    return all(output is not None and file_fingerprint(output['path']) == output
+               for output in checkpoint['outputs'].values())
+
+
+def upstream(*stages) -> dict:
+    """
+    Service function, outputs of finished stages as inputs of next stage
+    :param stages: stage names
+    :return: dict stage -> outputs (None for not finished stage)
+    """
+    return {stage: (read_checkpoint(stage) or {}).get('outputs') for stage in stages}
+
+
+def session(args) -> dict:
+    """
+    Service function, params of pars.txt with database session options (see arb_shtrih.session_params)
+    """
+    from arb_shtrih import read_params, session_params
+    return session_params(read_params(args.path), args)
+
+
+# Every stage: inputs(params, args) -> dict of input fingerprints, run(params, args) -> dict of output fingerprints
+
+def extract_dbf_inputs(params: dict, args) -> dict:
+    from dbf_mmap import dbf_fingerprint
+    return {'InvSoot7': dbf_fingerprint(params['dbf7'] + '\\InvSoot.dbf'),
+            'InvSoot8': dbf_fingerprint(params['dbf8'] + '\\InvSoot.dbf')}
+
+
+def extract_dbf(params: dict, args) -> dict:
+    """
+    Extract InvSoot.dbf files of parus-7 and parus-8 to stage tables InvSoot7 and InvSoot8
+    """
+    from arb_shtrih import extract
+    from columnar import write_table
+
+    names = ('InvSoot7', 'InvSoot8')
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    for name, db in zip(names, extract(params, args, names)):
+        write_table(db, stage_table(name))
+    return {name: table_fingerprint(name) for name in names}
+
+
+def extract_oracle_inputs(params: dict, args) -> dict:
+    import ora_session
+    from arb_shtrih import table_fingerprint as db_fingerprint, IMPORT7_FINGERPRINT_SQL, UDO_IMPORT7_FINGERPRINT_SQL
+
+    with ora_session.connection(params) as connection:
+        return {'database': params.get('sqlite') or f'{params["host"]}/{params["service"]}',
+                'import7': db_fingerprint(connection, IMPORT7_FINGERPRINT_SQL),
+                'udo_import7': db_fingerprint(connection, UDO_IMPORT7_FINGERPRINT_SQL)}
+
+
+def extract_oracle(params: dict, args) -> dict:
+    """
+    Extract tables import7 and udo_import7 to stage tables
+    """
+    from arb_shtrih import extract
+    from columnar import write_table
+
+    names = ('import7', 'udo_import7')
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    for name, db in zip(names, extract(params, args, names)):
+        write_table(db, stage_table(name))
+    return {name: table_fingerprint(name) for name in names}
+
+
+def map_inputs(params: dict, args) -> dict:
+    return {**upstream('extract-dbf', 'extract-oracle'), 'max_code': args.max_code, 'duplicates': args.duplicates}
+
+
+def map_codes(params: dict, args) -> dict:
+    """
+    Map InvSoot8 codes on stage tables (see arb_shtrih.process), result is stage table mapped (IRN, KRN, CODE)
+    """
+    import instrument
+    from arb_shtrih import process, code_allocator
+    from columnar import read_table, write_table
+    from diagnostics import Diagnostics
+
+    db7, db8, db_imp, invsubst = (read_table(stage_table(name))
+                                  for name in ('InvSoot7', 'InvSoot8', 'import7', 'udo_import7'))
+    diagnostics = Diagnostics(jsonl=args.log_jsonl, verbosity=args.verbosity, background=True)
+    with instrument.stage('process', len(db8)):
+        allocator = code_allocator(args, db7, db8)
+        result_db = process(db7, db8, db_imp, invsubst, diagnostics, args.map_workers, allocator=allocator)
+        diagnostics.close()
+    allocator.write_report(args.conflicts)
+    print(f'Outcomes: {diagnostics.summary()}')
+    print(f'Codes: {allocator.summary()}')
+    allocator.close()
+
+    write_table(result_db[['IRN', 'KRN', 'CODE']], stage_table('mapped'))
+    return {'mapped': table_fingerprint('mapped')}
+
+
+def writeback_inputs(params: dict, args) -> dict:
+    return {**upstream('map'), 'output': os.path.abspath(args.output)}
+
+
+def writeback(params: dict, args) -> dict:
+    """
+    Write mapped codes to copy of InvSoot8 dbf file (see arb_shtrih.patch_codes)
+    """
+    import instrument
+    from arb_shtrih import patch_codes
+    from columnar import read_table
+
+    result_db = read_table(stage_table('mapped'))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with instrument.stage('write_back', len(result_db)):
+        patch_codes(params['dbf8'] + '\\InvSoot.dbf', args.output, result_db)
+    return {'output': file_fingerprint(args.output)}
+
+
+def load_udo_inputs(params: dict, args) -> dict:
+    import ora_session
+    from arb_shtrih import table_fingerprint as db_fingerprint
+    from invs_test import INVSUBST_FINGERPRINT_SQL, INSOST_FINGERPRINT_SQL
+
+    with ora_session.connection(params) as connection:
+        return {'database': params.get('sqlite') or f'{params["host"]}/{params["service"]}',
+                'inv_subst': db_fingerprint(connection, INVSUBST_FINGERPRINT_SQL),
+                'insost': db_fingerprint(connection, INSOST_FINGERPRINT_SQL),
+                'dry_run': args.dry_run, 'pushdown': args.pushdown}
+
+
+def load_udo(params: dict, args) -> dict:
+    """
+    Fill UDO_T_IMPORT7 with pairs of RN7 and RN8 (see invs_test.fill_udo)
+    Output is database table, so it has no fingerprint: the stage is done while its source tables are the same
+    """
+    from invs_test import fill_udo
+
+    pairs = fill_udo(params, batch_size=args.batch_size, commit=args.commit, dry_run=args.dry_run, csv=args.csv,
+                     pushdown=args.pushdown)
+    print(f'{pairs} pairs {"written to udo_pairs.csv" if args.dry_run else "inserted to UDO_T_IMPORT7"}')
+    return {}
+
+
+HANDLERS = {'extract-dbf': (extract_dbf_inputs, extract_dbf),
+            'extract-oracle': (extract_oracle_inputs, extract_oracle),
+            'map': (map_inputs, map_codes),
+            'writeback': (writeback_inputs, writeback),
+            'load-udo': (load_udo_inputs, load_udo)}
+
+
+def run_stage(stage: str, params: dict, args, resume: bool = False) -> bool:
+    """
+    Run one stage and write its checkpoint
+    :param stage: stage name (see HANDLERS)
+    :param params: dict with params (see session)
+    :param args: command line arguments
+    :param resume: skip stage, if it's finished with the same inputs (see is_done)
+    :return: True if stage was run, False if it was skipped
+    """
+    inputs_of, run = HANDLERS[stage]
+    inputs = inputs_of(params, args)
+    if resume and is_done(stage, inputs):
+        print(f'{stage}: skipped, inputs are the same as of run {read_checkpoint(stage)["finished"]}')
+        return False
+
+    started = time.perf_counter()
+    outputs = run(params, args)
+    write_checkpoint(stage, inputs, outputs, time.perf_counter() - started)
+    print(f'{stage}: done in {time.perf_counter() - started:.2f} s')
+    return True
+
+
+def status(args) -> int:
+    """
+    Print checkpoints of stages (without heavy imports)
+    """
+    for stage in ('load-udo',) + STAGES:
+        checkpoint = read_checkpoint(stage)
+        if checkpoint is None:
+            print(f'{stage}: not finished')
+        else:
+            print(f'{stage}: finished {checkpoint["finished"]} in {checkpoint["wall"]} s')
+    return 0
+
+
+def main(args) -> int:
+    """
+    Main function, run subcommand
+    :param args: command line arguments
+    :return: exit code
+    """
+    if args.command == 'status':
+        return status(args)
+
+    import instrument
+    import ora_session
+
+    instrument.configure(profile=args.profile, trace_malloc=args.trace_malloc)
+    params = session(args)
+    try:
+        if args.command == 'run':
+            stages = (('load-udo',) if args.load_udo else ()) + STAGES
+            for stage in stages:
+                run_stage(stage, params, args, args.resume)
+        else:
+            run_stage(args.command, params, args)
+    finally:
+        ora_session.close_pool()
+    instrument.write_report(args.report, f'shtrih_cli {args.command}')
+    return 0
+
+
+def build_parser() -> ArgumentParser:
+    common = ArgumentParser(add_help=False)
+    common.add_argument('--path', type=dir_path, default='./pars.txt', required=False,
+                        help='Path to *.txt file with all neaded parameters\n (See example.txt)')
+    common.add_argument('--sqlite', type=dir_path, default=None, required=False,
+                        help='Path to sqlite db with the same tables, used instead of oracle db')
+    common.add_argument('--thin', action='store_true',
+                        help='Connect to oracle db in thin mode (without Oracle_instantClient)')
+    common.add_argument('--arraysize', type=int, default=50000, required=False,
+                        help='Rows fetched from database in one round-trip')
+    common.add_argument('--workers', type=int, default=1, required=False,
+                        help='Run extract stages concurrently on N threads')
+    common.add_argument('--map-workers', type=int, default=1, required=False,
+                        help='Map InvSoot8 rows on N processes (rows are partitioned by IRN hash)')
+    common.add_argument('--output', type=str, default=RESULT, required=False,
+                        help='Result dbf file of writeback')
+    common.add_argument('--max-code', type=int, default=14641, required=False,
+                        help='Generated codes are \'000\' + number, numbers start after max code '
+                             '(codes used in InvSoot7 and InvSoot8 are skipped)')
+    common.add_argument('--duplicates', choices=['allocate', 'keep'], default='allocate', required=False,
+                        help='InvSoot7 code found for several rows: the first row gets it, next rows get free codes '
+                             '(allocate) or keep old codes (keep)')
+    common.add_argument('--conflicts', type=str, default='..\\.log_files\\code_conflicts.csv', required=False,
+                        help='Csv report of code conflicts (duplicates and kept codes given to other rows)')
+    common.add_argument('--csv', action='store_true',
+                        help='Also write extracted tables to csv files in ..\\.temp_files (for debugging)')
+    common.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='Always extract dbf files and database tables, don\'t use snapshots of previous runs')
+    common.add_argument('--cache-size', type=int, default=2048, required=False,
+                        help='Max size of snapshot folder, MB (the least recently used snapshots are removed)')
+    common.add_argument('--verbosity', type=int, choices=[0, 1, 2], default=1, required=False,
+                        help='log_proc.txt details: 0 - only counters, 1 - errors, 2 - errors and successful matches')
+    common.add_argument('--log-jsonl', type=str, default=None, required=False,
+                        help='Also write outcomes of rows to JSON Lines file')
+    common.add_argument('--batch-size', type=int, default=10000, required=False,
+                        help='load-udo: rows inserted to UDO_T_IMPORT7 by one statement')
+    common.add_argument('--commit', choices=['batch', 'run'], default='batch', required=False,
+                        help='load-udo: commit after every batch or once after all rows')
+    common.add_argument('--dry-run', action='store_true',
+                        help='load-udo: don\'t insert anything, write pairs to udo_pairs.csv')
+    common.add_argument('--pushdown', action='store_true',
+                        help='load-udo: pair RN7 and RN8 inside database by one INSERT ... SELECT '
+                             '(pairing on client is used, if it fails)')
+    common.add_argument('--report', type=str, default='..\\.log_files\\report_shtrih_cli.json', required=False,
+                        help='JSON report of run: wall and CPU time, rows, rows/sec and peak memory of every stage')
+    common.add_argument('--profile', type=str, default=None, required=False,
+                        help='Run one stage under cProfile (stage name from report, e.g. process), '
+                             'dump is written to ..\\.log_files\\<stage>.prof')
+    common.add_argument('--trace-malloc', action='store_true',
+                        help='Record python memory high-water mark of stages (tracemalloc, slows down run)')
+
+    parser = ArgumentParser(prog='shtrih_cli',
+                            description='Import \'codes\' from SHTRIH.DBF(7) to SHTRIH.DBF(8) stage by stage. '
+                                        f'Stage tables and checkpoints are kept in {STAGE_DIR}')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('extract-dbf', parents=[common],
+                        help='Extract InvSoot.dbf files of parus-7 and parus-8 to stage tables')
+    commands.add_parser('extract-oracle', parents=[common],
+                        help='Extract tables import7 and udo_import7 to stage tables')
+    commands.add_parser('map', parents=[common],
+                        help='Map InvSoot8 codes on stage tables')
+    commands.add_parser('writeback', parents=[common],
+                        help='Write mapped codes to copy of InvSoot8 dbf file')
+    commands.add_parser('load-udo', parents=[common],
+                        help='Fill UDO_T_IMPORT7 with pairs of RN7 and RN8 (same as invs_test.py)')
+    run = commands.add_parser('run', parents=[common],
+                              help=f'Run stages {", ".join(STAGES)} one after another')
+    run.add_argument('--resume', action='store_true',
+                     help='Skip stages finished with the same inputs (by checkpoints), whose outputs weren\'t changed')
+    run.add_argument('--load-udo', action='store_true',
+                     help='Run load-udo before other stages')
+    commands.add_parser('status', help='Show finished stages')
+    return parser
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(build_parser().parse_args()))
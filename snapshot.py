@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import pandas as pd
+
+from columnar import write_table, read_table, table_size
+
+
+# Extracted tables are cached between runs, snapshot is valid while fingerprint of its source is the same
+SNAPSHOT_DIR = '..\\.temp_files\\snapshots'
+SNAPSHOT_FORMAT = 3
+
+# Snapshot folder is shared by sites of batch run (thread pool): changes of folder are made under lock
+_LOCK = threading.RLock()
+
+
+def snapshot_path(name: str, fingerprint: dict, snapshot_dir: str = SNAPSHOT_DIR) -> str:
+    """
+    Service function, path to snapshot of source with this fingerprint (columnar table, see columnar.py)
+    :param name: source name (InvSoot7, import7, etc.)
+    :param fingerprint: dict describing state of source
+    :param snapshot_dir: snapshot folder
+    :return: path without extension
+    """
+    key = json.dumps({'format': SNAPSHOT_FORMAT, **fingerprint}, sort_keys=True, default=str)
+    return os.path.join(snapshot_dir, f'{name}-{hashlib.sha1(key.encode()).hexdigest()[:16]}')
+
+
+def cached(name: str, fingerprint: dict, load, snapshot_dir: str = SNAPSHOT_DIR) -> pd.DataFrame:
+    """
+    Return snapshot of source, if source wasn't changed, otherwise call load() and store its result
+    Old snapshots of the same source are removed
+    :param name: source name (InvSoot7, import7, etc.)
+    :param fingerprint: dict describing state of source (record count, mtime, max RN, ...)
+    :param load: function that extracts source to pd.DataFrame
+    :param snapshot_dir: snapshot folder
+    :return: pd.DataFrame object
+    """
+    path = snapshot_path(name, fingerprint, snapshot_dir)
+    with _LOCK:
+        hit = os.path.isdir(path + '.cols')
+        if hit:
+            os.utime(path + '.cols')
+    if hit:
+        return read_table(path)
+
+    db = load()
+    with _LOCK:
+        invalidate(name, snapshot_dir)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        write_table(db, path)
+    return db
+
+
+def snapshots(snapshot_dir: str = SNAPSHOT_DIR) -> list:
+    """
+    List of snapshots, the least recently used first
+    :param snapshot_dir: snapshot folder
+    :return: list of (path without extension, size)
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+    tables = []
+    for i in os.listdir(snapshot_dir):
+        if not i.endswith('.cols'):
+            continue
+        path = os.path.join(snapshot_dir, i)[:-len('.cols')]
+        try:
+            tables.append((os.path.getmtime(path + '.cols'), path, table_size(path)))
+        except FileNotFoundError:
+            continue    # removed while folder is scanned (by other process)
+    tables.sort()
+    return [(path, size) for _, path, size in tables]
+
+
+def invalidate(name: str = None, snapshot_dir: str = SNAPSHOT_DIR) -> int:
+    """
+    Remove snapshots of one source or all snapshots
+    :param name: source name, None - all sources
+    :param snapshot_dir: snapshot folder
+    :return: number of removed snapshots
+    """
+    removed = 0
+    with _LOCK:
+        for path, _ in snapshots(snapshot_dir):
+            if name is None or os.path.basename(path).rsplit('-', 1)[0] == name:
+                shutil.rmtree(path + '.cols', ignore_errors=True)
+                removed += 1
+    return removed
+
+
+def evict(max_bytes: int, snapshot_dir: str = SNAPSHOT_DIR) -> int:
+    """
+    Remove the least recently used snapshots until total size is not bigger than max_bytes
+    :param max_bytes: size limit of snapshot folder
+    :param snapshot_dir: snapshot folder
+    :return: number of removed snapshots
+    """
+    removed = 0
+    with _LOCK:
+        files = snapshots(snapshot_dir)
+        total = sum(size for _, size in files)
+        for path, size in files:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path + '.cols', ignore_errors=True)
+            total -= size
+            removed += 1
+    return removed
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts of the repository are flat modules, imported by tests from repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
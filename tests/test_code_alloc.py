@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+
+import code_alloc
+from code_alloc import CodeAllocator
+
+
+def test_report_merged_from_spill_in_row_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_alloc, 'SPILL_CHUNK', 2)
+    spill = tmp_path / 'spill'
+    allocator = CodeAllocator(np.array([14642]), spill_dir=str(spill))
+
+    # first chunk: row 4 is duplicate of row 0, row 3 keeps code given to row 2
+    duplicated = allocator.give(np.array([0, 1, 0]), np.array([0, 2, 4]))
+    allocator.conflict('duplicate', [4], ['A'], allocator.take(1), allocator.first_row([0]))
+    allocator.keep([1, 3], [2, 1], ['C', 'B'])
+    # second chunk: code of row 1 is given to row 6, row 5 keeps code of row 0
+    duplicated = np.concatenate([duplicated, allocator.give(np.array([2, 1]), np.array([6, 7]))])
+    allocator.conflict('duplicate', [7], ['B'], None, allocator.first_row([1]))
+    allocator.keep([5, 8], [0, 3], ['A', 'D'])
+    assert duplicated.tolist() == [False, False, True, False, True]
+
+    path = str(tmp_path / 'conflicts.csv')
+    assert allocator.write_report(path) == 5
+    with open(path, encoding='UTF-8') as f:
+        assert f.read().splitlines() == ['kind@row@code@new_code@first_row',
+                                         'kept_code@1@C@@6',
+                                         'kept_code@3@B@@2',
+                                         'duplicate@4@A@00014643@0',
+                                         'kept_code@5@A@@0',
+                                         'duplicate@7@B@@2']
+    assert allocator.conflicts()['row'].tolist() == [1, 3, 4, 5, 7]
+    assert allocator.summary().endswith('duplicates: 2, kept codes given to other rows: 3')
+
+    assert os.listdir(spill)
+    allocator.close()
+    assert not os.listdir(spill)
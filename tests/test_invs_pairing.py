@@ -0,0 +1,82 @@
+import random
+import sqlite3
+
+import pytest
+
+import ora_session
+from columnar import DTYPE_INV_SUBST, DTYPE_INSOST
+from invs_test import (INVSUBST_SQL, INSOST_SQL, insost_pairs, insert_pairs, server_pairs, pair_diff,
+                       oracle_pushdown)
+
+
+@pytest.fixture
+def params(tmp_path):
+    """
+    Sqlite stand-in with uneven (PRN, NOMEN) groups, rows with null PRN / NOMEN and rows in random RN order
+    """
+    rnd = random.Random(1)
+    path = str(tmp_path / 'stand_in.db')
+    connection = sqlite3.connect(path)
+    connection.executescript('CREATE TABLE IMPORT7 (table7 text, rn7 text, rn8 integer);'
+                             'CREATE TABLE INVSUBST (RN integer, PRN integer, NOMENCLATURE integer);'
+                             'CREATE TABLE P7_INSOST (RN text, MASTER_RN text, RN_PRNOM text);'
+                             'CREATE TABLE UDO_T_IMPORT7 (table7 varchar2(20), RN7 varchar2(10), RN8 NUMBER(17));')
+    imp = [('INBASE', f'M{p:03d}', 100 + p) for p in range(20)]
+    imp += [('NOBASE', f'N{n:03d}', 500 + n) for n in range(6)] + [('NOBASE', 'NX00', 17354601)]
+    subst, insost, rn = [], [], 0
+    for p in range(20):
+        for n in range(6):
+            for _ in range(rnd.randint(0, 4)):
+                rn += 1
+                subst.append((rn * 7 % 10007, 100 + p, 500 + n))
+            for _ in range(rnd.randint(0, 4)):
+                insost.append((f'{len(insost):04d}', f'M{p:03d}', f'N{n:03d}'))
+    subst += [(90001, None, 500), (90002, 101, None), (90003, None, None), (90004, 101, 17354601)]
+    insost += [('Z001', 'M001', 'NX00'), ('Z002', 'MISS', 'N001')]
+    rnd.shuffle(subst)
+    rnd.shuffle(insost)
+    connection.executemany('insert into IMPORT7 values (?, ?, ?)', imp)
+    connection.executemany('insert into INVSUBST values (?, ?, ?)', subst)
+    connection.executemany('insert into P7_INSOST values (?, ?, ?)', insost)
+    connection.commit()
+    connection.close()
+    return {'sqlite': path, 'authid': 'main'}
+
+
+def client_pairs(connection):
+    invsubst = ora_session.fetch_frame(connection, INVSUBST_SQL, ['RN', 'PRN', 'NOMEN'], DTYPE_INV_SUBST)
+    insost = ora_session.fetch_frame(connection, INSOST_SQL, ['RN7', 'PRN', 'NOMEN'], DTYPE_INSOST)
+    return insost_pairs(invsubst, insost)
+
+
+def udo_rows(params):
+    with ora_session.connection(params) as connection:
+        return sorted(connection.execute('select table7, rn7, rn8 from UDO_T_IMPORT7').fetchall())
+
+
+def test_server_pairing_is_the_same(params):
+    with ora_session.connection(params) as connection:
+        client = client_pairs(connection)
+        server = server_pairs(connection)
+    assert len(client) > 0
+    assert client['PRN'].notna().all() and client['NOMEN'].notna().all()
+    assert pair_diff(client, server).empty
+
+
+def test_pair_diff_finds_difference(params):
+    with ora_session.connection(params) as connection:
+        client = client_pairs(connection)
+        server = server_pairs(connection)
+    client.loc[0, 'RN8'] = -1
+    diff = pair_diff(client.drop(index=1), server)
+    assert sorted(diff['SIDE']) == ['client', 'server', 'server']
+
+
+def test_pushdown_inserts_client_pairs(params):
+    with ora_session.connection(params) as connection:
+        client = client_pairs(connection)
+        insert_pairs(connection, client)
+    inserted = udo_rows(params)
+
+    assert oracle_pushdown(params) == len(client)
+    assert udo_rows(params) == inserted
@@ -0,0 +1,164 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import arb_shtrih
+import bench_shtrih
+import ora_session
+from code_alloc import CodeAllocator, code_values, DUPLICATE_KEEP
+from columnar import DTYPE_SOOT
+from dbf_mmap import read_dbf_frame, read_header
+from diagnostics import Diagnostics
+
+
+def baseline_process(db7, db8, db_imp, invsubst):
+    """
+    Row by row process() of the first version (iterrows over InvSoot8, column scans for every row),
+    without logging. A missing (rn7, invs_rn7) pair of InvSoot7 (IndexError in the first version) keeps old code
+    :return: db8 with new codes, rows given generated codes
+    """
+    def where(mask):
+        return mask.fillna(False).astype(bool)
+
+    db8 = db8.copy()
+    db8['CODE'] = db8['CODE'].astype(object)
+    codes = set()
+    codes_list = dict()
+    generated = []
+
+    max_code = 14641
+    i = 0
+    for idx, row in db8.iterrows():
+        i += 1
+        rn7 = list(db_imp.loc[where(db_imp['RN8'] == row.IRN)]['SRN7'])
+        if pd.isna(row.KRN):
+            if len(rn7) == 0:
+                continue
+            code = list(db7.loc[where(db7['IRN'] == rn7[0]) & db7['KRN'].isnull()]['CODE'])
+            if len(code) == 0:
+                codes_list[idx] = '000' + str(max_code + i)
+                generated.append(idx)
+            elif code[0] not in codes:
+                codes.add(code[0])
+                codes_list[idx] = code[0]
+        else:
+            if len(rn7) == 0:
+                continue
+            invs_rn7 = list(invsubst.loc[where(invsubst['RN8'] == row.KRN)]['RN7'])
+            if len(invs_rn7) == 0:
+                codes_list[idx] = '000' + str(max_code + i)
+                generated.append(idx)
+                continue
+            code7 = list(db7.loc[where(db7['IRN'] == rn7[0]) & where(db7['KRN'] == invs_rn7[0])]['CODE'])
+            if len(code7) == 0:
+                continue
+            if code7[0] not in codes:
+                codes.add(code7[0])
+                codes_list[idx] = code7[0]
+
+    for key, value in codes_list.items():
+        db8.loc[key, 'CODE'] = value
+    return db8, generated
+
+
+@pytest.fixture(scope='module')
+def generated(tmp_path_factory):
+    """
+    Generated dbf files and sqlite stand-in with null KRN, missing import7 / udo_import7 keys and null rn7
+    """
+    folder = str(tmp_path_factory.mktemp('generated'))
+    paths = bench_shtrih.generate(folder, 400, seed=3, missing_import7=0.1, missing_subst=0.1, duplicate_codes=0.05)
+    connection = sqlite3.connect(paths['sqlite'])
+    connection.execute('update import7 set rn7 = null where rowid % 17 = 0 and table7 = \'INBASE\'')
+    connection.execute('update udo_import7 set rn7 = null where rowid % 13 = 0')
+    connection.commit()
+    connection.close()
+    return paths
+
+
+def load(paths):
+    db7 = read_dbf_frame(paths['dbf7'] + '\\InvSoot.dbf', dtype=DTYPE_SOOT, columns=list(DTYPE_SOOT))
+    db8 = read_dbf_frame(paths['dbf8'] + '\\InvSoot.dbf', dtype=DTYPE_SOOT, columns=list(DTYPE_SOOT))
+    with ora_session.connection({'sqlite': paths['sqlite']}) as connection:
+        db_imp = arb_shtrih.fetch_import7(connection)
+        invsubst = arb_shtrih.fetch_udo_import7(connection)
+    return db7, db8, db_imp, invsubst
+
+
+def test_same_codes_as_baseline(generated, tmp_path):
+    db7, db8, db_imp, invsubst = load(generated)
+    assert db8['KRN'].isna().any() and db_imp['SRN7'].isna().any() and invsubst['RN7'].isna().any()
+    expected, fallback = baseline_process(db7, db8, db_imp, invsubst)
+
+    # duplicates keep old code as in the first version, generated codes are free codes instead of max_code + i
+    allocator = CodeAllocator(np.concatenate([code_values(db7['CODE']), code_values(db8['CODE'])]),
+                              duplicates=DUPLICATE_KEEP)
+    diagnostics = Diagnostics(str(tmp_path / 'log_proc.txt'))
+    result = arb_shtrih.process(db7, db8.copy(), db_imp, invsubst, diagnostics, allocator=allocator)
+    diagnostics.close()
+
+    assert fallback and len(fallback) < len(db8)
+    kept = np.setdiff1d(np.arange(len(db8)), fallback)
+    codes = result['CODE'].astype(object)
+    assert codes.take(kept).tolist() == expected['CODE'].take(kept).tolist()
+
+    new = codes.take(fallback)
+    assert allocator.allocated == len(fallback) and new.is_unique
+    assert not new.isin(db7['CODE'].astype(object)).any() and not new.isin(db8['CODE'].astype(object)).any()
+
+
+def test_same_result_on_workers(generated, tmp_path):
+    db7, db8, db_imp, invsubst = load(generated)
+    imp = arb_shtrih.build_import_indexes(db_imp, invsubst)
+    soot7 = arb_shtrih.build_soot7_indexes(db7)
+    serial = arb_shtrih.resolve_codes(db8['IRN'], db8['KRN'], imp, soot7)
+
+    codes = {}
+    for workers in (1, 2, 3):
+        if workers > 1:
+            sharded = arb_shtrih.resolve_codes_sharded(db8['IRN'], db8['KRN'], imp, soot7, workers)
+            assert sharded['status'].tolist() == serial['status'].tolist()
+            assert sharded['row7'].tolist() == serial['row7'].tolist()
+        diagnostics = Diagnostics(str(tmp_path / f'log_proc_{workers}.txt'))
+        result = arb_shtrih.process(db7, db8.copy(), db_imp, invsubst, diagnostics, workers=workers, imp=imp)
+        diagnostics.close()
+        codes[workers] = result['CODE'].astype(object).tolist()
+
+    assert len(set(serial['status'].tolist())) > 3
+    assert codes[1] == codes[2] == codes[3]
+
+
+def test_stream_same_as_in_memory(generated, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db7, _, db_imp, invsubst = load(generated)
+
+    # repeated (IRN, KRN) keys in the same chunk and across chunk boundaries, deleted records among them
+    with open(generated['dbf8'] + '\\InvSoot.dbf', 'rb') as f:
+        data = bytearray(f.read())
+    header = read_header(data)
+    offset, length = header.header_length, header.record_length
+    for i, j in ((0, 1), (6, 7), (13, 21), (20, 300), (5, 399), (399, 398), (150, 0)):
+        data[offset + length * j + 1:offset + length * j + 35] = data[offset + length * i + 1:offset + length * i + 35]
+    for i in (0, 7, 100, 299):
+        data[offset + length * i] = ord('*')
+    source = str(tmp_path / 'InvSoot8.dbf')
+    with open(source, 'wb') as f:
+        f.write(data)
+
+    db8 = read_dbf_frame(source, dtype=DTYPE_SOOT, columns=list(DTYPE_SOOT))
+    diagnostics = Diagnostics(str(tmp_path / 'log_proc.txt'))
+    result = arb_shtrih.process(db7, db8, db_imp, invsubst, diagnostics)
+    diagnostics.close()
+    arb_shtrih.patch_codes(source, str(tmp_path / 'in_memory.dbf'), result)
+    with open(tmp_path / 'in_memory.dbf', 'rb') as f:
+        expected = f.read()
+
+    for chunk_size in (1, 7, 1000):
+        target = str(tmp_path / f'stream_{chunk_size}.dbf')
+        diagnostics = Diagnostics(str(tmp_path / 'log_proc.txt'))
+        arb_shtrih.stream_codes(source, target, db7, db_imp, invsubst, chunk_size, diagnostics)
+        diagnostics.close()
+        with open(target, 'rb') as f:
+            assert f.read() == expected, chunk_size
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import rn7_codec
+from arb_shtrih import convert7
+
+
+ASCII_RN7 = ['0A', 'zz9_', '!~ab', 'AAAA', '0000001']
+CYRILLIC_RN7 = ['АБВГ', 'ёЁжЖ', 'аб1Я']
+
+
+def test_round_trip():
+    column = ASCII_RN7 + CYRILLIC_RN7 + ['']
+    assert rn7_codec.decode(rn7_codec.encode(column)).tolist() == column
+    assert rn7_codec.unpack(rn7_codec.pack(column)).tolist() == column
+
+
+def test_null():
+    assert rn7_codec.encode(['0A', None]).tolist() == [b'048065', b'']
+    assert rn7_codec.pack([None, np.nan]).tolist() == [0, 0]
+    assert rn7_codec.value([None, '']).isna().tolist() == [True, True]
+
+
+def test_same_as_convert7_for_ascii():
+    assert rn7_codec.encode(ASCII_RN7).astype(str).tolist() == [convert7(i) for i in ASCII_RN7]
+
+
+def test_database_charset():
+    # oracle ASCII() returns byte of char in database charset, convert7 (ord) differs for not ASCII chars
+    assert rn7_codec.encode(['АБВГ']).tolist() == [b'192193194195']
+    assert convert7('АБВГ') != '192193194195'
+    assert rn7_codec.value(['АБВГ']).tolist() == [192193194195]
+
+
+def test_value_and_packed_input():
+    column = ['0A', 'АБВГ', None]
+    packed = rn7_codec.pack(column)
+    assert rn7_codec.value(packed).tolist() == rn7_codec.value(column).tolist()
+    assert rn7_codec.encode(packed).tolist() == rn7_codec.encode(column).tolist()
+    assert rn7_codec.value(['1234'], drop_first=True).tolist() == [49050051052]
+
+
+def test_not_in_charset():
+    with pytest.raises(ValueError):
+        rn7_codec.encode(['日本'])
+    with pytest.raises(ValueError):
+        rn7_codec.pack(['12345678'])
@@ -0,0 +1,54 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import arb_shtrih
+import bench_shtrih
+from columnar import DTYPE_SOOT
+from dbf_mmap import read_dbf_frame
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    """
+    InvSoot.dbf with null KRN, repeated keys and deleted records
+    """
+    monkeypatch.chdir(tmp_path)
+    rows = 60
+    irn = (1000 + np.arange(rows) % 45).astype('S17')
+    krn = np.where(np.arange(rows) % 3 == 0, b'', (2000 + np.arange(rows) % 7).astype('S17'))
+    path = str(tmp_path / 'InvSoot.dbf')
+    bench_shtrih.write_dbf(path, bench_shtrih.SOOT_FIELDS,
+                           [irn, krn, np.arange(rows).astype('S10'), np.full(rows, b'0000000000001'),
+                            np.full(rows, b'name')])
+    with open(path, 'r+b') as f:
+        header = f.read(12)
+        header_length, record_length = int.from_bytes(header[8:10], 'little'), int.from_bytes(header[10:12], 'little')
+        for i in (0, 5, 17, 59):
+            f.seek(header_length + i * record_length)
+            f.write(b'*')
+    return path
+
+
+def test_patch_codes_same_bytes_as_write_codes(source, tmp_path):
+    result_db = read_dbf_frame(source, dtype=DTYPE_SOOT, columns=list(DTYPE_SOOT))
+    codes = ['', '7', '00014642', '0000123456789', None, '123456789012']
+    result_db['CODE'] = [codes[i % len(codes)] for i in range(len(result_db))]
+    # records without new code are left unchanged
+    result_db = result_db.iloc[3:].reset_index(drop=True)
+
+    written = str(tmp_path / 'written.dbf')
+    shutil.copyfile(source, written)
+    missed = arb_shtrih.write_codes(written, arb_shtrih.build_code_index(result_db))
+    patched = str(tmp_path / 'patched.dbf')
+    assert arb_shtrih.patch_codes(source, patched, result_db) == missed
+
+    with open(written, 'rb') as f:
+        expected = f.read()
+    with open(patched, 'rb') as f:
+        actual = f.read()
+    # the dbf library sets date of last update (bytes 1-3 of header)
+    assert actual[:1] + actual[4:] == expected[:1] + expected[4:]
+    assert actual != open(source, 'rb').read()